@@ -0,0 +1,250 @@
+#!/usr/bin/python3
+import twpath
+import twdaemon
+import portPairs
+import multiprocessing
+import itertools
+import argparse
+import heapq
+
+
+DEFAULT_DB_NAME = 'tw2002.db'
+
+COMMODITIES = ('Ore', 'Org', 'Equ')
+
+# rough credits made on a unit of each commodity bought from a port selling at 100% and sold to a port buying at 100%.
+# ports at lower percentages give worse prices, so a leg's margin is scaled by the two ports' percentages
+UNIT_MARGINS = (10, 18, 30)
+
+DEFAULT_HOLDS = 50
+DEFAULT_TOP = 20
+
+# a port class as (sells, buys) masks, with the bits portPairs.class_mask uses
+def trade_masks(port_class):
+    buys = portPairs.class_mask(port_class)
+    return 7 & ~buys, buys
+
+# the most profitable cargo to carry from seller to buyer, given the commodities one sells and the other buys, as
+# (estimated profit, commodity, units); None if neither port has any of them to trade
+def best_trade(seller, buyer, commodities, holds):
+    best = None
+    for c in range(3):
+        if(not commodities & (1 << c)):
+            continue
+        units = min(holds, seller[2 + 2 * c], buyer[2 + 2 * c])
+        if(units <= 0):
+            continue
+        profit = units * UNIT_MARGINS[c] * (seller[3 + 2 * c] + buyer[3 + 2 * c]) / 200
+        if(best is None or profit > best[0]):
+            best = (profit, c, units)
+    return best
+
+# the sectors no more than limit hops from start (or to start, with reverse=True), as { sector: hops }
+def hops_within(graph, start, limit, reverse=False):
+    offsets, targets = graph.adjacency(reverse)
+    hops = {start: 0}
+    level = [start]
+    for distance in range(1, limit + 1):
+        following = []
+        for current in level:
+            if(current >= graph.size):
+                continue
+            for i in range(offsets[current], offsets[current + 1]):
+                neighbor = targets[i]
+                if(neighbor not in hops):
+                    hops[neighbor] = distance
+                    following.append(neighbor)
+        level = following
+    return hops
+
+# every leg worth flying: from each port to each port no more than separation hops away that buys something it sells,
+# with the best cargo for it.  returns { sector: [(sector, hops, profit, commodity, units), ...] }
+def find_legs(graph, ports, separation, holds):
+    masks = {sector: trade_masks(port[1]) for sector, port in ports.items()}
+    legs = {}
+    for sector, port in ports.items():
+        sells = masks[sector][0]
+        if(not sells):
+            continue
+        found = []
+        for other, hops in hops_within(graph, sector, separation).items():
+            if(other == sector or other not in ports):
+                continue
+            trade = best_trade(port, ports[other], sells & masks[other][1], holds)
+            if(trade):
+                found.append((other, hops) + trade)
+        if(found):
+            legs[sector] = found
+    return legs
+
+# best first, ties going to the circuit through the lowest sectors
+def circuit_rank(circuit):
+    return (circuit[0], circuit[1], tuple(-s for s in circuit[3]))
+
+# the top most profitable circuits per turn that start from one of starts, best first.  each circuit is found once,
+# from its lowest sector.  a circuit is (profit per turn, profit, hops, sectors, legs), with a (commodity, units, hops)
+# leg leaving each sector.  branches that can't get back to the start in time, or can't beat the top found so far,
+# are pruned; shared_best is the lowest profit per turn still in the running across the processes searching other starts
+def search_circuits(legs, starts, lengths, separation, turns_per_warp, top, shared_best=None):
+    longest = max(lengths)
+    most = max(leg[2] for found in legs.values() for leg in found)
+    # the legs into each port, and how many hops each one is
+    into = {}
+    for sector, found in legs.items():
+        for leg in found:
+            into.setdefault(leg[0], {})[sector] = leg[1]
+    best = []
+    threshold = 0
+
+    def record(circuit):
+        nonlocal threshold
+        key = circuit_rank(circuit)
+        if(len(best) < top):
+            heapq.heappush(best, (key, circuit))
+        elif(key > best[0][0]):
+            heapq.heapreplace(best, (key, circuit))
+        else:
+            return
+        if(len(best) == top and best[0][0][0] > threshold):
+            threshold = best[0][0][0]
+            if(shared_best is not None):
+                with shared_best.get_lock():
+                    if(shared_best.value < threshold):
+                        shared_best.value = threshold
+
+    for start in starts:
+        # the fewest hops back to start from the ports one and two legs away from it; any further out, each leg left
+        # is at least one hop
+        home = {1: into.get(start, {}), 2: {}}
+        for middle, middle_hops in home[1].items():
+            if(middle < start):
+                continue
+            for other, other_hops in into.get(middle, {}).items():
+                if(other > start and other != middle and other_hops + middle_hops < home[2].get(other, longest * separation + 1)):
+                    home[2][other] = other_hops + middle_hops
+        path = [start]
+        trades = []
+
+        def extend(sector, profit, hops):
+            nonlocal threshold
+            depth = len(path)
+            for other, leg_hops, leg_profit, commodity, units in legs.get(sector, ()):
+                if(other == start):
+                    if(depth in lengths):
+                        total_hops = hops + leg_hops
+                        total = profit + leg_profit
+                        record((total / (total_hops * turns_per_warp), total, total_hops, tuple(path), tuple(trades) + ((commodity, units, leg_hops),)))
+                    continue
+                if(depth == longest or other < start or other in path):
+                    continue
+                # the best any circuit through here could do: the legs left all as profitable as the best leg there is,
+                # and as short as they can be
+                bound = None
+                for n in lengths:
+                    left = n - depth
+                    if(left < 1):
+                        continue
+                    back = home[left].get(other) if left in home else left
+                    if(back is not None):
+                        per_turn = (profit + leg_profit + left * most) / ((hops + leg_hops + back) * turns_per_warp)
+                        if(bound is None or per_turn > bound):
+                            bound = per_turn
+                if(bound is None):
+                    continue
+                if(shared_best is not None and shared_best.value > threshold):
+                    threshold = shared_best.value
+                if(bound < threshold):
+                    continue
+                path.append(other)
+                trades.append((commodity, units, leg_hops))
+                extend(other, profit + leg_profit, hops + leg_hops)
+                path.pop()
+                trades.pop()
+
+        extend(start, 0, 0)
+    return [circuit for key, circuit in sorted(best, reverse=True)]
+
+worker_args = None
+
+def circuits_init(*args):
+    global worker_args
+    worker_args = args
+
+def circuits_worker(starts):
+    legs, lengths, separation, turns_per_warp, top, shared_best = worker_args
+    return search_circuits(legs, starts, lengths, separation, turns_per_warp, top, shared_best)
+
+# the top most profitable circuits per turn, best first.  with processes, the starting sectors are dealt out across a
+# process pool
+def find_circuits(ports, lengths=(3, 4), separation=1, holds=DEFAULT_HOLDS, turns_per_warp=1, top=DEFAULT_TOP, processes=1):
+    graph = twpath.load_graph()
+    legs = find_legs(graph, ports, separation, holds)
+    starts = sorted(legs)
+    if(len(starts) == 0):
+        return []
+    if(processes > 1 and len(starts) > 1):
+        # the lower a starting sector, the more circuits it has to search, so deal them out round-robin
+        batches = [starts[i::processes * 4] for i in range(min(processes * 4, len(starts)))]
+        shared_best = multiprocessing.Value('d', 0)
+        with multiprocessing.Pool(processes, initializer=circuits_init, initargs=(legs, lengths, separation, turns_per_warp, top, shared_best)) as pool:
+            found = itertools.chain.from_iterable(pool.map(circuits_worker, batches, chunksize=1))
+            return heapq.nlargest(top, found, key=circuit_rank)
+    return search_circuits(legs, starts, lengths, separation, turns_per_warp, top)
+
+def main(dbname, lengths=(3, 4), separation=1, holds=DEFAULT_HOLDS, turns_per_warp=1, top=DEFAULT_TOP, processes=1):
+    twpath.connect_database(dbname)
+
+    ports = {}
+    max_last_seen = ''
+    for row in twpath.port_list():
+        ports[row[0]] = row
+        if(row[8] > max_last_seen):
+            max_last_seen = row[8]
+
+    circuits = find_circuits(ports, lengths=lengths, separation=separation, holds=holds, turns_per_warp=turns_per_warp, top=top, processes=processes)
+    if(len(circuits) == 0):
+        print('No circuits found with ports no more than {} hop{} apart; try a larger --separation.'.format(separation, '' if separation == 1 else 's'))
+        return
+
+    # best last, so it's nearest the prompt
+    for per_turn, profit, hops, sectors, trades in reversed(circuits):
+        for sector in sectors:
+            port = portPairs.Port(ports[sector])
+            portStr = str(port)
+            if(port.last_seen < max_last_seen):
+                portStr += '\t(Not scanned since {})'.format(port.last_seen)
+            print(portStr)
+        print("Circuit ({} ports, {} hops):  {}".format(len(sectors), hops, ' > '.join(str(s) for s in sectors + sectors[:1])))
+        for i, (commodity, units, leg_hops) in enumerate(trades):
+            source = sectors[i]
+            destination = sectors[(i + 1) % len(sectors)]
+            legStr = "\t{} {}:\t{} > {}".format(units, COMMODITIES[commodity], source, destination)
+            if(leg_hops > 1):
+                legStr += "\t(route: {})".format(' > '.join(str(s) for s in twpath.dijkstra(source, destination)[0]))
+            print(legStr)
+        print("Estimated profit: {:.0f} credits per circuit, {:.0f} per turn".format(profit, per_turn))
+        print('')
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Find trade circuits of three or four ports, each selling the next one something it buys, ranked by estimated profit per turn.')
+    parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
+    parser.add_argument('--ports', '-n', type=int, nargs='+', choices=[3, 4], default=[3, 4], help='How many ports a circuit can have; default 3 4')
+    parser.add_argument('--separation', '-s', type=int, default=1, help='How far apart consecutive ports can be; default 1 hop (adjacent sectors)')
+    parser.add_argument('--holds', type=int, default=DEFAULT_HOLDS, help='Cargo holds on your ship; default {}'.format(DEFAULT_HOLDS))
+    parser.add_argument('--turns-per-warp', type=int, default=1, help='Turns your ship uses per warp, to work out the profit per turn; default 1')
+    parser.add_argument('--top', '-t', type=int, default=DEFAULT_TOP, help='How many circuits to show; default {}'.format(DEFAULT_TOP))
+    parser.add_argument('--processes', '-j', type=int, default=1, help='Number of worker processes to spread the search across; default 1')
+
+    args = parser.parse_args(argv)
+
+    if(args.separation < 1 or args.holds < 1 or args.turns_per_warp < 1 or args.top < 1):
+        parser.error('--separation, --holds, --turns-per-warp and --top must be at least 1')
+
+    if(twdaemon.forward(args.db, 'portCircuits', argv)):
+        return
+
+    main(args.db, lengths=tuple(args.ports), separation=args.separation, holds=args.holds, turns_per_warp=args.turns_per_warp, top=args.top, processes=args.processes)
+
+
+if(__name__ == '__main__'):
+    run()
@@ -1,9 +1,16 @@
 #!/usr/bin/python3
-import sqlite3
 import twpath
+import twhops
+import twdaemon
+import heapq
 import re
 import argparse
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 port_class_numbers = {'BBS':1, 'BSB':2, 'SBB':3, 'SSB':4, 'SBS':5, 'BSS':6, 'SSS':7, 'BBB':8}
 port_class_sales =   {1:'BBS', 2:'BSB', 3:'SBB', 4:'SSB', 5:'SBS', 6:'BSS', 7:'SSS', 8:'BBB'}
@@ -36,6 +43,138 @@ class Port:
 
 
 
+# a port class as a 3-bit mask with a bit set for each commodity (ore, org, equ) the port buys
+def class_mask(port_class):
+    mask = 0
+    for i, c in enumerate(port_class):
+        if(c == 'B'):
+            mask |= 1 << i
+    return mask
+
+# the commodities a port type cares about and which of those it wants bought, as masks: a port of class C matches
+# when class_mask(C) & care == want
+def type_masks(port_type):
+    care = 0
+    want = 0
+    for i, c in enumerate(port_type):
+        if(c != '?'):
+            care |= 1 << i
+            if(c == 'B'):
+                want |= 1 << i
+    return care, want
+
+# the ports table as columns, for scoring every candidate pair at once
+class PortTable:
+    rows = None
+    sector = None
+    mask = None
+    amt = None
+    pct = None
+    index = None
+
+    def __init__(self, rows, size):
+        self.rows = rows
+        masks = {}
+        for row in rows:
+            if(row[1] not in masks):
+                masks[row[1]] = class_mask(row[1])
+        self.sector = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        self.mask = numpy.array([masks[row[1]] for row in rows], dtype=numpy.int8)
+        levels = numpy.array([row[2:8] for row in rows], dtype=numpy.int64).reshape(-1, 6)
+        self.amt = levels[:, 0::2]
+        self.pct = levels[:, 1::2]
+        # the row of the port in each sector, -1 where there isn't one
+        self.index = numpy.full(max(size, int(self.sector.max(initial=0)) + 1), -1, dtype=numpy.int64)
+        self.index[self.sector] = numpy.arange(len(rows))
+
+    def matching(self, port_type):
+        care, want = type_masks(port_type)
+        return (self.mask & care) == want
+
+    def port(self, sector):
+        return Port(self.rows[self.index[sector]])
+
+    # (pct_score, amt_score) of each pair, as port_score works them out
+    def scores(self, lo, hi, port_type):
+        cols = [i for i in range(3) if port_type[i] != "?"]
+        a = self.index[lo]
+        b = self.index[hi]
+        pct = (self.pct[a][:, cols] + self.pct[b][:, cols]).sum(axis=1)
+        amt = numpy.minimum(self.amt[a][:, cols], self.amt[b][:, cols]).sum(axis=1)
+        return pct, amt
+
+# the distinct pairs among (source, destination) sector pairs, in the order they were first found.  like the dict the
+# pure Python search fills in, a pair found twice keeps its first place but the direction it was found in last.
+# returns the lower and higher sector of each pair, and the one it was found from
+def distinct_pairs(sources, destinations):
+    lo = numpy.minimum(sources, destinations)
+    hi = numpy.maximum(sources, destinations)
+    key = lo * (int(hi.max(initial=0)) + 1) + hi
+    keys, first = numpy.unique(key, return_index=True)
+    keys, last = numpy.unique(key[::-1], return_index=True)
+    last = len(key) - 1 - last
+    order = numpy.argsort(first, kind='stable')
+    return lo[first[order]], hi[first[order]], sources[last[order]]
+
+# pairs of adjacent sectors with a warp each way, a type A port in one and a type B port in the other, found with
+# array operations on the sector graph's warp lists
+def adjacent_pairs(table, is_a, is_b):
+    graph = twpath.load_graph()
+    size = max(graph.size, len(table.index))
+    offsets = numpy.asarray(graph.fwd_offsets, dtype=numpy.int64)
+    targets = numpy.asarray(graph.fwd_targets, dtype=numpy.int64)
+    sources = numpy.repeat(numpy.arange(graph.size, dtype=numpy.int64), numpy.diff(offsets))
+    a_at = numpy.zeros(size, dtype=bool)
+    a_at[table.sector[is_a]] = True
+    b_at = numpy.zeros(size, dtype=bool)
+    b_at[table.sector[is_b]] = True
+    keep = a_at[sources] & b_at[targets]
+    # the warp lists are sorted, so the warps' keys are too and the warp back can be found by bisection
+    keys = sources * size + targets
+    back = targets[keep] * size + sources[keep]
+    found = numpy.minimum(numpy.searchsorted(keys, back), len(keys) - 1)
+    sources = sources[keep][keys[found] == back]
+    targets = targets[keep][keys[found] == back]
+    # in the order the pure Python search finds them: port by port, then warp by warp
+    order = numpy.lexsort((targets, table.index[sources]))
+    return distinct_pairs(sources[order], targets[order])
+
+# pairs of type A and B ports no more than separation hops apart each way, looked up in the hop matrix.  they're
+# listed in the order search_pairs finds them, searching outward from each type A port that has any, so pairs with
+# equal scores are printed in the same order whether or not the matrix is up to date
+def hop_matrix_pairs(table, hops, is_a, is_b, separation):
+    a_sectors = table.sector[is_a]
+    b_sectors = table.sector[is_b]
+    a_sectors = a_sectors[a_sectors < hops.size]
+    b_sectors = b_sectors[b_sectors < hops.size]
+    matrix = numpy.frombuffer(hops.map, dtype=numpy.uint8, count=hops.size * hops.size, offset=twhops.HEADER_SIZE).reshape(hops.size, hops.size)
+    there = matrix[numpy.ix_(a_sectors, b_sectors)]
+    back = matrix[numpy.ix_(b_sectors, a_sectors)].T
+    same = a_sectors[:, None] == b_sectors[None, :]
+    close = ((there <= separation) | same) & ((back <= separation) | same)
+    sources = []
+    destinations = []
+    for i in numpy.flatnonzero(close.any(axis=1)):
+        sector = int(a_sectors[i])
+        for pathAB in twpath.dijkstra(sector, b_sectors[close[i]].tolist(), return_all=True, max_hops=separation):
+            sources.append(sector)
+            destinations.append(pathAB[-1])
+    return distinct_pairs(numpy.array(sources, dtype=numpy.int64), numpy.array(destinations, dtype=numpy.int64))
+
+# the order to print pairs in: by score, best last, as sorting all of them would.  with top, only the best top pairs,
+# picked out by partitioning on the score rather than sorting everything
+def ranked_pairs(pct, amt, top=None):
+    order = numpy.arange(len(pct))
+    if(top is not None and top < len(pct)):
+        key = pct * (int(amt.max()) + 1) + amt
+        threshold = numpy.partition(key, len(key) - top)[len(key) - top]
+        above = numpy.flatnonzero(key > threshold)
+        # of the pairs tied with the last one in, a stable sort would put the last found at the end
+        tied = numpy.flatnonzero(key == threshold)
+        order = numpy.concatenate((above, tied[len(tied) - (top - len(above)):]))
+        order.sort()
+    return order[numpy.lexsort((order, amt[order], pct[order]))]
+
 def port_score(portA, portB, port_type):
     pct_score = 0
     amt_score = 0
@@ -50,84 +189,123 @@ def port_score(portA, portB, port_type):
         amt_score += min(portA.equ_amt, portB.equ_amt)
     return (pct_score, amt_score)
 
-def main(dbname, port_type_A, port_type_B, separation=1, start=None, commissioned=False):
-    database = sqlite3.connect(dbname)
-
-    ports = {}
+def regen_str(rates):
+    if(rates is None or rates[3] < 2):
+        return "Regeneration: not enough reports"
+    return "Regeneration per day ({} reports):\tOre: {}  Org: {}  Equ: {}".format(rates[3],
+            *['{:+.0f}'.format(r) if r is not None else '?' for r in rates[:3]])
 
-    conn = database.cursor()
-
-    port_type_A = port_type_A.upper()
-    port_type_B = port_type_B.upper()
-
-    ptA_regex = "^" + port_type_A.replace("?", ".") + "$"
-    ptB_regex = "^" + port_type_B.replace("?", ".") + "$"
-
-    fedSpace = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
-    if(commissioned):
-        starDock = None
-        try:
-            for sd in conn.execute('SELECT value FROM settings WHERE key=?', ('stardock',)):
-                starDock = int(sd[0])
-        except:
-            pass
-        if(starDock):
-            fedSpace.append(starDock)
+# port pairs no more than separation hops apart each way, found by searching outward from each type A port.  returns
+# { (lower sector, higher sector): (pathAB, pathBA) } in the order they were found
+def search_pairs(portA_candidates, portB_candidates, separation):
+    candidates = {}
+    for sector in portA_candidates:
+        for pathAB in twpath.dijkstra(sector, portB_candidates, return_all=True, max_hops=separation):
+            destination = pathAB[-1]
+            # the distance one way is good, but we should check the return path too in case of one-way warps
+            pathBA = twpath.dijkstra(destination, sector, max_hops=separation)
+            if(len(pathBA)):
+                candidates[tuple(sorted([sector, destination]))] = (pathAB, pathBA[0])
+    return candidates
 
-    max_last_seen = ''
+# the candidate pairs without numpy, from a Port object per port: { (lower sector, higher sector): (pathAB, pathBA) }
+def python_pairs(ports, port_type_A, port_type_B, separation, hops):
+    careA, wantA = type_masks(port_type_A)
+    careB, wantB = type_masks(port_type_B)
     portA_candidates = []
     portB_candidates = []
-    # get a list of all ports
-    for port in conn.execute('SELECT * FROM ports'):
-        p = Port(port)
-        ports[p.sector] = p
-        if(p.last_seen > max_last_seen):
-            max_last_seen = p.last_seen
-        if(re.match(ptA_regex, p.port_class)):
+    for p in ports.values():
+        mask = class_mask(p.port_class)
+        if(mask & careA == wantA):
             portA_candidates.append(p.sector)
-        if(re.match(ptB_regex, p.port_class)):
+        if(mask & careB == wantB):
             portB_candidates.append(p.sector)
 
-    # find all the neighboring ports
-    for sector in ports:
-        for warp in conn.execute('SELECT destination FROM warps WHERE source=?', (sector,)):
-            warp = warp[0]
-            # print(sector, warp)
-            if(warp in ports):
-                ports[sector].warps[warp] = True
-        # print(sector, ports[sector].warps)
-
-    twpath.connect_database(dbname)
-
-    # print('portA_candidates', portA_candidates)
-    # print('portB_candidates', portB_candidates)
-
     candidates = {}
-    if(separation > 1):
-        # find port pairs that satisfy the desired criteria
+    if(hops):
+        # the precomputed hop matrix answers both directions with two lookups, so we only search from the type A ports
+        # that have a pair, to list them in the order search_pairs would
         for sector in portA_candidates:
-            portA = ports[sector]
-            # if(portA.port_class[1:] != 'SB'):
-            for pathAB in twpath.dijkstra(sector, portB_candidates, return_all=True):
-                distanceAB = len(pathAB)-1
+            close = [destination for destination in portB_candidates if hops.distance(sector, destination) <= separation and hops.distance(destination, sector) <= separation]
+            if(len(close) == 0):
+                continue
+            for pathAB in twpath.dijkstra(sector, close, return_all=True, max_hops=separation):
                 destination = pathAB[-1]
-                if(distanceAB <= separation):
-                    # the distance one way is good, but we should check the return path too in case of one-way warps
-                    pathBA = twpath.dijkstra(destination, sector)[0]
-                    distanceBA = len(pathBA)-1
-                    # print(sector, path)
-                    if(distanceBA <= separation):
-                        candidates[tuple(sorted([sector, destination]))] = (pathAB, pathBA)
+                pathBA = twpath.dijkstra(destination, sector)[0]
+                candidates[tuple(sorted([sector, destination]))] = (pathAB, pathBA)
+    elif(separation > 1):
+        candidates = search_pairs(portA_candidates, portB_candidates, separation)
     else:
+        # find all the neighboring ports
+        for sector in ports:
+            for warp in twpath.warps_from(sector):
+                if(warp in ports):
+                    ports[sector].warps[warp] = True
         # use the faster checks for adjacency rather than the full dijkstra shortest-path we need for non-adjacent sectors
+        portB_set = set(portB_candidates)
         for sector in portA_candidates:
             portA = ports[sector]
             for warp in portA.warps:
-                if(warp in portB_candidates):
+                if(warp in portB_set):
                     portB = ports[warp]
                     if(sector in portB.warps):
                         candidates[tuple(sorted([sector, warp]))] = ([sector, warp], [warp, sector])
+    return candidates
+
+def main(dbname, port_type_A, port_type_B, separation=1, start=None, commissioned=False, regen=False, top=None):
+    twpath.connect_database(dbname)
+
+    port_type_A = port_type_A.upper()
+    port_type_B = port_type_B.upper()
+
+    fedSpace = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
+    if(commissioned):
+        starDock = twpath.get_setting('stardock')
+        if(starDock):
+            fedSpace.append(int(starDock))
+
+    rows = twpath.port_list()
+    max_last_seen = max((row[8] for row in rows), default='')
+
+    hops = None
+    if(separation > 1):
+        hops = twhops.load(dbname)
 
+    # each pair to print is (lower sector, higher sector, the sector it was found from), worst first; the routes
+    # between them are looked up only for the pairs that are printed, unless the search found them already
+    paths = {}
+    if(numpy is not None and len(rows)):
+        table = PortTable(rows, twpath.load_graph().size)
+        is_a = table.matching(port_type_A)
+        is_b = table.matching(port_type_B)
+        if(hops):
+            lo, hi, found_from = hop_matrix_pairs(table, hops, is_a, is_b, separation)
+        elif(separation > 1):
+            paths = search_pairs(table.sector[is_a].tolist(), table.sector[is_b].tolist(), separation)
+            lo = numpy.array([a_b[0] for a_b in paths], dtype=numpy.int64)
+            hi = numpy.array([a_b[1] for a_b in paths], dtype=numpy.int64)
+            found_from = numpy.array([pathAB[0] for pathAB, pathBA in paths.values()], dtype=numpy.int64)
+        else:
+            lo, hi, found_from = adjacent_pairs(table, is_a, is_b)
+        pct, amt = table.scores(lo, hi, port_type_A)
+        pairs = [(int(lo[i]), int(hi[i]), int(found_from[i])) for i in ranked_pairs(pct, amt, top)]
+        port = table.port
+    else:
+        ports = {}
+        for row in rows:
+            p = Port(row)
+            ports[p.sector] = p
+        paths = python_pairs(ports, port_type_A, port_type_B, separation, hops)
+        keys = list(paths)
+        def score(i):
+            return port_score(ports[keys[i][0]], ports[keys[i][1]], port_type_A)
+        if(top is not None):
+            order = heapq.nlargest(top, range(len(keys)), key=lambda i: (score(i), i))
+            order.reverse()
+        else:
+            order = sorted(range(len(keys)), key=score)
+        pairs = [keys[i] + (paths[keys[i]][0][0],) for i in order]
+        port = ports.__getitem__
 
     fighters = twpath.fighter_locations()
     if(commissioned):
@@ -137,24 +315,54 @@ def main(dbname, port_type_A, port_type_B, separation=1, start=None, commissione
 
     blind_warps = twpath.blind_warps()
 
-    for a_b in sorted(candidates.keys(), key=lambda a_b:port_score(ports[a_b[0]], ports[a_b[1]], port_type_A)):
+    # one search from all fighters (and one from all blind warps) answers "nearest safe warp" for every port
+    fighter_routes = None
+    if(len(fighters)):
+        fighter_routes = twpath.nearest_sources(fighters)
+    blind_routes = None
+    if(len(blind_warps)):
+        blind_routes = twpath.nearest_sources(blind_warps)
+
+    regen_rates = None
+    if(regen):
+        regen_rates = twpath.port_regen_rates()
+
+    for a, b, found_from in pairs:
+        a_b = (a, b)
+        if(a_b in paths):
+            pathAB, pathBA = paths[a_b]
+        else:
+            other = b if found_from == a else a
+            if(separation > 1):
+                pathAB = twpath.dijkstra(found_from, other)[0]
+                pathBA = twpath.dijkstra(other, found_from)[0]
+            else:
+                pathAB = [found_from, other]
+                pathBA = [other, found_from]
+        distanceAB = len(pathAB)-1
+        distanceBA = len(pathBA)-1
         for p in a_b:
-            pathAB, pathBA = candidates[a_b]
-            distanceAB = len(pathAB)-1
-            distanceBA = len(pathBA)-1
+            portP = port(p)
             fRoute = None
-            if(len(fighters)):
-                fRoute = [str(s) for s in twpath.dijkstra(p, fighters, reverse=True)[0]]
-            portStr = str(ports[p])
-            if(ports[p].last_seen < max_last_seen):
-                portStr += '\t(Not scanned since {})'.format(ports[p].last_seen)
+            if(fighter_routes):
+                fRoute = fighter_routes.route(p)
+            if(fRoute):
+                fRoute = [str(s) for s in fRoute]
+            portStr = str(portP)
+            if(portP.last_seen < max_last_seen):
+                portStr += '\t(Not scanned since {})'.format(portP.last_seen)
             if(fRoute and len(fRoute) == 1):
                 portStr += '\t *** Direct warp available ***'
             print(portStr)
+            if(regen_rates is not None):
+                print("\t\t{}".format(regen_str(regen_rates.get(p))))
             if(fRoute and len(fRoute) > 1):
                 print("\t\tRoute from nearest safe warp ({} hops):\t{}".format(len(fRoute)-1, ' > '.join(fRoute)))
-            if(len(blind_warps)):
-                bRoute = [str(s) for s in twpath.dijkstra(p, blind_warps, reverse=True)[0]]
+            bRoute = None
+            if(blind_routes):
+                bRoute = blind_routes.route(p)
+            if(bRoute):
+                bRoute = [str(s) for s in bRoute]
                 if(fRoute is None or len(bRoute) < len(fRoute)):
                     print("\t\tNearest explored blind warp ({} hops):\t{}".format(len(bRoute)-1, ' > '.join(bRoute)))
 
@@ -168,17 +376,22 @@ def main(dbname, port_type_A, port_type_B, separation=1, start=None, commissione
                 ))
         print('')
 
-if(__name__ == '__main__'):
+def run(argv=None):
     parser = argparse.ArgumentParser(description='Find pairs of adjacent ports that will buy/sell your desired commodities.  One port of the pair will match what you specify in the command, and the other will be the opposite.')
     parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
     parser.add_argument('--commissioned', '-c', action='store_true', help='If you have a Commission, FedSpace sectors will be factored in for the nearest safe warp location')
     parser.add_argument('--port-type', '-p', default="?BS", help='Specify a port type by listing desired commodities in the following order: Ore Org Equ, specifying Buy (B) Sell (S) or don\'t care (?).  e.g., "?S?" for a port that sells Organics.  Can specify both port types, if desired, e.g., "SBS-SSB".  Default: "?BS".')
     parser.add_argument('--separation', '-s', type=int, default=1, help='How far apart the two ports can be; default 1 hop (adjacent sectors)')
+    parser.add_argument('--regen', '-r', action='store_true', help='Show how fast each port regenerates, estimated from the history of port reports')
+    parser.add_argument('--top', '-t', type=int, help='Only show the best TOP pairs')
     parser.add_argument('start', type=int, nargs='?', help='Optional starting sector for the route calculation')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     # print(args)
 
+    if(twdaemon.forward(args.db, 'portPairs', argv)):
+        return
+
     if(args.port_type):
         tmp = re.match('^(?P<portA>[BbSs?]{3})-(?P<portB>[BbSs?]{3})$', args.port_type)
         if(tmp):
@@ -190,5 +403,11 @@ if(__name__ == '__main__'):
         else:
             raise argparse.ArgumentTypeError('Enter a 3 character code consisting only of "?", "B", or "S", e.g., "S?B" for a port that sells Fuel Ore and buys Equipment.  Optionally, enter two 3 character codes separated by a "-", e.g., "S?B-?SS".')
 
-    main(args.db, portA, portB, separation=args.separation, start=args.start, commissioned=args.commissioned)
+    if(args.top is not None and args.top < 1):
+        parser.error('--top must be at least 1')
 
+    main(args.db, portA, portB, separation=args.separation, start=args.start, commissioned=args.commissioned, regen=args.regen, top=args.top)
+
+
+if(__name__ == '__main__'):
+    run()
@@ -1,8 +1,14 @@
 #!/usr/bin/python3
 
-import sqlite3
 import argparse
-import queue
+import sqlite3
+import heapq
+import functools
+import multiprocessing
+
+import twpath
+import twhops
+import twdaemon
 
 database = None
 DEFAULT_DB_NAME = 'tw2002.db'
@@ -13,13 +19,27 @@ explored = None
 
 def connect_database(filename):
     global database
-    database = sqlite3.connect(filename)
+    twpath.connect_database(filename)
+    database = twpath.database
 
+@twpath.cachedQuery
 def deadend_sectors():
     global database
+    conn = database.cursor()
+    try:
+        # in the order the full scan below would find them
+        dead_ends = [sector for (sector,) in conn.execute('''
+            SELECT sector FROM sector_degree
+            WHERE warps_out = 1 AND warps_in = 1
+            ORDER BY (SELECT min(rowid) FROM warps WHERE warps.source = sector_degree.sector)
+            ''')]
+        conn.close()
+        return dead_ends
+    except sqlite3.OperationalError:
+        # a database twparser hasn't migrated yet
+        pass
     sourcemap = {}
     destmap = {}
-    conn = database.cursor()
     for source,dest in conn.execute('SELECT source, destination FROM warps'):
         if(not source in sourcemap):
             sourcemap[source] = []
@@ -39,46 +59,22 @@ def deadend_sectors():
     return dead_ends
 
 def explored_sectors():
-    global database
-    conn = database.cursor()
-    retval = [int(s[0]) for s in conn.execute('SELECT sector FROM explored')]
-    conn.close()
-    return retval
+    return twpath.explored_sectors()
 
 def fighter_locations():
-    global database
-    conn = database.cursor()
-    query = conn.execute("SELECT sector FROM fighters")
-    retval = [int(sector[0]) for sector in query]
-    conn.close()
-    return retval
+    return twpath.fighter_locations()
+
+def bubble_sectors():
+    return [sector for gate, sectors in twpath.bubbles() for sector in sectors]
 
 def list_all_sectors():
-    global database
-    conn = database.cursor()
-    query = conn.execute("SELECT DISTINCT source FROM warps")
-    retval = [int(sector[0]) for sector in query]
-    conn.close()
-    # print("list_all_sectors", retval)
-    return retval
+    return twpath.list_all_sectors()
 
 def warps_from(sector):
-    global database
-    conn = database.cursor()
-    query = conn.execute("SELECT destination FROM warps WHERE source=?", (sector,))
-    retval = [int(warp[0]) for warp in query]
-    conn.close()
-    # print("warps_from", sector, "=", retval)
-    return retval
+    return twpath.warps_from(sector)
 
 def warps_to(sector):
-    global database
-    conn = database.cursor()
-    query = conn.execute("SELECT source FROM warps WHERE destination=?", (sector,))
-    retval = [int(warp[0]) for warp in query]
-    conn.close()
-    # print("warps_from", sector, "=", retval)
-    return retval
+    return twpath.warps_to(sector)
 
 def backtrace(parent, start, end):
     path = [end]
@@ -87,136 +83,182 @@ def backtrace(parent, start, end):
     path.reverse()
     return path
 
-class Sector:
-    sector = None
-    warps = None
-    path = None
-
-    def __init__(self, sector, path=[]):
-        self.sector = sector
-        self.warps = warps_from(sector)
-        self.path = path
-
-    def __repr__(self):
-        return "Sector({}, warps={}, path={})".format(self.sector, self.warps, self.path)
-
 MAX_WARPS = 20
 
-def path_walker(start_vertex, end_vertices, avoids=[], max_explored=DEFAULT_MAX_EXPLORED):
-    explored = explored_sectors()
-
-    if(end_vertices != None and not isinstance(end_vertices, list)):
-        end_vertices = [end_vertices]
-
-    lifo = queue.LifoQueue()
-
-    lifo.put(Sector(start_vertex))
-
+# routes scoring within this many Unexplored sectors of the best one are returned
+ROUTE_SLACK = 3
+
+# how often (in expanded sectors) a pool worker syncs its best score with the others
+SYNC_INTERVAL = 4096
+
+def sector_mask(sectors, size):
+    mask = bytearray(size)
+    for s in sectors:
+        if(0 <= s < size):
+            mask[s] = 1
+    return mask
+
+# iterative depth-first search of every simple route from start, continuing the given path.
+# explored/avoided/wanted are bytearrays indexed by sector (wanted=None means any end point will do).
+# returns [(unexplored count, route), ...] in the order the routes were found, skipping routes that
+# cannot come within ROUTE_SLACK of the best count seen so far
+def walk_routes(graph, explored, avoided, wanted, start, path, max_explored, shared_best=None):
+    offsets, targets = graph.adjacency()
+    path = list(path)
+    on_path = bytearray(len(explored))
+    path_explored = 0
+    for s in path:
+        on_path[s] = 1
+        path_explored += explored[s]
+
+    best = 0
+    if(shared_best is not None):
+        best = shared_best.value
     results = []
-    maxCnt = 0
-    deCnt = 0
-    maxExplored = 0
-    while(not lifo.empty()):
-        # if((maxExplored + maxCnt + deCnt) % 10000 == 0):
-        #     print(lifo.qsize(), maxExplored, maxCnt, deCnt)
-
-        sector = lifo.get()
-        if(sector.sector in avoids):
+    stack = [(start, len(path))]
+    visits = 0
+    while(stack):
+        sector, depth = stack.pop()
+        while(len(path) > depth):
+            s = path.pop()
+            on_path[s] = 0
+            path_explored -= explored[s]
+
+        if(avoided[sector]):
             continue
-        if(explored_cnt(sector.path) > max_explored):
-            maxExplored += 1
+        if(path_explored > max_explored):
             continue
-        if(len(sector.path) > MAX_WARPS):
-            maxCnt += 1
-            if(end_vertices == None or sector.sector in end_vertices):
-                results.append((unexplored_cnt(sector.path + [sector.sector]), "max", sector))
+        unexplored = depth - path_explored + 1 - explored[sector]
+        # even if every remaining hop hit an Unexplored sector, this branch can't make the cut
+        if(unexplored + MAX_WARPS + 1 - depth <= best - ROUTE_SLACK):
             continue
+
+        visits += 1
+        if(shared_best is not None and visits % SYNC_INTERVAL == 0 and shared_best.value > best):
+            best = shared_best.value
+
         newPaths = False
-        for warp in sector.warps:
-            if(not warp in sector.path):
-                lifo.put(Sector(warp, path=sector.path + [sector.sector]))
-                newPaths = True
-        if(not newPaths):
-            # print(sector)
-            if(end_vertices == None or sector.sector in end_vertices):
-                results.append((unexplored_cnt(sector.path + [sector.sector]), "de", sector))
-            deCnt += 1
-
-    # print(maxExplored, maxCnt, deCnt)
-    # for x in range(10):
-    #    print(results[int(x*len(results)/10)])
+        if(depth <= MAX_WARPS and sector < graph.size):
+            for i in range(offsets[sector], offsets[sector + 1]):
+                warp = targets[i]
+                if(not on_path[warp]):
+                    stack.append((warp, depth + 1))
+                    newPaths = True
+        if(newPaths):
+            path.append(sector)
+            on_path[sector] = 1
+            path_explored += explored[sector]
+        elif(wanted is None or wanted[sector]):
+            # either a dead end, or we've hit the maximum route length
+            if(unexplored > best - ROUTE_SLACK):
+                results.append((unexplored, path + [sector]))
+                if(unexplored > best):
+                    best = unexplored
+                    if(shared_best is not None):
+                        with shared_best.get_lock():
+                            if(shared_best.value < best):
+                                shared_best.value = best
+    return results
+
+worker_args = None
+
+def walk_routes_init(*args):
+    global worker_args
+    worker_args = args
+
+def walk_routes_worker(task):
+    graph, explored, avoided, wanted, max_explored, shared_best = worker_args
+    start, path = task
+    return walk_routes(graph, explored, avoided, wanted, start, path, max_explored, shared_best)
+
+def path_walker(start_vertex, end_vertices, avoids=[], max_explored=DEFAULT_MAX_EXPLORED, processes=1):
+    if(end_vertices != None and not isinstance(end_vertices, list)):
+        end_vertices = [end_vertices]
+
+    graph = twpath.load_graph()
+    size = max(graph.size, start_vertex + 1)
+    explored = sector_mask(explored_sectors(), size)
+    avoided = sector_mask(avoids, size)
+    wanted = None
+    if(end_vertices != None):
+        wanted = sector_mask(end_vertices, size)
+
+    first_hops = []
+    if(processes > 1 and not avoided[start_vertex]):
+        first_hops = [warp for warp in graph.warps_from(start_vertex) if warp != start_vertex]
+
+    if(len(first_hops) > 1):
+        # fan the first-level branches out across a process pool, in the same order the serial search takes them
+        shared_best = multiprocessing.Value('i', 0)
+        tasks = [(warp, [start_vertex]) for warp in reversed(first_hops)]
+        with multiprocessing.Pool(processes, initializer=walk_routes_init, initargs=(graph, explored, avoided, wanted, max_explored, shared_best)) as pool:
+            results = []
+            for r in pool.map(walk_routes_worker, tasks, chunksize=1):
+                results += r
+    else:
+        results = walk_routes(graph, explored, avoided, wanted, start_vertex, [], max_explored)
+
     maxUnexplored = 0
     for r in results:
         if(r[0] > maxUnexplored):
             maxUnexplored = r[0]
 
-    # print(maxUnexplored)
-
     retval = []
-    for result in sorted(list(results), key=lambda r: r[0]):
-    # for r in sorted(list(results), key=lambda r: results[r][1]):
-        if(result[0] > (maxUnexplored-3)):
-            # print(result)
-            sector = result[2]
-            retval.append(sector.path + [sector.sector])
+    for result in sorted(results, key=lambda r: r[0]):
+        if(result[0] > (maxUnexplored - ROUTE_SLACK)):
+            retval.append(result[1])
     return retval
 
 
 
 # inspired by http://pythonfiddle.com/dijkstra/
-# modified to use a weighted algorithm
+# modified to use a weighted algorithm: entering an explored sector costs 100, an unexplored one costs 0.
+# ties are broken on the lowest sector number, so the routes match the original O(V^2) selection loop
 def weighted_dijkstra(start_vertex, end_vertices, avoids=[], max_explored=None):
-    
-    explored = explored_sectors()
-
-    list_all = list_all_sectors()
+    graph = twpath.load_graph()
+    offsets, targets = graph.adjacency()
 
     if(end_vertices == None):
-        end_vertices = list_all
+        end_vertices = graph.sectors()
 
     if(not isinstance(end_vertices, list)):
         end_vertices = [end_vertices]
-    distance = {}
-    visited = {}
-    parent = {}
-    shortest_distance = {}
-    weight = {}
-
-    retVal = []
 
-    for node in list_all:
-        visited[node] = False
-        parent[node] = None
-        shortest_distance[node] = float('inf')
-        weight[node] = 0
-        if(node in explored):
+    size = max(graph.size, start_vertex + 1)
+    weight = bytearray(size)
+    for node in explored_sectors():
+        if(node < size):
             weight[node] = 100
+    # avoided sectors can still be reached, but are never expanded
+    visited = bytearray(size)
+    for node in avoids:
+        if(0 <= node < size):
+            visited[node] = 1
 
-        if(node in avoids):
-            visited[node] = True
+    shortest_distance = [float('inf')] * size
+    parent = {}
+    retVal = []
 
     shortest_distance[start_vertex] = 0
-    current = None
-    while(True):
-        choices = {s:shortest_distance[s] for s in shortest_distance if visited[s] == False and shortest_distance[s] < float('inf')}
-        # print(choices)
-        choices = sorted(choices.keys(), key=lambda s: choices[s])
-        # print(choices)
-        if(len(choices)==0):
-            break
-        current = choices[0]
-        # print('')
-        # print("current", current)
-        visited[current] = True
-        warp_list = warps_from(current)
-        for neighbor in warp_list:
-            # print("neighbor", neighbor)
-            prospective_distance = shortest_distance[current] + weight[neighbor]
+    heap = [(0, start_vertex)]
+    while(heap):
+        distance, current = heapq.heappop(heap)
+        if(visited[current] or distance > shortest_distance[current]):
+            continue
+        visited[current] = 1
+        if(current >= graph.size):
+            continue
+        for i in range(offsets[current], offsets[current + 1]):
+            neighbor = targets[i]
+            prospective_distance = distance + weight[neighbor]
             if(prospective_distance < shortest_distance[neighbor]):
                 shortest_distance[neighbor] = prospective_distance
                 parent[neighbor] = current
+                if(not visited[neighbor]):
+                    heapq.heappush(heap, (prospective_distance, neighbor))
     for v in end_vertices:
-        retVal.append(backtrace(parent, start_vertex, v))
+        if(v == start_vertex or v in parent):
+            retVal.append(backtrace(parent, start_vertex, v))
     return retVal
 
 def sector_representation(sector):
@@ -248,18 +290,25 @@ def unexplored_cnt(route):
     return cnt
 
 
-if(__name__ == '__main__'):
+def run(argv=None):
+    global explored
+
     parser = argparse.ArgumentParser(description='Tool that will attempt to plan an Ether Probe path to an Unexplored dead end that will hit as many Unexplored sectors as possible en route.')
     parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
     parser.add_argument('--thorough', '-t', type=int, default=-1, nargs='?', help='Switch to a more thorough algorithm.  Will likely generate longer paths and find more Unexplored sectors along the route, but is MUCH SLOWER to run.  Add a max number of explored sectors before a route is discarded; default {}.  Higher numbers could generate better paths, but increase the time needed to run the algorithm exponentially!'.format(DEFAULT_MAX_EXPLORED))
+    parser.add_argument('--processes', '-j', type=int, default=1, help='Number of worker processes to spread the --thorough search across; default 1')
     parser.add_argument('--top', type=int, default=1, help='Show the top <X> probe destination/routes; default 1')
     parser.add_argument('--all', '-a', action='store_true', help='Treat every sector as a destination, not just Unexplored dead ends')
+    parser.add_argument('--bubbles', '-b', action='store_true', help='Also aim for the Unexplored sectors inside bubbles (pockets of sectors behind a single gate; see twgraph.py), not just Unexplored dead ends')
     parser.add_argument('--avoid', '-v', type=int, nargs='+', default=[], help='Sectors to avoid when plotting probe routes')
     parser.add_argument('--fighters', '-f', action='store_true', help='Set the start_sector list to all sectors that currently have one of your deployed fighters')
     parser.add_argument('--no-trim', '-n', action='store_true', help='Do not trim routes greater than 20 hops')
     parser.add_argument('start_sector', type=int, nargs='*', help='The sector to use as the Ether Probe launching site')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+
+    if(twdaemon.forward(args.db, 'smartProbe', argv)):
+        return
 
     max_route_len = 21
     if(args.no_trim):
@@ -269,7 +318,7 @@ if(__name__ == '__main__'):
     if(args.thorough is None):
         args.thorough = DEFAULT_MAX_EXPLORED
     if(args.thorough > 0):
-        mapping_algo = path_walker
+        mapping_algo = functools.partial(path_walker, processes=args.processes)
 
     connect_database(args.db)
 
@@ -282,6 +331,8 @@ if(__name__ == '__main__'):
     if(not args.all):
         # start with a list of dead ends
         candidates = { sector:None for sector in deadend_sectors() }
+        if(args.bubbles):
+            candidates.update((sector, None) for sector in bubble_sectors())
         # trim the ones we've already explored
         for sector in list(candidates):
             if(sector in explored):
@@ -290,11 +341,19 @@ if(__name__ == '__main__'):
 
     if(len(args.start_sector) == 0):
         print("No start sectors specified, exiting.")
-        quit()
+        return
+
+    # with a hop matrix, skip destinations that are too far away for any route to survive the trim
+    hops = None
+    if(candidates != None and not args.no_trim):
+        hops = twhops.load(args.db)
 
     routes = []
     for source in args.start_sector:
-        routes += mapping_algo(source, candidates, avoids=args.avoid, max_explored=args.thorough)
+        source_candidates = candidates
+        if(hops):
+            source_candidates = [c for c in candidates if hops.distance(source, c) < max_route_len]
+        routes += mapping_algo(source, source_candidates, avoids=args.avoid, max_explored=args.thorough)
     # print(routes)
 
     buckets = {}
@@ -347,3 +406,5 @@ if(__name__ == '__main__'):
         print('')
 
 
+if(__name__ == '__main__'):
+    run()
@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+
+import sqlite3
+import argparse
+import random
+import time
+import contextlib
+import tempfile
+import subprocess
+import platform
+import json
+import io
+import sys
+import os
+
+import twparser
+import twpath
+import twgen
+import portPairs
+import portCircuits
+import smartProbe
+import twgraph
+
+DEFAULT_DB_NAME = 'tw2002.db'
+
+# a few lines of the colourful chatter that surrounds the reports we care about in a real session
+ANSI_CHATTER = (
+    b'\x1b[35mCommand [\x1b[1;33mTL\x1b[0;35m=\x1b[1;33m00:00:00\x1b[0;35m]\x1b[1;37m:\x1b[0;35m[\x1b[1;36m{sector}\x1b[0;35m] (\x1b[1;33m?=Help\x1b[0;35m)? : \x1b[0m',
+    b'\x1b[1;32mSector  \x1b[1;33m: \x1b[36m{sector} \x1b[0;32min \x1b[34muncharted space.\x1b[0m',
+    b'\x1b[0;35mPorts   \x1b[1;33m: \x1b[36mSomewhere Station\x1b[0;33m, \x1b[1;33mClass \x1b[36m3 \x1b[0;35m(\x1b[1;32mS\x1b[36mB\x1b[32mB\x1b[0;35m)\x1b[0m',
+    b'\x1b[1;32mWarps to Sector(s) \x1b[1;33m:  \x1b[36m{warps}\x1b[0m',
+    b'\x1b[0;32m<Auto Pilot Engaged>\x1b[0m',
+    b'',
+)
+
+def warp_lists(database):
+    warps = {}
+    for source, destination in database.execute('SELECT source, destination FROM warps WHERE source IN (SELECT sector FROM explored) ORDER BY source, destination'):
+        warps.setdefault(source, []).append(destination)
+    return warps
+
+# write a synthetic game log built from a database: CIM warp and port reports, a fighter scan, C-I and C-F output and
+# plenty of ANSI-coloured sector displays, repeated as many times as asked
+def make_transcript(database, out, repeat=1, seed=0):
+    rng = random.Random(seed)
+    warps = warp_lists(database)
+    ports = database.execute('SELECT sector, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct FROM ports ORDER BY sector').fetchall()
+    fighters = [row[0] for row in database.execute('SELECT sector FROM fighters ORDER BY sector')]
+    sectors = sorted(warps)
+    lines = 0
+
+    def line(text):
+        nonlocal lines
+        out.write(text + b'\r\n')
+        lines += 1
+
+    for r in range(repeat):
+        line(b': ')
+        for sector, destinations in warps.items():
+            line(('{:4}'.format(sector) + ''.join(' {:4}'.format(w) for w in destinations)).encode('ascii'))
+        line(b': ENDINTERROG')
+
+        for sector, port_class, *amounts in ports:
+            flags = ['-' if c == 'B' else ' ' for c in port_class]
+            line('{:4} {} {:4} {:3}% {} {:4} {:3}% {} {:4} {:3}%'.format(sector, flags[0], amounts[0], amounts[1], flags[1], amounts[2], amounts[3], flags[2], amounts[4], amounts[5]).encode('ascii'))
+
+        line(b'')
+        line(b'                 Deployed  Fighter  Scan')
+        line(b'')
+        line(b' Sector    Fighters    Personal/Corp    Mode    Toll')
+        line(b' ===================================================')
+        for sector in fighters:
+            line(' {:5}         1       Personal      Defensive  N/A'.format(sector).encode('ascii'))
+
+        for i in range(len(sectors)):
+            sector = rng.choice(sectors)
+            destinations = warps[sector]
+            for chatter in ANSI_CHATTER:
+                line(chatter.replace(b'{sector}', str(sector).encode('ascii')).replace(b'{warps}', ' - '.join(str(w) for w in destinations).encode('ascii')))
+            if(i % 10 == 0):
+                line('Sector {} has warps to sector(s) : {}'.format(sector, ' - '.join(str(w) for w in destinations)).encode('ascii'))
+            if(i % 25 == 0):
+                destination = rng.choice(destinations)
+                line(b'')
+                line('The shortest path (1 hops, 3 turns) from sector {} to sector {} is: {} > {}'.format(sector, destination, sector, destination).encode('ascii'))
+                line(b'')
+                line('FM > {}'.format(sector).encode('ascii'))
+                line('  TO > {} ({}) > {}'.format(destination, sector, destination).encode('ascii'))
+                line(b'')
+    return lines
+
+# a stand-in for the database writer's queue that just counts the writes the parser hands it
+class CountingQueue:
+    def __init__(self):
+        self.count = 0
+
+    def put(self, item, block=True, timeout=None):
+        self.count += 1
+
+# lines per second through parse_complete_line, with the database writes counted rather than performed
+def bench_classifier(lines, repeat=3):
+    saved = twparser.dbqueue
+    best = None
+    writes = 0
+    try:
+        for r in range(repeat):
+            twparser.dbqueue = CountingQueue()
+            twparser.routeList = None
+            start = time.perf_counter()
+            for line in lines:
+                twparser.parse_complete_line(line)
+            elapsed = time.perf_counter() - start
+            writes = twparser.dbqueue.count
+            if(best is None or elapsed < best):
+                best = elapsed
+    finally:
+        twparser.dbqueue = saved
+    return best, writes
+
+# a synthetic stream of game output: CIM style reports with CR-LF line endings, the odd long unfinished line, cut
+# into reads of random sizes the way they'd arrive from the network
+def make_stream(size, seed=0):
+    rng = random.Random(seed)
+    data = bytearray()
+    while(len(data) < size):
+        if(rng.random() < 0.01):
+            data += b'\x1b[35mPress [ENTER] to continue ' + b'.' * rng.randint(1000, 20000)
+        for i in range(rng.randint(1, 200)):
+            data += ('{:4}'.format(rng.randint(1, 9999)) + ''.join(' {:4}'.format(rng.randint(1, 9999)) for w in range(rng.randint(1, 6))) + '\r\n').encode('ascii')
+    data = bytes(data[:size])
+    chunks = []
+    pos = 0
+    while(pos < size):
+        n = rng.randint(1, 4096)
+        chunks.append(data[pos:pos + n])
+        pos += n
+    return chunks
+
+# the way twclient used to assemble lines: append each read to the unfinished line and split the lot again
+def split_lines_naive(chunks):
+    count = 0
+    currentData = b''
+    for newData in chunks:
+        newData = newData.replace(b'\r', b'')
+        currentData += newData
+        arr = currentData.splitlines(keepends=True)
+        for line in arr:
+            if(line[-1] == 0x0a):
+                count += 1
+        if(len(arr) and arr[-1][-1] != 0x0a):
+            currentData = arr[-1]
+        else:
+            currentData = b''
+    return count
+
+def split_lines_framer(chunks):
+    count = 0
+    framer = twparser.LineFramer()
+    for newData in chunks:
+        count += len(framer.feed(newData))
+    return count
+
+def bench_framer(chunks, repeat=3):
+    results = {}
+    for name, func in (('splitlines', split_lines_naive), ('LineFramer', split_lines_framer)):
+        best = None
+        for r in range(repeat):
+            start = time.perf_counter()
+            lines = func(chunks)
+            elapsed = time.perf_counter() - start
+            if(best is None or elapsed < best):
+                best = elapsed
+        results[name] = (lines, best)
+    return results
+
+# the best of repeat runs of func, in seconds.  the tools' caches are emptied before each run, so every run pays for
+# loading the map the way a fresh command line run would
+def best_time(func, repeat):
+    best = None
+    for r in range(repeat):
+        twpath.invalidate()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+        if(best is None or elapsed < best):
+            best = elapsed
+    return best
+
+def git_commit():
+    try:
+        result = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    except OSError:
+        # git isn't installed
+        return None
+    if(result.returncode != 0):
+        return None
+    return result.stdout.strip()
+
+DIJKSTRA_ROUTES = 200
+
+# time each tool on a generated universe of the given size: twpath.dijkstra between random sectors, portPairs and
+# portCircuits at separations 1 to 3, both smartProbe searches from sector 1 to the Unexplored dead ends, twgraph's
+# bubble analysis, and twparser ingesting a transcript of the universe's CIM reports
+def bench_universe(workdir, sectors, seed=0, repeat=1):
+    dbname = os.path.join(workdir, 'universe-{}.db'.format(sectors))
+    if(not os.path.exists(dbname)):
+        twgen.generate(dbname, sectors, seed=seed)
+    twpath.connect_database(dbname)
+    smartProbe.connect_database(dbname)
+    results = {}
+
+    rng = random.Random(seed)
+    pairs = [(rng.randint(1, sectors), rng.randint(1, sectors)) for i in range(DIJKSTRA_ROUTES)]
+    def routes():
+        for start, end in pairs:
+            twpath.dijkstra(start, end)
+    seconds = best_time(routes, repeat)
+    results['twpath.dijkstra'] = {'seconds': seconds, 'routes': len(pairs), 'per_route': seconds / len(pairs)}
+
+    for separation in (1, 2, 3):
+        seconds = best_time(lambda: portPairs.main(dbname, '?BS', '?SB', separation=separation), repeat)
+        results['portPairs.main separation={}'.format(separation)] = {'seconds': seconds}
+
+    ports = {row[0]: row for row in twpath.port_list()}
+    for separation in (1, 2, 3):
+        seconds = best_time(lambda: portCircuits.find_circuits(ports, separation=separation), repeat)
+        results['portCircuits separation={}'.format(separation)] = {'seconds': seconds}
+
+    explored = twpath.explored_sectors()
+    candidates = [sector for sector in smartProbe.deadend_sectors() if sector not in explored]
+    for name, algorithm in (('weighted_dijkstra', smartProbe.weighted_dijkstra), ('path_walker', smartProbe.path_walker)):
+        seconds = best_time(lambda: algorithm(1, candidates, max_explored=smartProbe.DEFAULT_MAX_EXPLORED), repeat)
+        results['smartProbe.{}'.format(name)] = {'seconds': seconds, 'destinations': len(candidates)}
+
+    graph = twpath.load_graph()
+    seconds = best_time(lambda: twgraph.analyse(graph, explored=explored), repeat)
+    results['twgraph.analyse'] = {'seconds': seconds}
+
+    logname = os.path.join(workdir, 'universe-{}.log'.format(sectors))
+    database = sqlite3.connect(dbname)
+    with open(logname, 'wb') as out:
+        lines = make_transcript(database, out, seed=seed)
+    database.close()
+    size = os.path.getsize(logname)
+    def ingest():
+        target = os.path.join(workdir, 'ingest.db')
+        for suffix in ('', '-wal', '-shm'):
+            if(os.path.exists(target + suffix)):
+                os.remove(target + suffix)
+        twparser.bulk_ingest(target, [logname], processes=1)
+    seconds = best_time(ingest, repeat)
+    results['twparser ingest'] = {'seconds': seconds, 'lines': lines, 'bytes': size, 'lines_per_second': lines / seconds}
+    return results
+
+def run_suite(sizes, seed=0, repeat=1, workdir=None):
+    report = {
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'seed': seed,
+        'repeat': repeat,
+        'sizes': {},
+        }
+    with contextlib.ExitStack() as stack:
+        if(workdir is None):
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix='twbench-'))
+        os.makedirs(workdir, exist_ok=True)
+        for sectors in sizes:
+            report['sizes'][str(sectors)] = bench_universe(workdir, sectors, seed=seed, repeat=repeat)
+            for name, result in report['sizes'][str(sectors)].items():
+                print('{:6} sectors  {:36} {:9.3f}s'.format(sectors, name, result['seconds']), flush=True)
+    return report
+
+# how each timing in new compares with the same one in old, as (size, name, old seconds, new seconds)
+def compare_reports(old, new):
+    rows = []
+    for size, results in new['sizes'].items():
+        for name, result in results.items():
+            before = old['sizes'].get(size, {}).get(name)
+            rows.append((size, name, before['seconds'] if before else None, result['seconds']))
+    return rows
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Benchmarks for the parser and analysis tools.')
+    subparsers = parser.add_subparsers(dest='command')
+
+    p = subparsers.add_parser('transcript', help='Write a synthetic game log built from a database, for the other benchmarks to use')
+    p.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
+    p.add_argument('--repeat', '-r', type=int, default=1, help='Number of times to repeat the reports; default 1')
+    p.add_argument('--seed', type=int, default=0, help='Random seed for the sector displays; default 0')
+    p.add_argument('output', type=argparse.FileType('wb'), help='Log file to write')
+
+    p = subparsers.add_parser('classifier', help='Measure how many log lines per second twparser can classify')
+    p.add_argument('--repeat', '-r', type=int, default=3, help='Number of timed runs; the best is reported; default 3')
+    p.add_argument('filename', type=argparse.FileType('rb'), help='Game log to classify, e.g. one written by "transcript"')
+
+    p = subparsers.add_parser('framer', help='Measure how fast a stream of game output can be split into lines')
+    p.add_argument('--size', type=int, default=10 * 1024 * 1024, help='Size of the synthetic stream in bytes; default 10MB')
+    p.add_argument('--repeat', '-r', type=int, default=3, help='Number of timed runs; the best is reported; default 3')
+
+    p = subparsers.add_parser('suite', help='Time the tools on generated universes of several sizes and save the results as JSON')
+    p.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000], help='Universe sizes in sectors; default 1000 5000 20000')
+    p.add_argument('--seed', type=int, default=0, help='Random seed for the universes; default 0')
+    p.add_argument('--repeat', '-r', type=int, default=1, help='Number of timed runs; the best is reported; default 1')
+    p.add_argument('--workdir', help='Directory to keep the generated universes in (and reuse them from); default a temporary directory')
+    p.add_argument('--output', '-o', help='JSON file to save the results to')
+
+    p = subparsers.add_parser('compare', help='Compare two sets of results saved by "suite"')
+    p.add_argument('--threshold', type=float, default=10, help='Percentage slowdown to flag as a regression; default 10')
+    p.add_argument('old', type=argparse.FileType('r'), help='Results from before the change')
+    p.add_argument('new', type=argparse.FileType('r'), help='Results from after the change')
+
+    args = parser.parse_args()
+
+    # add_subparsers(required=True) needs Python 3.7
+    if(args.command is None):
+        parser.error('choose a benchmark to run')
+
+    if(args.command == 'transcript'):
+        database = sqlite3.connect(args.db)
+        lines = make_transcript(database, args.output, repeat=args.repeat, seed=args.seed)
+        database.close()
+        args.output.close()
+        print('{}: {} lines'.format(args.output.name, lines))
+
+    elif(args.command == 'classifier'):
+        lines = args.filename.readlines()
+        elapsed, writes = bench_classifier(lines, repeat=args.repeat)
+        print('{} lines, {} writes queued in {:.3f}s: {:.0f} lines/s'.format(len(lines), writes, elapsed, len(lines) / elapsed))
+
+    elif(args.command == 'framer'):
+        chunks = make_stream(args.size)
+        for name, (lines, elapsed) in bench_framer(chunks, repeat=args.repeat).items():
+            print('{}: {} bytes in {} reads, {} lines in {:.3f}s: {:.1f} MB/s'.format(name, args.size, len(chunks), lines, elapsed, args.size / elapsed / 1e6))
+
+    elif(args.command == 'suite'):
+        report = run_suite(args.sizes, seed=args.seed, repeat=args.repeat, workdir=args.workdir)
+        if(args.output):
+            with open(args.output, 'w') as out:
+                json.dump(report, out, indent=2)
+            print('Results saved to {}'.format(args.output))
+
+    elif(args.command == 'compare'):
+        old = json.load(args.old)
+        new = json.load(args.new)
+        print('{} -> {}'.format(old.get('commit'), new.get('commit')))
+        regressions = 0
+        for size, name, before, after in compare_reports(old, new):
+            if(before is None):
+                print('{:>6} sectors  {:36} {:>9}  {:9.3f}s'.format(size, name, '-', after))
+                continue
+            change = (after - before) / before * 100
+            flag = ''
+            if(change > args.threshold):
+                flag = '  <-- slower'
+                regressions += 1
+            print('{:>6} sectors  {:36} {:9.3f}s {:9.3f}s {:+7.1f}%{}'.format(size, name, before, after, change, flag))
+        if(regressions):
+            sys.exit(1)
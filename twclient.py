@@ -1,19 +1,25 @@
 #!/usr/bin/python3
 
-import telnetlib
 import sys
+import selectors
 import select
 import termios
 import tty
 import fcntl
 import os
 import socket
+import sqlite3
 import argparse
 import time
 import threading
+import queue
+from collections import deque
 from contextlib import contextmanager
 
 import twparser
+import twpath
+import twscript
+import twsession
 
 settings = None
 
@@ -39,6 +45,90 @@ def nonblocking(stream):
     finally:
         fcntl.fcntl(stream.fileno(), fcntl.F_SETFL, orig)
 
+# stdout usually shares its file description with stdin, which is non-blocking during the session, so when the
+# terminal falls behind a burst of output a write fails instead of waiting
+def write_terminal(data):
+    view = memoryview(data)
+    while(len(view)):
+        try:
+            written = os.write(1, view)
+        except BlockingIOError:
+            select.select([], [1], [])
+            continue
+        view = view[written:]
+
+# telnet protocol bytes (RFC 854)
+IAC  = 255 # interpret as command
+DONT = 254
+DO   = 253
+WONT = 252
+WILL = 251
+SB   = 250 # subnegotiation begin
+SE   = 240 # subnegotiation end
+
+# a minimal telnet client connection: reads return the game's data with the telnet commands taken out, and every
+# option the server asks about is refused, which is all the game needs
+class TelnetConnection:
+    sock = None
+    state = None # None, or the partial IAC sequence we're in the middle of
+    subnegotiation = False
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def write(self, data):
+        with self.write_lock:
+            self.sock.sendall(data.replace(bytes([IAC]), bytes([IAC, IAC])))
+
+    # read whatever has arrived; only call this when the socket is readable.  raises EOFError when the server hangs up
+    def read_available(self):
+        raw = self.sock.recv(65536)
+        if(not raw):
+            raise EOFError
+        if(self.state is None and not self.subnegotiation and IAC not in raw):
+            return raw.replace(b'\0', b'').replace(b'\021', b'')
+        return self.process(raw)
+
+    def process(self, raw):
+        data = bytearray()
+        replies = bytearray()
+        for c in raw:
+            if(self.state is None):
+                if(c == IAC):
+                    self.state = bytes([c])
+                elif(not self.subnegotiation and c != 0 and c != 0o21): # NUL and XON are padding
+                    data.append(c)
+            elif(len(self.state) == 1):
+                if(c in (DO, DONT, WILL, WONT)):
+                    self.state += bytes([c])
+                    continue
+                self.state = None
+                if(c == IAC):
+                    if(not self.subnegotiation):
+                        data.append(c)
+                elif(c == SB):
+                    self.subnegotiation = True
+                elif(c == SE):
+                    self.subnegotiation = False
+            else:
+                command = self.state[1]
+                self.state = None
+                if(command in (DO, DONT)):
+                    replies += bytes([IAC, WONT, c])
+                else:
+                    replies += bytes([IAC, DONT, c])
+        if(replies):
+            with self.write_lock:
+                self.sock.sendall(replies)
+        return bytes(data)
 
 def connect(host, port):
 
@@ -50,7 +140,7 @@ def connect(host, port):
 
     print('Trying {}...'.format(ip))
     try:
-        tn = telnetlib.Telnet(host, port)
+        tn = TelnetConnection(host, port)
     except:
         print("telnet: Unable to connect to remote host: Connection timed out", file=sys.stderr)
         return None
@@ -58,136 +148,393 @@ def connect(host, port):
 
     return tn
 
-def interactive_session(tn):
+# running statistics for a series of timings, e.g. the time from data arriving on the socket to it reaching the screen
+class LatencyStats:
+    SAMPLES = 10000
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.samples = deque(maxlen=self.SAMPLES)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.worst = max(self.worst, seconds)
+        self.samples.append(seconds)
+
+    def percentile(self, p):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def __str__(self):
+        if(self.count == 0):
+            return '{}: no samples'.format(self.name)
+        return '{}: {} samples, mean {:.3f}ms, median {:.3f}ms, 99th percentile {:.3f}ms, max {:.3f}ms'.format(
+                self.name, self.count, self.total / self.count * 1000, self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, self.worst * 1000)
+
+display_latency = LatencyStats('socket to screen')
+
+# how long trades spend haggling: the round trip from each offer being entered to the port's reply (the first thing the
+# game sends after echoing the offer), and the time from the first "Your offer" prompt of each trade to the reply to its
+# last offer.  auto-haggle only types the offer, so it isn't sent until the user presses enter
+class HaggleStats:
+    def __init__(self):
+        self.round_trip = LatencyStats('offer round trip')
+        self.trades = 0
+        self.seconds = 0.0
+        self.trade_start = None
+        self.trade_end = None
+        self.typed = False
+        self.sent = None
+
+    def offered(self, new_trade, prompt_time):
+        if(new_trade):
+            self.finish_trade()
+            self.trades += 1
+            self.trade_start = prompt_time
+        self.typed = True
+        self.sent = None
+
+    def entered(self, now):
+        if(self.typed):
+            self.typed = False
+            self.sent = now
+
+    def reply(self, now):
+        if(self.sent is None or now < self.sent):
+            return
+        self.round_trip.add(now - self.sent)
+        self.sent = None
+        self.trade_end = now
+
+    def finish_trade(self):
+        if(self.trade_start is not None and self.trade_end is not None):
+            self.seconds += self.trade_end - self.trade_start
+        self.trade_start = None
+        self.trade_end = None
+
+    def total_seconds(self):
+        if(self.trade_start is not None and self.trade_end is not None):
+            return self.seconds + self.trade_end - self.trade_start
+        return self.seconds
+
+    def __str__(self):
+        return 'haggling: {} trades, {:.3f}s total\n{}'.format(self.trades, self.total_seconds(), self.round_trip)
+
+haggle_stats = HaggleStats()
+
+# chunks of game data waiting for the parser thread; if it falls this far behind, the session waits for it to catch up
+PARSE_QUEUE_CHUNKS = 1000
+
+# log (at verbose level 1) when data waits longer than this to be parsed
+PARSE_LAG_WARNING = 0.1
+
+parse_lag = LatencyStats('parse lag')
+
+# the parser thread: frames the game data into lines and parses them off the terminal I/O loop.  chunks arrive as
+# (time received, data), with None to stop.  answers to prompts go back to the I/O loop through the responses queue,
+# as (answer, is an offer, starts a new trade, time received), with a byte written to wakeup to get its attention.
+# an answer of None instead reports that the port has replied to the last offer, with the time the reply arrived
+def parser_worker(chunks, responses, wakeup, recorder=None):
+    framer = twparser.LineFramer()
+    partialAnswered = False
+    # the "Your offer" prompt we last answered, until the port's reply to the offer arrives
+    offerPrompt = None
+
+    # anything other than the prompt line, which the game completes with its echo of our offer, is the port's reply
+    def is_reply(line, partial=False):
+        text = twparser.strip_ansi(line).strip()
+        return len(text) > 0 and not text.startswith(offerPrompt) and not (partial and offerPrompt.startswith(text))
+    while(True):
+        item = chunks.get()
+        if(item is None):
+            break
+        ready, newData = item
+        # recording here rather than as the data arrives keeps the disk off the I/O loop
+        if(recorder):
+            recorder.write(ready, newData)
+        lines = framer.feed(newData)
+        if(twparser.verbose == 4):
+            print(("lines", lines))
+        for line in lines:
+            if(offerPrompt is not None and is_reply(line)):
+                offerPrompt = None
+                responses.put((None, False, False, ready))
+                os.write(wakeup, b'.')
+            twparser.parse_complete_line(line)
+        if(offerPrompt is not None and len(framer) and is_reply(framer.partial(), partial=True)):
+            offerPrompt = None
+            responses.put((None, False, False, ready))
+            os.write(wakeup, b'.')
+        if(len(lines)):
+            partialAnswered = False
+
+        # check the unfinished line for a prompt as soon as it arrives, answering each prompt only once
+        if(len(framer) and not partialAnswered):
+            offers = twparser.port_status.offers
+            trades = twparser.port_status.trades
+            suggestion = twparser.parse_partial_line(framer.partial())
+            if(suggestion):
+                partialAnswered = True
+                is_offer = twparser.port_status.offers != offers
+                if(is_offer):
+                    offerPrompt = twparser.strip_ansi(framer.partial()).strip()
+                responses.put((suggestion, is_offer, twparser.port_status.trades != trades, ready))
+                os.write(wakeup, b'.')
+
+        lag = time.perf_counter() - ready
+        parse_lag.add(lag)
+        if(twparser.verbose >= 3 or (lag > PARSE_LAG_WARNING and twparser.verbose >= 1)):
+            twparser.log(1, "parser_worker: {} bytes parsed {:.1f}ms after arriving, {} chunks queued".format(len(newData), lag * 1000, chunks.qsize()))
+
+def interactive_session(tn, recorder=None):
     global settings
-    currentData = b''
+    commandPending = False
+
+    chunks = queue.Queue(PARSE_QUEUE_CHUNKS)
+    responses = queue.Queue()
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_r, False)
+    parser = threading.Thread(target=parser_worker, args=(chunks, responses, wakeup_w, recorder))
+    parser.start()
+
+    sel = selectors.DefaultSelector()
+    sel.register(tn, selectors.EVENT_READ, 'game')
+    sel.register(sys.stdin, selectors.EVENT_READ, 'user')
+    sel.register(wakeup_r, selectors.EVENT_READ, 'parser')
+
+    try:
+        with cbreak(sys.stdin):
+            with nonblocking(sys.stdin):
+                while(True):
+                    # sleep until the game, the user or the parser has something for us
+                    events = sel.select()
+
+                    for key, mask in events:
+                        if(key.data == 'game'):
+                            ready = time.perf_counter()
+                            try:
+                                newData = tn.read_available()
+                            except (EOFError, ConnectionError):
+                                print("Connection closed by foreign host.")
+                                return
+                            if(len(newData) == 0):
+                                continue
+                            if(twparser.verbose == 4):
+                                print(("newData1", newData))
+                            if(not settings['mute']):
+                                write_terminal(newData)
+                                display_latency.add(time.perf_counter() - ready)
+                            chunks.put((ready, newData))
+
+                        elif(key.data == 'parser'):
+                            try:
+                                os.read(wakeup_r, 4096)
+                            except BlockingIOError:
+                                pass
+                            while(not responses.empty()):
+                                suggestion, is_offer, new_trade, ready = responses.get()
+                                if(suggestion is None):
+                                    haggle_stats.reply(ready)
+                                elif(settings['auto_haggle']):
+                                    # print("SUGGESTION:", suggestion)
+                                    tn.write(suggestion)
+                                    if(is_offer):
+                                        haggle_stats.offered(new_trade, ready)
+
+                        else:
+                            # in non-blocking mode, read() will return None if no more data is available
+                            # we need non-blocking mode because select() doesn't tell us how much data is available;
+                            # even if more than one input character is in the buffer, select() won't fire again until new input is received
+                            userData = sys.stdin.buffer.read(1)
+                            while(userData):
+                                if(commandPending):
+                                    commandPending = False
+                                    user_command(tn, userData)
+                                elif(userData == b'\x14'): # secret escape char
+                                    commandPending = True
+                                else:
+                                    # translates backspace character into the one expected by tw2002
+                                    if(userData == b'\x7f'): # Backspace
+                                        userData = b'\x08' # ctrl-H
+                                    # translate newline into CR-LF, as expected by telnet protocol
+                                    if(userData == b'\n'):
+                                        userData = b'\r\n'
+                                    if(userData in (b'\r', b'\r\n')):
+                                        haggle_stats.entered(time.perf_counter())
+                                    # print(('userData', userData), flush=True)
+                                    tn.write(userData)
+                                userData = sys.stdin.buffer.read(1)
+    finally:
+        # let the parser finish whatever the game sent before it hung up
+        chunks.put(None)
+        parser.join()
+        sel.close()
+        os.close(wakeup_r)
+        os.close(wakeup_w)
+
+# number of course plots ZTM keeps in flight at once
+ZTM_WINDOW = 10
+
+# give up on a course plot if its route hasn't come back in this many seconds
+ZTM_REPLY_TIMEOUT = 30
+
+# the course plots for ZTM, as (x, from, to), skipping any the warps we already know give the answer to.  x is the
+# checkpoint: a run resumed at x starts from the plots for x
+def ztm_plots(graph, explored, first, max_sector):
+    from_one = graph.known_routes(1, range(1, max_sector + 1), explored)
+    known_from = {}
+    requested = set()
+    for x in range(first, max_sector + 1):
+        for s in (x - 1, x):
+            if(s not in known_from):
+                known_from[s] = graph.known_routes(s, (1, s + 1), explored)
+        known_from.pop(x - 2, None)
+        for (a, b) in [(1, x), (x, 1), (x - 1, x)]:
+            if((a, b) in requested):
+                continue
+            requested.add((a, b))
+            if((a == 1 and b in from_one) or (a != 1 and b in known_from[a])):
+                continue
+            yield x, a, b
+
+def do_ztm(tn):
+    try:
+        with twscript.Script(tn, 'Zero-turn mapping') as script:
+            # the 'V' screen tells us what the max_sector is
+            script.send('QQQQQQQQNV')
+            match = script.expect(twparser.maxSectorRe, step='game info')
+            max_sector = int(match.group('maxSector').replace(',',''))
+            script.wait_for_prompt('Command')
+            script.send('^')
+            script.wait_for_prompt('CIM')
+
+            # resume from the checkpoint left by an earlier run, unless that run finished
+            first = int(settings.get('ztm_next', 2))
+            if(first < 2 or first > max_sector):
+                first = 2
 
-    with cbreak(sys.stdin):
-        with nonblocking(sys.stdin):
-            noNewData = 0
+            twparser.flush()
+            database = sqlite3.connect(twparser.database_name)
+            graph = twpath.SectorGraph(database.execute('SELECT source, destination FROM warps ORDER BY rowid'))
+            explored = set(row[0] for row in database.execute('SELECT sector FROM explored'))
+            database.close()
+            script.record('load known warps')
+
+            while(not twparser.routes_saved.empty()):
+                twparser.routes_saved.get_nowait()
+
+            plots = ztm_plots(graph, explored, first, max_sector)
+            in_flight = {}  # (from, to) -> (x, time sent)
+            sent = 0
+            timeouts = 0
+            checkpoint = first
+            finished = False
             while(True):
-                newData = b''
-                try:
-                    newData = tn.read_eager()
-                except EOFError:
-                    print("Connection closed by foreign host.")
+                # keep the window full
+                while(not finished and len(in_flight) < ZTM_WINDOW):
+                    try:
+                        x, a, b = next(plots)
+                    except StopIteration:
+                        finished = True
+                        break
+                    in_flight[(a, b)] = (x, time.time())
+                    tn.write('F{}\r\n{}\r\n'.format(a, b).encode('utf-8'))
+                    sent += 1
+                if(len(in_flight) == 0):
                     break
-                if(len(newData)):
-                    noNewData = 0
-                    if(twparser.verbose == 4):
-                        print(("newData1", newData))
-                    # print(newData.decode('utf-8'), flush=True, end='')
-                    # sys.stdout.write(newData)
-                    if(not settings['mute']):
-                        os.write(1, newData)
-                    newData = newData.replace(b'\r', b'')
-                    currentData += newData
-                    arr = currentData.splitlines(keepends=True)
-                    if(twparser.verbose == 4):
-                        print(("arr", arr))
-                    for line in arr:
-                        if(line[-1] == 0x0a): # ends with b'\n'
-                            twparser.parse_complete_line(line[:-1])
-                    if(len(arr) and arr[-1][-1] != 0x0a):
-                        currentData = arr[-1]
-                    else:
-                        currentData = b''
-
-                    if(len(currentData)):
-                        # print(("currentData", currentData))
-                        # print(currentData, end='')
-                        pass
-                else:
-                    noNewData += 1
-
-                # if(False):
-                if(select.select([sys.stdin,], [], [], 0.0)[0]):
-                    # in non-blocking mode, read() will return b'' if no data is available
-                    # we need non-blocking mode because select() doesn't tell us how much data is available;
-                    # even if more than one input character is in the buffer, select() won't fire again until new input is received
-                    userData = sys.stdin.buffer.read(1)
-                    while(userData):
-                        # translates backspace character into the one expected by tw2002
-                        if(userData == b''): # secret escape char
-                            user_command(tn)
-                            # twparser.verbose += 1
-                            # if(twparser.verbose == 4):
-                            #     settings['mute'] = True
-                            # if(twparser.verbose > 4):
-                            #     twparser.verbose = 0
-                            #     settings['mute'] = False
-                            # print("VERBOSE LEVEL CHANGED: {}".format(twparser.verbose), flush=True)
-                            break
-                        if(userData == b'\x7f'): # Backspace
-                            userData = b'\x08' # ctrl-H
-                        # translate newline into CR-LF, as expected by telnet protocol
-                        if(userData == b'\n'):
-                            userData = b'\r\n'
-                        # print(('userData', userData), flush=True)
-                        tn.write(userData)
-                        userData = sys.stdin.buffer.read(1)
-                # we haven't seen any data recently, so give the CPU a break...
-                if(noNewData > 3):
-                    # no new data has come in for a bit, so we're probably paused at a prompt.  parse the prompt line
-                    if(len(currentData)):
-                        suggestion = twparser.parse_partial_line(currentData)
-                        if(settings['auto_haggle'] and suggestion):
-                            # print("SUGGESTION:", suggestion)
-                            tn.write(suggestion)
-                if(noNewData > 5):
-                    time.sleep(0.1)
-                        
-def do_ztm(tn):
-    tn.write(b'QQQQQQQQNV^')
-    time.sleep(5) # give time for the 'V' to complete and be parsed, so we know what the max_sector is
-    for x in range(2, settings['max_sector']+1):
-        for (a,b) in [(1,x), (x,1), (x-1,x)]:
-            twparser.route_saved.clear()
-            cmd = 'F{}\r\n{}\r\n'.format(a, b)
-            tn.write(cmd.encode('utf-8'))
-            twparser.route_saved.wait()
-    tn.write(b'Q')
+
+                try:
+                    in_flight.pop(twparser.routes_saved.get(timeout=1), None)
+                except queue.Empty:
+                    pass
+                for pair, (px, when) in list(in_flight.items()):
+                    if(time.time() - when > ZTM_REPLY_TIMEOUT):
+                        twparser.log(1, "do_ztm: no route came back for {} > {}".format(*pair))
+                        del in_flight[pair]
+                        timeouts += 1
+
+                # everything before the oldest plot still outstanding is done
+                done_to = min([x for x, when in in_flight.values()] + ([max_sector + 1] if finished else [x]))
+                if(done_to > checkpoint):
+                    checkpoint = done_to
+                    settings['ztm_next'] = checkpoint
+                    twparser.save_setting('ztm_next', checkpoint)
+            script.record('{} course plots for sectors {}-{}, {} skipped, {} timed out'.format(sent, first, max_sector, 3 * (max_sector - first + 1) - sent, timeouts))
+
+            script.send('Q')
+            script.wait_for_prompt('Command')
+            twparser.flush()
+            script.record('database saved')
+    except twscript.ScriptTimeout:
+        return
+    print("Zero-turn mapping complete; all routes saved.", flush=True)
 
 def do_update(tn):
-    tn.write(b'QQQQQQQQN^')
-    tn.write(b'IRQ')
-    tn.write(b'G')
-    tn.write(b'CYQ')
-    
-def user_command(tn):
+    try:
+        with twscript.Script(tn, 'Update') as script:
+            script.send('QQQQQQQQN')
+            script.wait_for_prompt('Command')
+            script.send('^')
+            script.wait_for_prompt('CIM')
+            script.send('I')
+            script.wait_for_prompt('CIM', step='sector report')
+            script.send('R')
+            script.wait_for_prompt('CIM', step='port report')
+            script.send('Q')
+            script.wait_for_prompt('Command')
+            script.send('G')
+            script.wait_for_prompt('Command', step='fighter scan')
+            script.send('C')
+            script.wait_for_prompt('Computer')
+            script.send('Y')
+            script.wait_for_prompt('Computer', step='planet scan')
+            script.send('Q')
+            script.wait_for_prompt('Command')
+            # wait for the parsed data to be committed
+            twparser.flush()
+            script.record('database saved')
+    except twscript.ScriptTimeout:
+        return
+    print("Update complete; database saved.", flush=True)
+
+# handle the key typed after the CTRL-T escape
+def user_command(tn, userData):
     global settings
 
-    while(True):
-        userData = sys.stdin.buffer.read(1)
-        if(not userData):
-            time.sleep(0.1)
-            continue
-        # change Verbose level
-        if(userData >= b'0' and userData <= b'4'):
-            twparser.verbose = int(userData)
-            if(twparser.verbose == 4):
-                settings['mute'] = True
-            else:
-                settings['mute'] = False
-            print("VERBOSE LEVEL CHANGED: {}".format(twparser.verbose), flush=True)
-        if(userData == b'z' or userData == b'Z'):
-            threading.Thread(target=do_ztm, args=(tn,)).start()
-        if(userData == b'u' or userData == b'U'):
-            threading.Thread(target=do_update, args=(tn,)).start()
-        if(userData == b's' or userData == b'S'):
-            print('')
-            print(settings)
-        break
-
-        
+    # change Verbose level
+    if(userData >= b'0' and userData <= b'4'):
+        twparser.verbose = int(userData)
+        if(twparser.verbose == 4):
+            settings['mute'] = True
+        else:
+            settings['mute'] = False
+        print("VERBOSE LEVEL CHANGED: {}".format(twparser.verbose), flush=True)
+    if(userData == b'z' or userData == b'Z'):
+        threading.Thread(target=do_ztm, args=(tn,)).start()
+    if(userData == b'u' or userData == b'U'):
+        threading.Thread(target=do_update, args=(tn,)).start()
+    if(userData == b's' or userData == b'S'):
+        print('')
+        print(settings)
+    if(userData == b'l' or userData == b'L'):
+        print('')
+        print(display_latency)
+        print(parse_lag)
+        print(haggle_stats, flush=True)
 
 if(__name__ == '__main__'):
+    recorder = None
     try:
         parser = argparse.ArgumentParser(description='A telnet emulator client for playing TW2002.  This client will database ports, warps, and the locations of your fighters and planets for use with analytical tools.')
         parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
         parser.add_argument('--twgs-name', '-n', dest='twgs_name', help='Optional TWGS BBS Username to input')
         parser.add_argument('--twgs-game', '-g', dest='twgs_game', help='Optional TWGS game to select')
         parser.add_argument('--twgs-game-pass', '-p', dest='twgs_game_pass', help='Optional TWGS game password to input')
+        parser.add_argument('--record', '-r', help='Record everything the game sends, with timings, to this file for twreplay.py; end the name in .gz or .zst to compress it')
         parser.add_argument('host', help='Hostname or IP address of the game server.')
         parser.add_argument('port', help='Port where the game is running.')
 
@@ -214,11 +561,16 @@ if(__name__ == '__main__'):
         if(args.twgs_game_pass):
             settings['twgs_game_pass'] = args.twgs_game_pass
 
+        if(args.record):
+            recorder = twsession.SessionRecorder(args.record)
+
         telnetConnection = connect(args.host, args.port)
         # telnetConnection = None
 
         if(telnetConnection):
-            interactive_session(telnetConnection)
+            interactive_session(telnetConnection, recorder)
 
     finally:
+        if(recorder):
+            recorder.close()
         twparser.quit()
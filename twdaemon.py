@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+import socket
+import socketserver
+import argparse
+import json
+import os
+import sys
+import io
+import time
+import importlib
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+
+import twpath
+
+DEFAULT_DB_NAME = 'tw2002.db'
+
+# the analysis tools the daemon will run on behalf of a client; each one has a run(argv) entry point
+TOOLS = ('twpath', 'portPairs', 'portCircuits', 'smartProbe')
+
+# seconds between checks of the database for changes while idle
+WATCH_INTERVAL = 1.0
+
+# how long a client will wait to connect before giving up and doing the work itself
+CONNECT_TIMEOUT = 0.5
+
+def socket_filename(dbname):
+    return os.path.abspath(dbname) + '.sock'
+
+# send one JSON request to the daemon serving a database; returns the decoded response, or None if no daemon answered
+def request(dbname, message):
+    path = socket_filename(dbname)
+    if(not os.path.exists(path)):
+        return None
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(CONNECT_TIMEOUT)
+        s.connect(path)
+        s.settimeout(None)
+        s.sendall(json.dumps(message).encode('utf-8') + b'\n')
+        line = s.makefile('rb').readline()
+    except OSError:
+        return None
+    finally:
+        s.close()
+    if(not line):
+        return None
+    try:
+        return json.loads(line.decode('utf-8'))
+    except ValueError:
+        return None
+
+# called by the tools once their arguments are parsed: if a daemon is serving this database, let it do the work
+# and print its output.  returns True if the request was handled, False if the caller should carry on by itself
+def forward(dbname, tool, argv):
+    if(os.environ.get('TW_NO_DAEMON')):
+        return False
+    if(argv is None):
+        argv = sys.argv[1:]
+    response = request(dbname, {'tool': tool, 'argv': argv, 'cwd': os.getcwd()})
+    if(response is None or 'output' not in response):
+        return False
+    sys.stdout.write(response['output'])
+    sys.stderr.write(response.get('errors', ''))
+    sys.stdout.flush()
+    if(response.get('status')):
+        sys.exit(response['status'])
+    return True
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                message = json.loads(line.decode('utf-8'))
+                response = self.server.state.dispatch(message)
+            except ValueError:
+                response = {'status': 2, 'error': 'malformed request'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+class Server(socketserver.UnixStreamServer):
+    timeout = WATCH_INTERVAL
+    state = None
+
+    def handle_timeout(self):
+        self.state.check()
+
+class DaemonState:
+    dbname = None
+    signature = None
+    requests = 0
+    stopping = False
+
+    def __init__(self, dbname):
+        self.dbname = os.path.abspath(dbname)
+
+    # the database and its write-ahead log change on every commit
+    def db_signature(self):
+        sig = []
+        for suffix in ('', '-wal'):
+            try:
+                st = os.stat(self.dbname + suffix)
+                sig.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                sig.append(None)
+        return tuple(sig)
+
+    # reload everything if the database has changed since we last looked
+    def check(self):
+        sig = self.db_signature()
+        if(sig == self.signature):
+            return
+        self.signature = sig
+        start = time.time()
+        twpath.connect_database(self.dbname)
+        twpath.invalidate()
+        graph = twpath.load_graph()
+        twpath.explored_sectors()
+        twpath.fighter_locations()
+        twpath.blind_warps()
+        twpath.port_list()
+        print('twdaemon: loaded {} sectors, {} warps in {:.3f}s'.format(graph.size, graph.edge_count(), time.time() - start), flush=True)
+
+    def dispatch(self, message):
+        tool = message.get('tool')
+        if(tool == 'ping'):
+            return {'status': 0, 'output': 'twdaemon serving {} ({} requests)\n'.format(self.dbname, self.requests)}
+        if(tool == 'shutdown'):
+            self.stopping = True
+            return {'status': 0, 'output': 'twdaemon shutting down\n'}
+        if(tool not in TOOLS):
+            return {'status': 2, 'error': 'unknown tool {}'.format(tool)}
+
+        self.check()
+        self.requests += 1
+        out = io.StringIO()
+        err = io.StringIO()
+        status = 0
+        cwd = os.getcwd()
+        start = time.time()
+        try:
+            os.chdir(message.get('cwd', cwd))
+            with redirect_stdout(out), redirect_stderr(err):
+                importlib.import_module(tool).run(message.get('argv', []))
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            err.write(traceback.format_exc())
+            status = 1
+        finally:
+            os.chdir(cwd)
+        print('twdaemon: {} {} ({:.3f}s)'.format(tool, ' '.join(message.get('argv', [])), time.time() - start), flush=True)
+        return {'status': status, 'output': out.getvalue(), 'errors': err.getvalue()}
+
+def serve(dbname):
+    path = socket_filename(dbname)
+    if(os.path.exists(path)):
+        if(request(dbname, {'tool': 'ping'})):
+            print('twdaemon: already running on {}'.format(path), file=sys.stderr)
+            return 1
+        # left over from a daemon that didn't shut down cleanly
+        os.unlink(path)
+
+    # the tools we run in-process (and any workers they start) must not forward requests back to us
+    os.environ['TW_NO_DAEMON'] = '1'
+    state = DaemonState(dbname)
+    state.check()
+    server = Server(path, RequestHandler)
+    server.state = state
+    os.chmod(path, 0o600)
+    print('twdaemon: listening on {}'.format(path), flush=True)
+    try:
+        while(not state.stopping):
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+    return 0
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Keeps the sector map, ports and fighters loaded in memory and answers twpath.py, portPairs.py and smartProbe.py queries over a Unix socket, so they start instantly.  The tools use it automatically while it is running.')
+    parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
+    parser.add_argument('--status', '-s', action='store_true', help='Check whether a daemon is running for this database')
+    parser.add_argument('--stop', action='store_true', help='Stop the daemon running for this database')
+
+    args = parser.parse_args()
+
+    if(args.status or args.stop):
+        response = request(args.db, {'tool': 'shutdown' if args.stop else 'ping'})
+        if(response is None):
+            print('twdaemon: not running')
+            sys.exit(1)
+        print(response['output'], end='')
+        sys.exit(0)
+
+    sys.exit(serve(args.db))
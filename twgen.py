@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+
+import sqlite3
+import argparse
+import random
+import time
+import os
+
+import twparser
+
+# how many warps lead out of a typical sector (bubbles and dead ends are added on top of this)
+WARP_DEGREES = {1: 4, 2: 22, 3: 30, 4: 24, 5: 13, 6: 7}
+
+# how common each port class is; class 8 (BBB) ports are rare
+PORT_CLASSES = {'BBS': 16, 'BSB': 16, 'SBB': 16, 'SSB': 14, 'SBS': 14, 'BSS': 14, 'SSS': 6, 'BBB': 4}
+
+FED_SPACE = range(1, 11)
+
+# a universe shaped like a Trade Wars 2002 one: FedSpace, a connected core of mostly two-way warps with a few one-way
+# ones, dead ends, bubbles reached through a single gate sector, ports, and some deployed fighters.  the same size and
+# seed always give the same universe.  returns the warps, explored sectors, ports, fighters and settings
+def make_universe(sectors, seed=0, explored_fraction=0.8, port_fraction=0.45, fighter_fraction=0.02, one_way_fraction=0.04, bubble_fraction=0.05, dead_end_fraction=0.03):
+    rng = random.Random(seed)
+    warps = set()
+
+    def link(a, b, one_way=False):
+        if(a != b):
+            warps.add((a, b))
+            if(not one_way):
+                warps.add((b, a))
+
+    # set aside the bubbles and dead ends so the core doesn't wire into them
+    core = list(range(11, sectors + 1))
+    rng.shuffle(core)
+    bubbles = []
+    bubble_sectors = int(sectors * bubble_fraction)
+    while(bubble_sectors > 0 and len(core) > 20):
+        size = min(rng.randint(4, 15), bubble_sectors)
+        bubbles.append([core.pop() for i in range(size)])
+        bubble_sectors -= size
+    dead_ends = [core.pop() for i in range(min(int(sectors * dead_end_fraction), len(core) - 10))]
+
+    # FedSpace is tightly connected, and sector 1 joins it to the rest
+    for a in FED_SPACE:
+        for b in FED_SPACE:
+            if(a < b and (b == a + 1 or rng.random() < 0.3)):
+                link(a, b)
+
+    # each core sector draws how many warps it should have.  a random spanning tree keeps every core sector reachable
+    # both ways, then extra warps bring each sector up to its degree, never past it, so there are no huge hubs
+    degrees = list(WARP_DEGREES)
+    wanted = dict(zip(core, rng.choices(degrees, [WARP_DEGREES[d] for d in degrees], k=len(core))))
+    out = {}
+
+    def has_room(sector):
+        return out.get(sector, 0) < wanted.get(sector, 6)
+
+    def add(a, b, one_way=False):
+        link(a, b, one_way)
+        out[a] = out.get(a, 0) + 1
+        if(not one_way):
+            out[b] = out.get(b, 0) + 1
+
+    for source, destination in warps:
+        out[source] = out.get(source, 0) + 1
+    reached = list(FED_SPACE)
+    for sector in core:
+        for tries in range(10):
+            other = rng.choice(reached)
+            if(has_room(other)):
+                break
+        add(sector, other)
+        reached.append(sector)
+    for sector in core:
+        for tries in range(20):
+            if(not has_room(sector)):
+                break
+            other = rng.choice(core)
+            if(other == sector or (sector, other) in warps or not has_room(other)):
+                continue
+            add(sector, other, rng.random() < one_way_fraction)
+
+    # a bubble is a small tangle of sectors whose only way in or out is its gate
+    for bubble in bubbles:
+        gate = rng.choice(core)
+        link(gate, bubble[0])
+        for i in range(1, len(bubble)):
+            link(bubble[i], bubble[rng.randrange(i)])
+            if(i > 2 and rng.random() < 0.3):
+                link(bubble[i], bubble[rng.randrange(i - 1)])
+
+    for sector in dead_ends:
+        link(sector, rng.choice(core))
+
+    everything = list(range(1, sectors + 1))
+    explored = set(FED_SPACE)
+    explored.update(s for s in everything if rng.random() < explored_fraction)
+
+    classes = list(PORT_CLASSES)
+    weights = [PORT_CLASSES[c] for c in classes]
+    stardock = rng.choice(core)
+    ports = []
+    # the CIM port report only lists ports in explored sectors
+    for sector in sorted(explored):
+        if(sector == stardock or sector in FED_SPACE or rng.random() >= port_fraction):
+            continue
+        port_class = rng.choices(classes, weights)[0]
+        row = [sector, port_class]
+        for c in port_class:
+            amount = rng.randint(1, 30) * 100
+            pct = rng.randint(5, 100)
+            row += [amount * pct // 100, pct]
+        ports.append(tuple(row))
+
+    fighters = [s for s in sorted(explored) if s not in FED_SPACE and rng.random() < fighter_fraction]
+
+    settings = {'max_sector': sectors, 'stardock': stardock}
+    return sorted(warps), explored, ports, fighters, settings
+
+# write a universe into a new database, with the same schema twparser.py creates.  ports go in as observations a day
+# before now, so the ports table is filled by twparser's triggers just as it is in play
+def write_universe(dbname, universe):
+    warps, explored, ports, fighters, settings = universe
+    twparser.database_init(dbname)
+    database = sqlite3.connect(dbname)
+    cursor = database.cursor()
+    ts = int(time.time()) - 86400
+    cursor.executemany('INSERT OR IGNORE INTO warps (source, destination) VALUES(?, ?)', warps)
+    cursor.executemany('INSERT OR IGNORE INTO explored (sector) VALUES(?)', [(s,) for s in sorted(explored)])
+    cursor.executemany('''
+        INSERT OR REPLACE INTO port_observations (sector, ts, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(row[0], ts) + row[1:] for row in ports])
+    cursor.executemany('INSERT OR IGNORE INTO fighters (sector) VALUES(?)', [(s,) for s in fighters])
+    cursor.executemany('REPLACE INTO settings (key, value) VALUES(?, ?)', [(k, str(v)) for k, v in settings.items()])
+    cursor.close()
+    database.commit()
+    database.close()
+
+def generate(dbname, sectors, seed=0):
+    if(os.path.exists(dbname)):
+        raise FileExistsError('{} already exists'.format(dbname))
+    universe = make_universe(sectors, seed=seed)
+    write_universe(dbname, universe)
+    return universe
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Trade Wars 2002 universe into a new SQLite database, for trying out and benchmarking the tools.')
+    parser.add_argument('--sectors', '-s', type=int, default=1000, help='Number of sectors in the universe; default 1000')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed; the same size and seed always give the same universe; default 0')
+    parser.add_argument('database', help='SQLite database file to create')
+
+    args = parser.parse_args()
+
+    if(args.sectors < 20):
+        parser.error('a universe needs at least 20 sectors')
+    start = time.time()
+    try:
+        warps, explored, ports, fighters, settings = generate(args.database, args.sectors, seed=args.seed)
+    except FileExistsError as e:
+        parser.error(str(e))
+    print('{}: {} sectors, {} warps, {} explored, {} ports, {} fighters, stardock in {} ({:.2f}s)'.format(
+        args.database, args.sectors, len(warps), len(explored), len(ports), len(fighters), settings['stardock'], time.time() - start))
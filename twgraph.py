@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+
+import sqlite3
+import argparse
+import json
+import time
+import os
+
+import twpath
+import twhops
+
+DEFAULT_DB_NAME = 'tw2002.db'
+
+# the analysis is saved next to the database in this format, with the versions of the warps and explored tables it was
+# made from
+CACHE_FORMAT = 3
+
+# a bubble of one sector is a dead end, which twpath.py --dead-ends already finds; anything bigger than this is a
+# region of the map rather than a bubble
+DEFAULT_MIN_BUBBLE = 2
+DEFAULT_MAX_BUBBLE = 100
+
+def cache_filename(dbname):
+    return dbname + '.bubbles'
+
+# a fingerprint of the explored table, which the one-way regions depend on.  sectors are only ever added to it, so
+# their count and sum change whenever it does
+def explored_version(database):
+    count, total = database.execute('SELECT count(*), ifnull(sum(sector), 0) FROM explored').fetchone()
+    return '{}:{}'.format(count, total)
+
+# each sector's neighbours by a warp in either direction, as lists indexed by sector
+def undirected(graph):
+    neighbours = [[] for s in range(graph.size)]
+    for reverse in (False, True):
+        offsets, targets = graph.adjacency(reverse)
+        for s in range(graph.size):
+            for i in range(offsets[s], offsets[s + 1]):
+                neighbours[s].append(targets[i])
+    return [sorted(set(n) - {s}) for s, n in enumerate(neighbours)]
+
+# the map's block structure, from one depth-first search over the warps taken in either direction (Hopcroft and
+# Tarjan), iterative so that long chains of sectors don't hit the recursion limit.  each search starts from roots[0],
+# then from the first of the others not yet reached.  returns (articulation points, biconnected components as sector
+# lists, separations); a separation (gate, sectors) is a group of sectors, on the far side of gate from the root,
+# that can only be reached through gate
+def block_structure(graph, roots):
+    neighbours = undirected(graph)
+    size = len(neighbours)
+    disc = [-1] * size
+    low = [0] * size
+    parent = [-1] * size
+    subtree = [1] * size
+    order = []
+    articulation = set()
+    components = []
+    separated = []
+    edges = []
+    for root in roots:
+        if(root >= size or disc[root] != -1 or not neighbours[root]):
+            continue
+        disc[root] = low[root] = len(order)
+        order.append(root)
+        root_children = 0
+        stack = [(root, iter(neighbours[root]))]
+        while(stack):
+            v, remaining = stack[-1]
+            for w in remaining:
+                if(disc[w] == -1):
+                    parent[w] = v
+                    disc[w] = low[w] = len(order)
+                    order.append(w)
+                    edges.append((v, w))
+                    stack.append((w, iter(neighbours[w])))
+                    break
+                elif(w != parent[v] and disc[w] < disc[v]):
+                    low[v] = min(low[v], disc[w])
+                    edges.append((v, w))
+            else:
+                stack.pop()
+                if(not stack):
+                    continue
+                u = stack[-1][0]
+                subtree[u] += subtree[v]
+                low[u] = min(low[u], low[v])
+                if(low[v] >= disc[u]):
+                    # nothing below v reaches back past u: u is the only way in to v's subtree
+                    if(u == root):
+                        root_children += 1
+                    else:
+                        articulation.add(u)
+                    separated.append((u, v))
+                    component = set()
+                    while(True):
+                        a, b = edges.pop()
+                        component.add(a)
+                        component.add(b)
+                        if((a, b) == (u, v)):
+                            break
+                    components.append(sorted(component))
+        if(root_children > 1):
+            articulation.add(root)
+    # a subtree is a contiguous run of the depth-first order
+    separations = [(gate, order[disc[v]:disc[v] + subtree[v]]) for gate, v in separated]
+    return sorted(articulation), components, separations
+
+# pockets of sectors whose only way in or out is a single gate sector, away from the root (sector 1 and FedSpace), as
+# (gate, sorted sectors).  a bubble inside a bigger one isn't listed separately
+def find_bubbles(separations, min_size=DEFAULT_MIN_BUBBLE, max_size=DEFAULT_MAX_BUBBLE):
+    candidates = sorted((s for s in separations if len(s[1]) <= max_size), key=lambda s: -len(s[1]))
+    inside = set()
+    bubbles = []
+    for gate, sectors in candidates:
+        if(gate in inside):
+            continue
+        inside.update(sectors)
+        if(len(sectors) >= min_size):
+            bubbles.append((gate, sorted(sectors)))
+    return sorted(bubbles)
+
+# strongly connected components of the warps (Tarjan), iterative; each component is a sorted list of sectors.  only
+# sectors with warps are included
+def strongly_connected_components(graph):
+    offsets, targets = graph.adjacency()
+    size = graph.size
+    index = [-1] * size
+    low = [0] * size
+    on_stack = bytearray(size)
+    stack = []
+    components = []
+    counter = 0
+    for root in range(size):
+        if(index[root] != -1 or (offsets[root + 1] == offsets[root] and len(graph.warps_to(root)) == 0)):
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = 1
+        work = [(root, offsets[root])]
+        while(work):
+            v, i = work[-1]
+            if(i < offsets[v + 1]):
+                work[-1] = (v, i + 1)
+                w = targets[i]
+                if(index[w] == -1):
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = 1
+                    work.append((w, offsets[w]))
+                elif(on_stack[w]):
+                    low[v] = min(low[v], index[w])
+                continue
+            work.pop()
+            if(work):
+                u = work[-1][0]
+                low[u] = min(low[u], low[v])
+            if(low[v] == index[v]):
+                component = []
+                while(True):
+                    w = stack.pop()
+                    on_stack[w] = 0
+                    component.append(w)
+                    if(w == v):
+                        break
+                components.append(sorted(component))
+    return components
+
+# the strongly connected components other than the biggest one, where warps only lead one way, as (sectors, whether
+# there's a warp in from outside, whether there's a warp out).  a region with no warp out is a trap.  the warps out of
+# a sector are only known once it's been explored, so regions with unexplored sectors in them (if explored is given)
+# and lone sectors with no known warps out aren't listed
+def one_way_regions(graph, components, explored=None):
+    if(len(components) == 0):
+        return []
+    main = max(components, key=len)
+    regions = []
+    for component in components:
+        if(component is main):
+            continue
+        if(explored is not None and any(sector not in explored for sector in component)):
+            continue
+        if(len(component) == 1 and len(graph.warps_from(component[0])) == 0):
+            continue
+        members = set(component)
+        enter = any(s not in members for sector in component for s in graph.warps_to(sector))
+        leave = any(s not in members for sector in component for s in graph.warps_from(sector))
+        regions.append((component, enter, leave))
+    return regions
+
+# analyse the sector map: articulation points, the number of biconnected components, bubbles and one-way regions
+def analyse(graph, explored=None, min_size=DEFAULT_MIN_BUBBLE, max_size=DEFAULT_MAX_BUBBLE):
+    articulation, components, separations = block_structure(graph, [1] + list(range(graph.size)))
+    regions = one_way_regions(graph, strongly_connected_components(graph), explored)
+    return {
+        'articulation_points': articulation,
+        'biconnected_components': len(components),
+        'bubbles': [{'gate': gate, 'sectors': sectors} for gate, sectors in find_bubbles(separations, min_size, max_size)],
+        'one_way_regions': [{'sectors': sectors, 'enter': enter, 'leave': leave} for sectors, enter, leave in regions],
+        }
+
+# the analysis of a database's sector map, from the file saved next to it if that was made from the same warps and
+# explored sectors with the same bubble sizes; otherwise worked out and saved
+def load(dbname, min_size=DEFAULT_MIN_BUBBLE, max_size=DEFAULT_MAX_BUBBLE, rebuild=False):
+    database = sqlite3.connect(dbname)
+    version = twhops.warps_version(database)
+    explored = explored_version(database)
+    database.close()
+    key = {'format': CACHE_FORMAT, 'version': version, 'explored': explored, 'min_size': min_size, 'max_size': max_size}
+    filename = cache_filename(dbname)
+    if(not rebuild and os.path.exists(filename)):
+        try:
+            with open(filename) as f:
+                cached = json.load(f)
+            if(cached.get('key') == key):
+                return cached['analysis']
+        except (OSError, ValueError):
+            pass
+
+    twpath.connect_database(dbname)
+    analysis = analyse(twpath.load_graph(), explored=twpath.explored_sectors(), min_size=min_size, max_size=max_size)
+    tmpname = filename + '.tmp'
+    try:
+        with open(tmpname, 'w') as f:
+            json.dump({'key': key, 'analysis': analysis}, f)
+        os.replace(tmpname, filename)
+    except OSError:
+        # the analysis still works without somewhere to save it
+        pass
+    return analysis
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Find the bubbles (pockets of sectors behind a single gate sector), choke points and one-way regions of the sector map.  The results are saved next to the database for twpath.py --bubble-gates and smartProbe.py --bubbles.')
+    parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
+    parser.add_argument('--min-size', type=int, default=DEFAULT_MIN_BUBBLE, help='Smallest bubble to list, in sectors; default {}'.format(DEFAULT_MIN_BUBBLE))
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_BUBBLE, help='Largest bubble to list, in sectors; default {}'.format(DEFAULT_MAX_BUBBLE))
+    parser.add_argument('--rebuild', '-f', action='store_true', help='Analyse the map again even if the saved results are up to date')
+    parser.add_argument('--choke-points', '-c', action='store_true', help='Also list every articulation point: sectors whose loss would cut the map in two')
+    parser.add_argument('--one-way', '-o', action='store_true', help='Also list the regions that can only be entered or left one way')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    analysis = load(args.db, min_size=args.min_size, max_size=args.max_size, rebuild=args.rebuild)
+    bubbles = analysis['bubbles']
+    print('{}: {} bubbles, {} articulation points, {} biconnected components, {} one-way regions ({:.2f}s)'.format(
+        cache_filename(args.db), len(bubbles), len(analysis['articulation_points']), analysis['biconnected_components'],
+        len(analysis['one_way_regions']), time.time() - start))
+
+    for bubble in sorted(bubbles, key=lambda b: len(b['sectors'])):
+        print('Gate {:5}  {:3} sectors:  {}'.format(bubble['gate'], len(bubble['sectors']), ' '.join(str(s) for s in bubble['sectors'])))
+
+    if(args.choke_points):
+        print('Articulation points: {}'.format(' '.join(str(s) for s in analysis['articulation_points'])))
+
+    if(args.one_way):
+        for region in analysis['one_way_regions']:
+            kind = 'trap, no way out' if not region['leave'] else ('no way in' if not region['enter'] else 'one way through')
+            print('{:3} sectors ({}):  {}'.format(len(region['sectors']), kind, ' '.join(str(s) for s in region['sectors'])))
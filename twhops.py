@@ -0,0 +1,298 @@
+#!/usr/bin/python3
+
+import sqlite3
+import argparse
+import mmap
+import os
+import struct
+import time
+import multiprocessing
+from array import array
+from collections import deque
+
+import twpath
+
+DEFAULT_DB_NAME = 'tw2002.db'
+
+# file layout: a one page header, then the size x size matrix of hop counts (row = source sector, column = destination),
+# then the list of warps the matrix was built from, so later rebuilds can tell which warps changed
+MAGIC = b'TWHOPS01'
+HEADER = struct.Struct('<8sII64s') # magic, size, number of warps, warps table version
+HEADER_SIZE = 4096
+
+# hop counts are stored in one byte; anything further away (or unreachable) is stored as this
+UNREACHABLE = 255
+
+# number of destination sectors searched together by the bit-parallel BFS
+DEFAULT_BATCH_SIZE = 2048
+
+# if more than this fraction of the rows need recomputing, rebuild the whole matrix instead
+INCREMENTAL_LIMIT = 0.25
+
+# maps each binary digit of a bitset to a two digit hex byte, expanding one bit per sector into one byte per sector
+SPREAD = str.maketrans({'0': '00', '1': '01'})
+
+def matrix_filename(dbname):
+    return dbname + '.hops'
+
+# cheap fingerprint of the warps table, used to tell whether data derived from it is stale
+def warps_version(database):
+    conn = database.cursor()
+    count, a, b = conn.execute('''
+        SELECT
+            count(*),
+            ifnull(sum(source * 65536 + destination), 0),
+            ifnull(sum(((source * 65536 + destination) * (source * 65536 + destination)) % 2147483647), 0)
+        FROM warps
+        ''').fetchone()
+    conn.close()
+    return '{}:{}:{}'.format(count, a, b)
+
+def load_graph(database):
+    conn = database.cursor()
+    graph = twpath.SectorGraph(conn.execute('SELECT source, destination FROM warps ORDER BY rowid'))
+    conn.close()
+    return graph
+
+def graph_edges(graph):
+    offsets, targets = graph.adjacency()
+    edges = array('I')
+    for s in range(graph.size):
+        for i in range(offsets[s], offsets[s + 1]):
+            edges.append(s)
+            edges.append(targets[i])
+    return edges
+
+class HopMatrix:
+    size = 0
+    version = None
+    edges = None
+
+    def __init__(self, filename, writable=False):
+        self.file = open(filename, 'r+b' if writable else 'rb')
+        access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+        self.map = mmap.mmap(self.file.fileno(), 0, access=access)
+        magic, self.size, n_edges, version = HEADER.unpack_from(self.map, 0)
+        if(magic != MAGIC):
+            self.close()
+            raise ValueError('{} is not a hop matrix file'.format(filename))
+        self.version = version.rstrip(b'\0').decode('ascii')
+        start = HEADER_SIZE + self.size * self.size
+        self.edges = array('I')
+        self.edges.frombytes(self.map[start:start + 8 * n_edges])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def distance(self, a, b):
+        if(a == b):
+            return 0
+        if(a < 0 or b < 0 or a >= self.size or b >= self.size):
+            return UNREACHABLE
+        return self.map[HEADER_SIZE + a * self.size + b]
+
+    def row(self, a):
+        start = HEADER_SIZE + a * self.size
+        return self.map[start:start + self.size]
+
+    def column(self, b):
+        return self.map[HEADER_SIZE + b:HEADER_SIZE + self.size * self.size:self.size]
+
+def write_header(m, size, n_edges, version):
+    m[0:HEADER.size] = HEADER.pack(MAGIC, size, n_edges, version.encode('ascii'))
+
+# bit-parallel BFS backwards from the destinations [first, last): bit i of a sector's bitset means that sector
+# can reach destination first+i.  each sector's hop counts for the whole batch are accumulated as one big integer
+# holding one byte per destination, then written into its row of the matrix in a single slice
+def fill_columns(m, graph, first, last):
+    offsets, targets = graph.adjacency(reverse=True)
+    width = last - first
+    bin_format = '0{}b'.format(width)
+
+    reached = {}
+    frontier = {}
+    for t in range(first, last):
+        reached[t] = frontier[t] = 1 << (t - first)
+    hops = {}
+    level = 0
+    while(frontier and level < UNREACHABLE - 1):
+        level += 1
+        incoming = {}
+        for current, bits in frontier.items():
+            for i in range(offsets[current], offsets[current + 1]):
+                neighbor = targets[i]
+                incoming[neighbor] = incoming.get(neighbor, 0) | bits
+        frontier = {}
+        for sector, bits in incoming.items():
+            new = bits & ~reached.get(sector, 0)
+            if(new):
+                reached[sector] = reached.get(sector, 0) | new
+                frontier[sector] = new
+                hops[sector] = hops.get(sector, 0) + int(format(new, bin_format).translate(SPREAD), 16) * level
+
+    everything = (1 << width) - 1
+    unreachable_row = bytes([UNREACHABLE]) * width
+    for sector in range(graph.size):
+        start = HEADER_SIZE + sector * graph.size + first
+        if(sector not in reached):
+            m[start:start + width] = unreachable_row
+            continue
+        row = hops.get(sector, 0)
+        missing = everything & ~reached[sector]
+        if(missing):
+            row += int(format(missing, bin_format).translate(SPREAD), 16) * UNREACHABLE
+        m[start:start + width] = row.to_bytes(width, 'little')
+
+# plain BFS from each source, rewriting that source's whole row
+def fill_rows(m, graph, sources):
+    offsets, targets = graph.adjacency()
+    size = graph.size
+    for source in sources:
+        row = bytearray([UNREACHABLE]) * size
+        row[source] = 0
+        queue = deque((source,))
+        while(queue):
+            current = queue.popleft()
+            hops = row[current] + 1
+            if(hops >= UNREACHABLE):
+                break
+            for i in range(offsets[current], offsets[current + 1]):
+                neighbor = targets[i]
+                if(row[neighbor] == UNREACHABLE and neighbor != source):
+                    row[neighbor] = hops
+                    queue.append(neighbor)
+        start = HEADER_SIZE + source * size
+        m[start:start + size] = row
+
+worker_state = None
+
+def fill_columns_init(filename, graph):
+    global worker_state
+    f = open(filename, 'r+b')
+    worker_state = (f, mmap.mmap(f.fileno(), 0), graph)
+
+def fill_columns_worker(batch):
+    f, m, graph = worker_state
+    fill_columns(m, graph, *batch)
+    m.flush()
+    return batch
+
+def build_full(filename, graph, version, processes=1, batch_size=DEFAULT_BATCH_SIZE):
+    size = graph.size
+    edges = graph_edges(graph)
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as f:
+        f.truncate(HEADER_SIZE + size * size + 4 * len(edges))
+    batches = [(t, min(t + batch_size, size)) for t in range(0, size, batch_size)]
+
+    with open(tmpname, 'r+b') as f:
+        m = mmap.mmap(f.fileno(), 0)
+        if(processes > 1 and len(batches) > 1):
+            with multiprocessing.Pool(processes, initializer=fill_columns_init, initargs=(tmpname, graph)) as pool:
+                for batch in pool.imap_unordered(fill_columns_worker, batches):
+                    pass
+        else:
+            for batch in batches:
+                fill_columns(m, graph, *batch)
+        start = HEADER_SIZE + size * size
+        m[start:start + 4 * len(edges)] = edges.tobytes()
+        write_header(m, size, len(edges) // 2, version)
+        m.flush()
+        m.close()
+    os.replace(tmpname, filename)
+
+# sources whose shortest paths may use one of the changed warps: an added warp u>w matters to source s only if it is
+# a shortcut (d(s,u)+1 < d(s,w)), and a removed one only if it was on a shortest path (d(s,u)+1 == d(s,w))
+def affected_sources(hm, added, removed):
+    affected = set()
+    for changes, test in ((added, lambda du, dw: du + 1 < dw), (removed, lambda du, dw: du + 1 == dw)):
+        for u, w in changes:
+            col_u = hm.column(u)
+            col_w = hm.column(w)
+            for s in range(hm.size):
+                du = col_u[s]
+                if(du < UNREACHABLE and test(du, col_w[s])):
+                    affected.add(s)
+    return affected
+
+# bring the hop matrix for a database up to date, recomputing only the affected rows when few warps have changed.
+# returns (HopMatrix, number of rows recomputed)
+def build(dbname, processes=1, full=False, batch_size=DEFAULT_BATCH_SIZE):
+    database = sqlite3.connect(dbname)
+    version = warps_version(database)
+    graph = load_graph(database)
+    database.close()
+    filename = matrix_filename(dbname)
+
+    hm = None
+    if(not full and os.path.exists(filename)):
+        try:
+            hm = HopMatrix(filename, writable=True)
+        except ValueError:
+            hm = None
+    if(hm and hm.version == version):
+        return hm, 0
+
+    if(hm and hm.size == graph.size and hm.version != ''):
+        edges = graph_edges(graph)
+        old = set(zip(hm.edges[0::2], hm.edges[1::2]))
+        new = set(zip(edges[0::2], edges[1::2]))
+        affected = affected_sources(hm, new - old, old - new)
+        if(len(affected) <= graph.size * INCREMENTAL_LIMIT):
+            # mark the file stale while we patch it, in case we're interrupted
+            write_header(hm.map, hm.size, len(hm.edges) // 2, '')
+            hm.map.flush()
+            fill_rows(hm.map, graph, sorted(affected))
+            hm.map.close()
+            hm.file.truncate(HEADER_SIZE + graph.size * graph.size + 4 * len(edges))
+            m = mmap.mmap(hm.file.fileno(), 0)
+            start = HEADER_SIZE + graph.size * graph.size
+            m[start:start + 4 * len(edges)] = edges.tobytes()
+            write_header(m, graph.size, len(edges) // 2, version)
+            m.flush()
+            m.close()
+            hm.file.close()
+            return HopMatrix(filename), len(affected)
+    if(hm):
+        hm.close()
+
+    build_full(filename, graph, version, processes=processes, batch_size=batch_size)
+    return HopMatrix(filename), graph.size
+
+# open the hop matrix for a database, if one exists and matches the current warps table
+def load(dbname):
+    filename = matrix_filename(dbname)
+    if(not os.path.exists(filename)):
+        return None
+    try:
+        hm = HopMatrix(filename)
+    except (ValueError, OSError, struct.error):
+        return None
+    database = sqlite3.connect(dbname)
+    version = warps_version(database)
+    database.close()
+    if(hm.version != version):
+        hm.close()
+        return None
+    return hm
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Precompute the hop distance between every pair of sectors, saved next to the database as a memory-mapped file for the other tools to use.')
+    parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
+    parser.add_argument('--processes', '-j', type=int, default=1, help='Number of worker processes to use for a full rebuild; default 1')
+    parser.add_argument('--full', '-f', action='store_true', help='Rebuild the whole matrix even if only a few warps have changed')
+    parser.add_argument('sectors', type=int, nargs='*', help='Optionally, print the hop counts between these sectors')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    hm, rows = build(args.db, processes=args.processes, full=args.full)
+    print('{}: {} sectors, {} warps, {} rows recomputed in {:.2f}s'.format(matrix_filename(args.db), hm.size, len(hm.edges) // 2, rows, time.time() - start))
+
+    for a in args.sectors:
+        for b in args.sectors:
+            if(a != b):
+                d = hm.distance(a, b)
+                print('{} > {}: {}'.format(a, b, 'unreachable' if d == UNREACHABLE else '{} hops'.format(d)))
@@ -9,12 +9,16 @@ from multiprocessing.pool import ThreadPool
 import traceback
 import sys
 import math
+import mmap
+import os
+import multiprocessing
 
 # variable for collating the multi-line output of route planning commands
 routeList = None
 
 # our SQLite database
 database = None
+database_name = None
 DB_THREAD_ID = None
 DEFAULT_DB_NAME = 'tw2002.db'
 dbqueue = queue.Queue()
@@ -30,14 +34,22 @@ class PortStatus:
     prev_their_offer = None
     prev_our_offer = None
     final_offer = False
+    # running totals, so the client can time the haggling
+    offers = 0
+    trades = 0
 
 port_status = PortStatus()
 
-# synchronizer, so the ZTM algorithm can know when the last route was processed and it can move on to the next
-route_saved = threading.Event()
+# functions called with (line, partial) for every line parsed, with the ANSI codes stripped; partial is True for an
+# unfinished line, such as a prompt.  see twscript.py
+line_listeners = []
 
-# sync flag for threads to exit
-QUITTING_TIME = False
+# the (from, to) sectors of each route listing parsed, so the ZTM algorithm can match them up with its requests.
+# nobody reads it outside of ZTM, so once it's full, more routes aren't added
+routes_saved = queue.Queue(1000)
+
+# set when the threads should exit; the writer itself stops when it reaches the shutdown sentinel (None) in dbqueue
+shutting_down = threading.Event()
 
 port_class_numbers = {'BBS':1, 'BSB':2, 'SBB':3, 'SSB':4, 'SBS':5, 'BSS':6, 'SSS':7, 'BBB':8}
 port_class_sales =   {1:'BBS', 2:'BSB', 3:'SBB', 4:'SSB', 5:'SBS', 6:'BSS', 7:'SSS', 8:'BBB'}
@@ -82,26 +94,68 @@ maxSectorRe = re.compile("^\s+Maximum players [0-9]+, sectors (?P<maxSector>[0-9
 stardockRe = re.compile("^\s*The StarDock is located in sector (?P<sector>[0-9,]+)\.$")
 
 # from https://stackoverflow.com/questions/14693701/how-can-i-remove-the-ansi-escape-sequences-from-a-string-in-python
-def strip_ansi(inString):
-    ansi_escape_8bit = re.compile(br'''
-        (?: # either 7-bit C1, two bytes, ESC Fe (omitting CSI)
-            \x1B
-            [@-Z\\-_]
-        |   # or a single 8-bit byte Fe (omitting CSI)
-            [\x80-\x9A\x9C-\x9F]
-        |   # or CSI + control codes
-            (?: # 7-bit CSI, ESC [ 
-                \x1B\[
-            |   # 8-bit CSI, 9B
-                \x9B
-            )
-            [0-?]*  # Parameter bytes
-            [ -/]*  # Intermediate bytes
-            [@-~]   # Final byte
+ansiEscapeRe = re.compile(br'''
+    (?: # either 7-bit C1, two bytes, ESC Fe (omitting CSI)
+        \x1B
+        [@-Z\\-_]
+    |   # or a single 8-bit byte Fe (omitting CSI)
+        [\x80-\x9A\x9C-\x9F]
+    |   # or CSI + control codes
+        (?: # 7-bit CSI, ESC [
+            \x1B\[
+        |   # 8-bit CSI, 9B
+            \x9B
         )
-    ''', re.VERBOSE)
-    return ansi_escape_8bit.sub(b'', inString)
+        [0-?]*  # Parameter bytes
+        [ -/]*  # Intermediate bytes
+        [@-~]   # Final byte
+    )
+''', re.VERBOSE)
+
+# any byte that could start an escape sequence; most lines have none, and can skip the substitution entirely
+ansiCandidateRe = re.compile(br'[\x1B\x80-\x9F]')
 
+def strip_ansi(inString):
+    if(not ansiCandidateRe.search(inString)):
+        return inString
+    return ansiEscapeRe.sub(b'', inString)
+
+
+# assembles a stream of data from the game into lines.  the data is kept in one buffer, with a note of how far
+# it's been searched for a newline, so a long unfinished line isn't copied or searched again each time more arrives.
+# carriage returns are dropped, as the game ends its lines with CR-LF
+class LineFramer:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.scanned = 0
+
+    def __len__(self):
+        return len(self.buffer)
+
+    # add data; returns the lines it completed, without their line endings
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        eol = buf.rfind(b'\n', self.scanned)
+        if(eol < 0):
+            self.scanned = len(buf)
+            return []
+        # everything up to the last newline is split in one go, then dropped from the buffer
+        with memoryview(buf) as view:
+            complete = view[:eol].tobytes()
+        del buf[:eol + 1]
+        self.scanned = len(buf)
+        if(b'\r' in complete):
+            complete = complete.replace(b'\r', b'')
+        return complete.split(b'\n')
+
+    # the unfinished line at the end of the data so far
+    def partial(self):
+        return bytes(self.buffer).replace(b'\r', b'')
+
+    def clear(self):
+        del self.buffer[:]
+        self.scanned = 0
 
 def log(logLevel, msg):
     global verbose
@@ -122,111 +176,251 @@ def dbWriteWrapper(func):
         return func(*args)
     return func_dbWriteWrapper
 
+# writes waiting for the next commit, as [table, sql, rows].  consecutive writes with the same SQL are merged so they
+# can go out in a single executemany; a write can also be merged past writes to other tables, since their order
+# relative to each other doesn't matter
+pending_writes = []
+pending_rows = 0
+pending_since = None
+
+# commit once this many rows are waiting, or the oldest has been waiting this many seconds
+DB_BATCH_ROWS = 1000
+DB_BATCH_SECONDS = 0.2
+
+# running totals, to report write throughput
+write_stats = {'rows': 0, 'transactions': 0, 'seconds': 0.0, 'skipped': 0}
+
+# what the database holds for the tables every scan rewrites, so rows that haven't changed needn't be written again.
+# loaded when the database is opened, and only touched by the database thread after that
+class DatabaseMirror:
+    def __init__(self, database):
+        self.warps = {}
+        for source, destination in database.execute('SELECT source, destination FROM warps'):
+            self.warps.setdefault(source, set()).add(destination)
+        self.explored = set(row[0] for row in database.execute('SELECT sector FROM explored'))
+        self.ports = {}
+        for row in database.execute('SELECT sector, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct, last_seen FROM ports'):
+            self.ports[row[0]] = tuple(row)
+        self.fighters = set(row[0] for row in database.execute('SELECT sector FROM fighters'))
+        # the sectors listed since the last fighter scan header, and whether the scan has changed since we last looked
+        self.fighter_scan = None
+        self.fighter_scan_dirty = False
+        self.skipped = 0
+
+    def add_explored(self, sector):
+        if(sector in self.explored):
+            self.skipped += 1
+            return False
+        self.explored.add(sector)
+        return True
+
+    # returns the warps that are new
+    def add_warps(self, warps):
+        new = []
+        for source, destination in warps:
+            known = self.warps.setdefault(source, set())
+            if(destination in known):
+                self.skipped += 1
+            else:
+                known.add(destination)
+                new.append((source, destination))
+        return new
+
+    # row is the port as it would appear in the ports table, with last_seen as a date
+    def update_port(self, row):
+        if(self.ports.get(row[0]) == row):
+            self.skipped += 1
+            return False
+        self.ports[row[0]] = row
+        return True
+
+    def start_fighter_scan(self):
+        self.fighter_scan = set()
+        self.fighter_scan_dirty = True
+
+    def add_fighter(self, sector):
+        if(self.fighter_scan is not None):
+            self.fighter_scan.add(sector)
+            self.fighter_scan_dirty = True
+        if(sector in self.fighters):
+            self.skipped += 1
+            return False
+        self.fighters.add(sector)
+        return True
+
+    # the fighters the scan so far no longer lists.  called at each commit: a scan split across commits leaves the
+    # table in the same state at each commit as deleting everything at the header would have
+    def finish_fighter_scan(self):
+        if(not self.fighter_scan_dirty):
+            return []
+        self.fighter_scan_dirty = False
+        gone = self.fighters - self.fighter_scan
+        self.fighters = set(self.fighter_scan)
+        return sorted(gone)
+
+mirror = None
+
+def queue_write(table, sql, rows):
+    global pending_rows
+    global pending_since
+    if(len(rows) == 0):
+        return
+    if(pending_since is None):
+        pending_since = time.time()
+    pending_rows += len(rows)
+    for entry in reversed(pending_writes):
+        if(entry[1] == sql):
+            entry[2].extend(rows)
+            return
+        if(entry[0] == table):
+            break
+    pending_writes.append([table, sql, list(rows)])
+
+def flush_writes():
+    global database
+    global pending_writes
+    global pending_rows
+    global pending_since
+    skipped = 0
+    if(mirror is not None):
+        gone = mirror.finish_fighter_scan()
+        if(len(gone)):
+            queue_write('fighters', 'DELETE FROM fighters WHERE sector = ?', [(sector,) for sector in gone])
+        skipped = mirror.skipped
+        mirror.skipped = 0
+        write_stats['skipped'] += skipped
+    if(len(pending_writes) == 0):
+        if(skipped):
+            log(1, "flush_writes: nothing changed, {} unchanged rows skipped".format(skipped))
+        pending_since = None
+        return
+    start = time.time()
+    c = database.cursor()
+    try:
+        for table, sql, rows in pending_writes:
+            c.executemany(sql, rows)
+        database.commit()
+    except sqlite3.Error:
+        # don't lose the whole batch to one bad row; retry them one by one
+        traceback.print_exc()
+        database.rollback()
+        for table, sql, rows in pending_writes:
+            for row in rows:
+                try:
+                    c.execute(sql, row)
+                except sqlite3.Error:
+                    log(1, "flush_writes: failed {} {}".format(sql.strip(), row))
+        database.commit()
+    elapsed = time.time() - start
+    write_stats['rows'] += pending_rows
+    write_stats['transactions'] += 1
+    write_stats['seconds'] += elapsed
+    log(1, "flush_writes: {} rows in {:.1f}ms, {} unchanged rows skipped".format(pending_rows, elapsed * 1000, skipped))
+    pending_writes = []
+    pending_rows = 0
+    pending_since = None
+
+# PRAGMA synchronous level for the writer; trade durability for speed with e.g.
+#   sqlite3 tw2002.db "insert into settings (key, value) values('db_synchronous', 'OFF')"
+def synchronous_level():
+    level = str(settings.get('db_synchronous', 'NORMAL')).upper()
+    if(level not in ('OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3')):
+        level = 'NORMAL'
+    return level
+
+def write_throughput():
+    rate = 0
+    if(write_stats['seconds'] > 0):
+        rate = write_stats['rows'] / write_stats['seconds']
+    return "{} rows in {} transactions, {:.3f}s writing ({:.0f} rows/s), {} unchanged rows skipped".format(
+            write_stats['rows'], write_stats['transactions'], write_stats['seconds'], rate, write_stats['skipped'])
+
 @dbWriteWrapper
 def clear_fighter_locations():
-    global database
+    global pending_since
     log(1, "clear_fighter_locations")
-    c = database.cursor()
-    c.execute('DELETE FROM fighters')
-    database.commit()
+    if(mirror is None):
+        queue_write('fighters', 'DELETE FROM fighters', [()])
+        return
+    # the fighters the scan doesn't list are deleted when it's committed
+    mirror.start_fighter_scan()
+    if(pending_since is None):
+        pending_since = time.time()
 
 @dbWriteWrapper
 def save_fighter_location(match):
-    global database
     sector = int(match.group('sector').strip())
     log(1, "save_fighter_location: {}".format(sector))
-
-    c = database.cursor()
-    c.execute('REPLACE INTO fighters (sector) VALUES(?)', (sector,))
-    database.commit()
+    if(mirror is None or mirror.add_fighter(sector)):
+        queue_write('fighters', 'REPLACE INTO fighters (sector) VALUES(?)', [(sector,)])
 
 @dbWriteWrapper
 def save_setting(key,value):
-    global database
+    queue_write('settings', 'REPLACE INTO settings (key, value) VALUES(?, ?)', [(key, value)])
 
-    c = database.cursor()
-    c.execute('REPLACE INTO settings (key, value) VALUES(?, ?)', (key, value))
-    database.commit()
+def save_warps(warps):
+    if(mirror is not None):
+        warps = mirror.add_warps(warps)
+    queue_write('warps', 'REPLACE INTO warps (source, destination) VALUES(?, ?)', warps)
 
 @dbWriteWrapper
 def save_warp_list(match):
-    global database
     sector = int(match.group('sector').strip())
     warps = re.findall('[0-9]+', match.group('warps'))
     log(1, "save_warp_list: {}, {}".format(sector, warps))
-    c = database.cursor()
-    c.execute('''
-        REPLACE into explored (sector)
-        VALUES(?)
-        ''', (sector,))
-    for warp in warps:
-        c.execute('''
-            REPLACE INTO warps (source, destination)
-            VALUES(?, ?)
-            ''', (sector, int(warp))
-        )
-    database.commit()
+    if(mirror is None or mirror.add_explored(sector)):
+        queue_write('explored', 'REPLACE INTO explored (sector) VALUES(?)', [(sector,)])
+    save_warps([(sector, int(warp)) for warp in warps])
 
 @dbWriteWrapper
 def save_port_list(match):
-    global database
     log(1, "save_port_list: {}".format(match.groups()))
     port_class = (match.group('ore_bs') + match.group('org_bs') + match.group('equ_bs')).replace(' ', 'S').replace('-', 'B')
+    sector = int(match.group('sector').strip())
+    port = (
+        port_class,
+        int(match.group('ore_amt').strip()),
+        int(match.group('ore_pct').strip()),
+        int(match.group('org_amt').strip()),
+        int(match.group('org_pct').strip()),
+        int(match.group('equ_amt').strip()),
+        int(match.group('equ_pct').strip()),
+        )
+    ts = int(time.time())
+    if(mirror is not None and not mirror.update_port((sector,) + port + (time.strftime('%Y-%m-%d', time.gmtime(ts)),))):
+        return
 
-    c = database.cursor()
-    c.execute('''
-        REPLACE INTO ports (sector, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct, last_seen)
-        VALUES(?, ?, ?, ?, ?, ?, ?, ?, date('now'))
-        ''', (
-            int(match.group('sector').strip()),
-            port_class,
-            int(match.group('ore_amt').strip()),
-            int(match.group('ore_pct').strip()),
-            int(match.group('org_amt').strip()),
-            int(match.group('org_pct').strip()),
-            int(match.group('equ_amt').strip()),
-            int(match.group('equ_pct').strip()),
-            )
+    # the triggers on port_observations drop it if nothing changed, and keep the ports table up to date
+    queue_write('port_observations', """
+        INSERT OR REPLACE INTO port_observations (sector, ts, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct)
+        VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, [(sector, ts) + port]
     )
-    database.commit()
 
 @dbWriteWrapper
 def save_planet_list(match):
-    global database
     log(1, "save_planet_list: {}".format(match.groups()))
-    c = database.cursor()
 
     citadel = match.group('citadel').strip()[-1]
     if(citadel == 'l'): # "No Citadel"
         citadel = '0'
-    c.execute('''
+    queue_write('planets', """
         REPLACE INTO planets (sector, id, name, class, citadel)
         VALUES(?, ?, ?, ?, ?)
-        ''', (
+        """, [(
             int(match.group('sector').strip()),
             int(match.group('id').strip()),
             match.group('name').strip(),
             match.group('class').strip(),
             int(citadel)
-            )
+            )]
     )
-    database.commit()
 
 @dbWriteWrapper
 def save_route_list(match):
-    global database
     route = re.findall('[0-9]+', match.group('route'))
     log(1, "save_route_list: {}".format(route))
-
-    c = database.cursor()
-    for i in range(len(route)-1):
-        # print(route[i], route[i+1])
-        c.execute('''
-            REPLACE INTO warps (source, destination)
-            VALUES(?, ?)
-            ''', (int(route[i]), int(route[i+1]))
-        )
-    database.commit()
+    save_warps([(int(route[i]), int(route[i+1])) for i in range(len(route)-1)])
 
 
 def parse_partial_line(line):
@@ -237,6 +431,8 @@ def parse_partial_line(line):
     except:
         return
     log(3, "parse_partial_line: {}".format((strippedLine,)))
+    for listener in line_listeners:
+        listener(strippedLine, True)
 
     portPrompt = portPromptRe.match(strippedLine)
     if(portPrompt):
@@ -244,6 +440,7 @@ def parse_partial_line(line):
         log(1, portPrompt)
         our_offer = their_offer
         if(port_status.prev_their_offer == None):
+            port_status.trades += 1
             if(port_status.operation == 'sell'):
                 if(port_status.source == 'planet'):
                     our_offer = math.ceil(our_offer / 0.94) - 1
@@ -263,6 +460,7 @@ def parse_partial_line(line):
         port_status.prev_their_offer = their_offer
         port_status.prev_our_offer = our_offer
         port_status.final_offer = False
+        port_status.offers += 1
         return('{}'.format(int(our_offer)).encode('utf-8'))
 
     bbsNameEntry = bbsNameEntryRe.match(strippedLine)
@@ -283,91 +481,117 @@ def parse_partial_line(line):
         del settings['twgs_game_pass']
         return('{}'.format(val).encode('utf-8'))
 
-def parse_complete_line(line):
+# handlers for the patterns matched by parse_complete_line
+def on_working_sector(match):
+    settings['working_sector'] = int(match.group('sector'))
+
+def on_stardock(match):
+    log(2, "stardock: {}".format(match))
+    sd = int(match.group('sector').replace(',',''))
+    if(not 'stardock' in settings or settings['stardock'] != sd):
+        settings['stardock'] = sd
+        save_setting('stardock', sd)
+
+def on_max_sector(match):
+    log(2, "maxSector: {}".format(match))
+    max_sector = int(match.group('maxSector').replace(',',''))
+    if(not 'max_sector' in settings or settings['max_sector'] != max_sector):
+        settings['max_sector'] = max_sector
+        save_setting('max_sector', max_sector)
+
+def on_port_operation(match):
+    log(2, "portOperation: {}".format(match))
+    if(match.group('planetOrShip') == 'units'):
+        port_status.source = 'planet'
+    port_status.operation = match.group('operation')
+    port_status.prev_their_offer = None
+
+def on_port_units(match):
+    log(2, "portUnits: {}".format(match))
+    port_status.units = int(match.group('units'))
+
+def on_port_final_offer(match):
+    log(2, "portFinalOffer: {}".format(match))
+    port_status.final_offer = True
+
+def on_clear_fighters(match):
+    log(2, "clearFighters: {}".format(match))
+    clear_fighter_locations()
+
+def on_save_fighters(match):
+    log(2, "saveFighters: {}".format(match))
+    save_fighter_location(match)
+
+def on_warp_list(match):
+    save_warp_list(match)
+
+def on_port_list(match):
+    save_port_list(match)
+
+def on_planet_list(match):
+    log(2, "planetList: {}".format(match.groups()))
+    save_planet_list(match)
+
+def on_route_complete(match):
+    save_route_list(match)
+    route = re.findall('[0-9]+', match.group('route'))
+    if(len(route)):
+        try:
+            routes_saved.put_nowait((int(route[0]), int(route[-1])))
+        except queue.Full:
+            pass
+
+# route listings are multi-line.  accumulate the lines, then we'll process it once it's complete
+def on_route_from(match):
+    global routeList
+    routeList = match.string
+
+# the patterns that could match a line, keyed on its first non-blank character (all digits share the key '0').
+# a line is only tried against the handful of patterns for its key, in the same order they were always checked.
+# each entry is (pattern, handler, stop), where stop means a matching line needs no further parsing
+completeLineHandlers = {
+    'S': ((workingSectorRe, on_working_sector, True), (warpListFromCIRe, on_warp_list, True)),
+    'T': ((stardockRe, on_stardock, True),),
+    'M': ((maxSectorRe, on_max_sector, True),),
+    'H': ((portOperationRe, on_port_operation, True),),
+    'A': ((portUnitsRe, on_port_units, True),),
+    'O': ((portFinalOfferRe, on_port_final_offer, True),),
+    'D': ((clearFightersRe, on_clear_fighters, True),),
+    '0': ((saveFightersRe, on_save_fighters, False), (warpListFromCIMRe, on_warp_list, True), (portListRe, on_port_list, True), (planetListRe, on_planet_list, False)),
+}
+
+# checked after any multi-line route has been accumulated
+routeLineHandlers = {
+    'F': ((routeListCompleteCIMRe, on_route_complete, True), (routeListFromCIMRe, on_route_from, True)),
+    'T': ((routeListCompleteCFRe, on_route_complete, True), (routeListFromCFRe, on_route_from, True)),
+}
+
+def line_key(strippedLine):
+    key = strippedLine.lstrip()[:1]
+    if(key.isdigit()):
+        return '0'
+    return key
+
+# with route_only, the line is only used to finish off a route listing in progress: other patterns are still matched,
+# so the route is accumulated exactly as it would be, but their handlers aren't called
+def parse_complete_line(line, route_only=False):
     global routeList
-    global port_status
     try:
         strippedLine = strip_ansi(line).decode('utf-8').rstrip()
     except:
         return
-    log(3, "parse_complete_line: {}".format((strippedLine,)))
-
-    workingSector = workingSectorRe.match(strippedLine)
-    if(workingSector):
-        settings['working_sector'] = int(workingSector.group('sector'))
-        return
-
-    stardock = stardockRe.match(strippedLine)
-    if(stardock):
-        log(2, "stardock: {}".format(stardock))
-        sd = int(stardock.group('sector').replace(',',''))
-        if(not 'stardock' in settings or settings['stardock'] != sd):
-            settings['stardock'] = sd
-            save_setting('stardock', sd)
-        return
-
-    maxSector = maxSectorRe.match(strippedLine)
-    if(maxSector):
-        log(2, "maxSector: {}".format(maxSector))
-        max_sector = int(maxSector.group('maxSector').replace(',',''))
-        if(not 'max_sector' in settings or settings['max_sector'] != max_sector):
-            settings['max_sector'] = max_sector
-            save_setting('max_sector', max_sector)
-        return
-
-    portOperation = portOperationRe.match(strippedLine)
-    if(portOperation):
-        log(2, "portOperation: {}".format(portOperation))
-        if(portOperation.group('planetOrShip') == 'units'):
-            port_status.source = 'planet'
-        port_status.operation = portOperation.group('operation')
-        port_status.prev_their_offer = None
-        return
-
-    portUnits = portUnitsRe.match(strippedLine)
-    if(portUnits):
-        log(2, "portUnits: {}".format(portUnits))
-        port_status.units = int(portUnits.group('units'))
-        return
-
-    portFinalOffer = portFinalOfferRe.match(strippedLine)
-    if(portFinalOffer):
-        log(2, "portFinalOffer: {}".format(portFinalOffer))
-        port_status.final_offer = True
-        return
-
-    clearFighters = clearFightersRe.match(strippedLine)
-    if(clearFighters):
-        log(2, "clearFighters: {}".format(clearFighters))
-        clear_fighter_locations()
-        return
-
-    saveFighters = saveFightersRe.match(strippedLine)
-    if(saveFighters):
-        log(2, "saveFighters: {}".format(saveFighters))
-        save_fighter_location(saveFighters)
-
-    warpList = warpListFromCIMRe.match(strippedLine)
-    if(warpList):
-        # print(strippedLine, warpList.groups())
-        save_warp_list(warpList)
-        return
-
-    warpList = warpListFromCIRe.match(strippedLine)
-    if(warpList):
-        save_warp_list(warpList)
-        return
-
-    portList = portListRe.match(strippedLine)
-    if(portList):
-        # print(strippedLine, portList.groups())
-        save_port_list(portList)
-        return
-
-    planetList = planetListRe.match(strippedLine)
-    if(planetList):
-        log(2, "planetList: {}".format(planetList.groups()))
-        save_planet_list(planetList)
+    if(verbose >= 3):
+        log(3, "parse_complete_line: {}".format((strippedLine,)))
+    for listener in line_listeners:
+        listener(strippedLine, False)
+
+    for regex, handler, stop in completeLineHandlers.get(line_key(strippedLine), ()):
+        match = regex.match(strippedLine)
+        if(match):
+            if(not route_only):
+                handler(match)
+            if(stop):
+                return
 
     if(routeList): # we've already seen the "FM" line, let's look for the rest of the message
         if(len(strippedLine) == 0):
@@ -379,42 +603,53 @@ def parse_complete_line(line):
             else:
                 routeList = None
 
-    routeListComplete = routeListCompleteCIMRe.match(strippedLine)
-    if(routeListComplete):
-        save_route_list(routeListComplete)
-        route_saved.set()
-        return
-    routeListComplete = routeListCompleteCFRe.match(strippedLine)
-    if(routeListComplete):
-        save_route_list(routeListComplete)
-        route_saved.set()
-        return
- 
-    # route listings are multi-line.  accumulate the lines, then we'll process it once it's complete
-    routeListFrom = routeListFromCIMRe.match(strippedLine)
-    if(routeListFrom):
-        routeList = strippedLine
-        return
-    routeListFrom = routeListFromCFRe.match(strippedLine)
-    if(routeListFrom):
-        routeList = strippedLine
-        return
+    for regex, handler, stop in routeLineHandlers.get(line_key(strippedLine), ()):
+        match = regex.match(strippedLine)
+        if(match):
+            handler(match)
+            if(stop):
+                return
 
 def dbqueue_service(dbname):
     global database
     global dbqueue
-    global QUITTING_TIME
     global DB_THREAD_ID
 
     DB_THREAD_ID = threading.get_ident()
 
     database = sqlite3.connect(dbname)
+    database.execute('PRAGMA journal_mode=WAL')
+    database.execute('PRAGMA synchronous={}'.format(synchronous_level()))
 
-    doFlash = False
     didWork = 0
     while(True):
+        # sleep until there's work, or until the oldest uncommitted write is due
+        timeout = None
+        if(pending_since is not None):
+            timeout = max(0, pending_since + DB_BATCH_SECONDS - time.time())
+        try:
+            item = dbqueue.get(timeout=timeout)
+        except queue.Empty:
+            flush_writes()
+            if(didWork > 1):
+                # if we had a queue, flash the screen to indicate that all database operations are complete
+                try:
+                    print("\x1b[?5h\x1b[?5l", flush=True, end='')
+                except:
+                    pass
+            didWork = 0
+            continue
+
+        if(item is None):
+            break
+        if(isinstance(item, threading.Event)):
+            # someone is waiting in flush() for everything queued before this point to be committed
+            flush_writes()
+            item.set()
+            continue
+
         try:
-            func, *args = dbqueue.get(block=False)
+            func, *args = item
             if(len(args)):
                 logStr = "dbqueue_service: {}({})".format(func.__name__, *args)
                 try:
@@ -428,40 +663,253 @@ def dbqueue_service(dbname):
                 log(1, "dbqueue_service: {}()".format(func.__name__))
                 func()
             didWork += 1
-        except queue.Empty:
-            if(didWork):
-                if(didWork > 1):
-                    # if we had a queue, flash the screen to indicate that all database operations are complete
-                    doFlash = True
-                didWork = 0
-            if(QUITTING_TIME):
-                break
-            time.sleep(1)
+            if(pending_rows >= DB_BATCH_ROWS):
+                flush_writes()
         except Exception:
             traceback.print_exc()
-        if(doFlash):
-            try:
-                # flash
-                print("\x1b[?5h\x1b[?5l", flush=True, end='')
-            except:
-                pass
-            doFlash = False
+
+    flush_writes()
+    if(write_stats['rows'] or write_stats['skipped']):
+        print("Database writes: {}".format(write_throughput()), flush=True)
 
 
 def dbqueue_monitor():
     global dbqueue
-    global QUITTING_TIME
 
-    cnt = 0
-    while(True):
-        cnt += 1
-        if((cnt % 10) == 0):
-            log(1, "dbqueue_monitor: {} queued items".format(dbqueue.qsize()))
-        if(QUITTING_TIME):
-            break
-        time.sleep(1)
+    while(not shutting_down.wait(10)):
+        log(1, "dbqueue_monitor: {} queued items".format(dbqueue.qsize()))
+
+# block until everything queued so far has been committed to the database.  returns False if the timeout expired first
+def flush(timeout=None):
+    if(threading.get_ident() == DB_THREAD_ID):
+        flush_writes()
+        return True
+    done = threading.Event()
+    dbqueue.put(done)
+    return done.wait(timeout)
+
+# bulk ingest of log files: each file is split on line boundaries into chunks that are parsed by a pool of worker
+# processes.  a worker runs the ordinary parser with itself as the database thread, so the writes it would have
+# queued collect in its pending_writes; those are handed back and applied in file order by a single writer
+BULK_CHUNK_BYTES = 4 * 1024 * 1024
+
+def bulk_chunks(filename, chunk_size=BULK_CHUNK_BYTES):
+    size = os.path.getsize(filename)
+    if(size == 0):
+        return []
+    chunks = []
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = 0
+        while(start < size):
+            end = m.find(b'\n', min(start + chunk_size, size) - 1)
+            end = size if end < 0 else end + 1
+            chunks.append((filename, start, end))
+            start = end
+        m.close()
+    return chunks
+
+def bulk_parse_chunk(chunk):
+    global DB_THREAD_ID
+    global routeList
+    global pending_writes
+    global pending_rows
+    global pending_since
+    global mirror
+    filename, start, end = chunk
+    DB_THREAD_ID = threading.get_ident()
+    # each worker only sees part of the log, so it can't tell which rows are unchanged; write everything
+    mirror = None
+    routeList = None
+    pending_writes = []
+    pending_rows = 0
+    pending_since = None
+
+    with open(filename, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(m)
+        pos = start
+        while(pos < end):
+            eol = m.find(b'\n', pos, end)
+            eol = end if eol < 0 else eol + 1
+            parse_complete_line(m[pos:eol])
+            pos = eol
+        # a route listing that runs past the end of the chunk is finished here; the next chunk's worker sees the
+        # rest of it without the "FM" line, and ignores it
+        while(routeList and pos < size):
+            eol = m.find(b'\n', pos)
+            eol = size if eol < 0 else eol + 1
+            parse_complete_line(m[pos:eol], route_only=True)
+            pos = eol
+        m.close()
+    return pending_writes
+
+def bulk_ingest(dbname, filenames, processes=1, chunk_size=BULK_CHUNK_BYTES):
+    start = time.time()
+    database_init(dbname)
+    chunks = []
+    for filename in filenames:
+        chunks.extend(bulk_chunks(filename, chunk_size))
+
+    database = sqlite3.connect(dbname, isolation_level=None)
+    database.execute('PRAGMA journal_mode=WAL')
+    c = database.cursor()
+    c.execute('BEGIN')
+    # rebuilding the secondary indexes and sector_degree once at the end is much faster than updating them row by
+    # row.  the triggers on port_observations stay, as they decide which observations are kept
+    indexes = c.execute("SELECT type, name, sql FROM sqlite_master WHERE (type = 'index' OR (type = 'trigger' AND tbl_name = 'warps')) AND sql IS NOT NULL").fetchall()
+    for kind, name, sql in indexes:
+        c.execute('DROP {} "{}"'.format(kind.upper(), name))
+
+    rows = 0
+    pool = None
+    if(processes > 1 and len(chunks) > 1):
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap(bulk_parse_chunk, chunks)
+    else:
+        results = map(bulk_parse_chunk, chunks)
+    try:
+        for writes in results:
+            for table, sql, table_rows in writes:
+                c.executemany(sql, table_rows)
+                rows += len(table_rows)
+    finally:
+        if(pool):
+            pool.close()
+            pool.join()
 
-def database_connect(dbname):
+    if(any(name == 'warps_degree_insert' for kind, name, sql in indexes)):
+        rebuild_sector_degree(c)
+    for kind, name, sql in indexes:
+        c.execute(sql)
+    c.execute('COMMIT')
+    database.close()
+
+    elapsed = time.time() - start
+    size = sum(end - begin for filename, begin, end in chunks)
+    print("Bulk ingest: {} bytes in {} chunks, {} rows written in {:.2f}s ({:.1f} MB/s)".format(size, len(chunks), rows, elapsed, size / elapsed / 1e6 if elapsed else 0))
+
+
+# the number of warps into and out of each sector, from scratch
+def rebuild_sector_degree(cursor):
+    cursor.execute('DELETE FROM sector_degree')
+    cursor.execute('''
+            INSERT INTO sector_degree (sector, warps_out, warps_in)
+            SELECT sector, sum(warps_out), sum(warps_in)
+            FROM (
+                SELECT source AS sector, count(*) AS warps_out, 0 AS warps_in FROM warps GROUP BY source
+                UNION ALL
+                SELECT destination, 0, count(*) FROM warps GROUP BY destination
+                )
+            GROUP BY sector
+            ''')
+
+def migration_warps_destination_index(cursor):
+    cursor.execute('CREATE INDEX IF NOT EXISTS warps_destination ON warps (destination, source)')
+
+# sector_degree holds the number of warps into and out of each sector, so dead ends can be looked up instead of
+# counted.  the triggers recount a sector's warps rather than adding or subtracting one, so they stay right when a
+# REPLACE overwrites a warp that was already there (which doesn't fire the delete trigger).  they delete and insert
+# rather than REPLACE, as an OR IGNORE on the statement that fired them would turn their REPLACE into an IGNORE
+def migration_sector_degree(cursor):
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sector_degree (
+                sector INTEGER PRIMARY KEY,
+                warps_out INTEGER NOT NULL,
+                warps_in INTEGER NOT NULL
+            );
+            ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS sector_degree_counts ON sector_degree (warps_out, warps_in)')
+    rebuild_sector_degree(cursor)
+    for trigger, event, row in (('warps_degree_insert', 'INSERT', 'NEW'), ('warps_degree_delete', 'DELETE', 'OLD')):
+        cursor.execute('''
+                CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} ON warps
+                BEGIN
+                    DELETE FROM sector_degree WHERE sector = {row}.source;
+                    INSERT INTO sector_degree (sector, warps_out, warps_in) VALUES (
+                        {row}.source,
+                        (SELECT count(*) FROM warps WHERE source = {row}.source),
+                        (SELECT count(*) FROM warps WHERE destination = {row}.source));
+                    DELETE FROM sector_degree WHERE sector = {row}.destination;
+                    INSERT INTO sector_degree (sector, warps_out, warps_in) VALUES (
+                        {row}.destination,
+                        (SELECT count(*) FROM warps WHERE source = {row}.destination),
+                        (SELECT count(*) FROM warps WHERE destination = {row}.destination));
+                END;
+                '''.format(trigger=trigger, event=event, row=row))
+
+# every port report seen, oldest first, so we can tell how fast ports regenerate.  ts is seconds since the epoch.  a
+# report identical to the port's last one isn't kept, it only brings the port's last_seen up to date; otherwise the
+# ports table is updated to match, so it always holds the latest report for each port.  (like the sector_degree
+# triggers, it deletes and inserts so an OR IGNORE on the insert that fired it can't stop it)
+def migration_port_observations(cursor):
+    cursor.execute('''
+            CREATE TABLE IF NOT EXISTS port_observations (
+                sector INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                class TEXT,
+                ore_amt INTEGER,
+                ore_pct INTEGER,
+                org_amt INTEGER,
+                org_pct INTEGER,
+                equ_amt INTEGER,
+                equ_pct INTEGER,
+                PRIMARY KEY (sector, ts)
+            ) WITHOUT ROWID;
+            ''')
+    cursor.execute('''
+            INSERT OR IGNORE INTO port_observations (sector, ts, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct)
+            SELECT sector, coalesce(CAST(strftime('%s', last_seen) AS INTEGER), 0), class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct
+            FROM ports
+            ''')
+    cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS port_observations_unchanged BEFORE INSERT ON port_observations
+            WHEN (
+                SELECT class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct
+                FROM port_observations
+                WHERE sector = NEW.sector
+                ORDER BY ts DESC
+                LIMIT 1
+                ) IS (NEW.class, NEW.ore_amt, NEW.ore_pct, NEW.org_amt, NEW.org_pct, NEW.equ_amt, NEW.equ_pct)
+            BEGIN
+                UPDATE ports SET last_seen = max(last_seen, date(NEW.ts, 'unixepoch')) WHERE sector = NEW.sector;
+                SELECT RAISE(IGNORE);
+            END;
+            ''')
+    cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS port_observations_latest AFTER INSERT ON port_observations
+            WHEN NEW.ts >= (SELECT max(ts) FROM port_observations WHERE sector = NEW.sector)
+            BEGIN
+                DELETE FROM ports WHERE sector = NEW.sector;
+                INSERT INTO ports (sector, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct, last_seen)
+                VALUES (NEW.sector, NEW.class, NEW.ore_amt, NEW.ore_pct, NEW.org_amt, NEW.org_pct, NEW.equ_amt, NEW.equ_pct, date(NEW.ts, 'unixepoch'));
+            END;
+            ''')
+
+# schema changes for databases made by older versions, applied in order.  PRAGMA user_version holds how many of
+# them a database has had; only ever add to the end of this list
+MIGRATIONS = [
+    migration_warps_destination_index,
+    migration_sector_degree,
+    migration_port_observations,
+]
+
+def migrate(database):
+    for number, migration in enumerate(MIGRATIONS, 1):
+        database.execute('BEGIN IMMEDIATE')
+        if(database.execute('PRAGMA user_version').fetchone()[0] >= number):
+            database.rollback()
+            continue
+        log(1, "migrate: {}".format(migration.__name__))
+        cursor = database.cursor()
+        migration(cursor)
+        cursor.execute('PRAGMA user_version = {}'.format(number))
+        cursor.close()
+        database.commit()
+
+# create any missing tables and load the saved settings
+def database_init(dbname):
+    global mirror
     initdb = sqlite3.connect(dbname)
 
     cursor = initdb.cursor()
@@ -528,9 +976,17 @@ def database_connect(dbname):
     cursor.close()
     initdb.commit()
 
+    migrate(initdb)
+    mirror = DatabaseMirror(initdb)
+
     del cursor
     del initdb
 
+def database_connect(dbname):
+    global database_name
+    database_name = dbname
+    database_init(dbname)
+
     # pool = ThreadPool(processes=1)
     # pool.apply_async(dbqueue_service, (dbname,))
 
@@ -547,11 +1003,11 @@ def database_connect(dbname):
 
 def quit():
     global dbqueue
-    global QUITTING_TIME
 
     if(dbqueue.qsize() > 0):
         print("Parsing complete.\nWaiting for database writes to finish...")
-    QUITTING_TIME = True
+    shutting_down.set()
+    dbqueue.put(None)
 
 
 if(__name__ == '__main__'):
@@ -559,17 +1015,29 @@ if(__name__ == '__main__'):
         parser = argparse.ArgumentParser(description='A TW2002 log parsing utility.  This tool will database ports, warps, and the locations of your fighters and planets for use with analytical tools.')
         parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
         parser.add_argument('--verbose', '-v', type=int, nargs='?', default=0, help='Verbose level for parser feedback (1-3)')
+        parser.add_argument('--bulk', '-b', action='store_true', help='Parse the files in parallel and write everything in one transaction; much faster for large logs')
+        parser.add_argument('--processes', '-j', type=int, default=multiprocessing.cpu_count(), help='Number of worker processes for --bulk; default one per CPU')
         parser.add_argument('filename', nargs='+', type=argparse.FileType('rb'), help='Name of the game log file(s) to parse')
 
         args = parser.parse_args()
 
         verbose = args.verbose
 
+        if(args.bulk):
+            for f in args.filename:
+                f.close()
+            bulk_ingest(args.db, [f.name for f in args.filename], processes=args.processes)
+            sys.exit(0)
+
         database_connect(args.db)
 
         for f in args.filename:
-            for line in f:
-                parse_complete_line(line)
+            framer = LineFramer()
+            for block in iter(lambda: f.read(65536), b''):
+                for line in framer.feed(block):
+                    parse_complete_line(line)
+            if(len(framer)):
+                parse_complete_line(framer.partial())
     finally:
         quit()
 
@@ -3,14 +3,237 @@
 import sqlite3
 import argparse
 import re
+import os
+import copy
+from array import array
+from collections import deque
 
 database = None
+database_name = None
 DEFAULT_DB_NAME = 'tw2002.db'
 
+# query results kept until the database changes, so a long-running process (see twdaemon.py) doesn't reload them
+cache = {}
+
+# in-memory copy of the warps table, loaded on first use
+graph = None
+
+# compact adjacency lists of the sector map, stored CSR-style: the warps out of sector S are
+# targets[offsets[S]:offsets[S+1]], for both the forward (source -> destination) and reverse directions
+class SectorGraph:
+    size = 0
+    fwd_offsets = None
+    fwd_targets = None
+    rev_offsets = None
+    rev_targets = None
+
+    def __init__(self, edges):
+        edges = list(dict.fromkeys((int(s), int(d)) for s, d in edges))
+        for s, d in edges:
+            if(s >= self.size):
+                self.size = s + 1
+            if(d >= self.size):
+                self.size = d + 1
+        # warps out of a sector are kept in ascending order; warps into a sector keep the order they were given in
+        self.fwd_offsets, self.fwd_targets = self._build(sorted(edges))
+        self.rev_offsets, self.rev_targets = self._build(sorted(((d, s) for s, d in edges), key=lambda e: e[0]))
+
+    def _build(self, pairs):
+        offsets = array('I', bytes(4 * (self.size + 1)))
+        for a, b in pairs:
+            offsets[a + 1] += 1
+        for i in range(self.size):
+            offsets[i + 1] += offsets[i]
+        targets = array('I', (b for a, b in pairs))
+        return offsets, targets
+
+    def adjacency(self, reverse=False):
+        if(reverse):
+            return self.rev_offsets, self.rev_targets
+        return self.fwd_offsets, self.fwd_targets
+
+    def warps_from(self, sector):
+        if(sector < 0 or sector >= self.size):
+            return []
+        return self.fwd_targets[self.fwd_offsets[sector]:self.fwd_offsets[sector + 1]].tolist()
+
+    def warps_to(self, sector):
+        if(sector < 0 or sector >= self.size):
+            return []
+        return self.rev_targets[self.rev_offsets[sector]:self.rev_offsets[sector + 1]].tolist()
+
+    def sectors(self):
+        offsets = self.fwd_offsets
+        return [s for s in range(self.size) if offsets[s + 1] > offsets[s]]
+
+    def edge_count(self):
+        return len(self.fwd_targets)
+
+    # which of the end sectors the known warps already give the shortest route to from start: those no further away
+    # than the first sector that isn't explored, since only an unexplored sector can have warps we don't know about
+    def known_routes(self, start, end_vertices, explored):
+        offsets, targets = self.adjacency()
+        remaining = set(end_vertices)
+        known = set()
+        if(start in remaining):
+            remaining.discard(start)
+            known.add(start)
+        if(start < 0 or start >= self.size):
+            return known
+        seen = bytearray(self.size)
+        seen[start] = 1
+        level = [start]
+        while(level and remaining):
+            for s in level:
+                if(s not in explored):
+                    return known
+            following = []
+            for s in level:
+                for i in range(offsets[s], offsets[s + 1]):
+                    neighbor = targets[i]
+                    if(not seen[neighbor]):
+                        seen[neighbor] = 1
+                        following.append(neighbor)
+                        if(neighbor in remaining):
+                            remaining.discard(neighbor)
+                            known.add(neighbor)
+            level = following
+        return known
+
+    # breadth-first search for the shortest route(s) from start to any of the end sectors, optionally giving up on
+    # routes longer than max_hops
+    def bfs(self, start, end_vertices, avoids=[], reverse=False, return_all=False, max_hops=None):
+        offsets, targets = self.adjacency(reverse)
+        size = max(self.size, start + 1)
+        seen = bytearray(size)
+        is_end = bytearray(size)
+        for s in avoids:
+            if(0 <= s < size):
+                seen[s] = 1
+        for s in end_vertices:
+            if(0 <= s < size):
+                is_end[s] = 1
+        parent = {}
+        retVal = []
+
+        seen[start] = 1
+        level = [start]
+        hops = 0
+        while(level):
+            following = []
+            for current in level:
+                if(is_end[current]):
+                    retVal.append(backtrace(parent, start, current, reverse))
+                    if(not return_all):
+                        return retVal
+                if(current >= self.size or hops == max_hops):
+                    continue
+                for i in range(offsets[current], offsets[current + 1]):
+                    neighbor = targets[i]
+                    if(not seen[neighbor]):
+                        seen[neighbor] = 1
+                        parent[neighbor] = current
+                        following.append(neighbor)
+            level = following
+            hops += 1
+        return retVal
+
+    # breadth-first search outward from all of the source sectors at once.  returns (distance, parent) arrays indexed
+    # by sector: the hop count to the nearest source (-1 if unreachable), and the next sector back towards that source
+    def multi_source_bfs(self, sources, avoids=[], reverse=False):
+        offsets, targets = self.adjacency(reverse)
+        size = self.size
+        for s in sources:
+            if(s >= size):
+                size = s + 1
+        distance = array('i', [-1]) * size
+        parent = array('i', [-1]) * size
+        for s in avoids:
+            if(0 <= s < size):
+                distance[s] = -2
+
+        queue = deque()
+        for s in sources:
+            if(distance[s] != 0):
+                distance[s] = 0
+                queue.append(s)
+        while(queue):
+            current = queue.popleft()
+            if(current >= self.size):
+                continue
+            hops = distance[current] + 1
+            for i in range(offsets[current], offsets[current + 1]):
+                neighbor = targets[i]
+                if(distance[neighbor] == -1):
+                    distance[neighbor] = hops
+                    parent[neighbor] = current
+                    queue.append(neighbor)
+        for s in avoids:
+            if(0 <= s < size and distance[s] == -2):
+                distance[s] = -1
+        return distance, parent
+
+# shortest routes from the nearest of a set of sectors (e.g. fighters or blind warps) to every other sector,
+# computed in one pass; with reverse=True, the routes lead from every sector to the nearest of the set instead
+class NearestSources:
+    distance = None
+    parent = None
+    reverse = False
+
+    def __init__(self, graph, sources, avoids=[], reverse=False):
+        self.reverse = reverse
+        self.distance, self.parent = graph.multi_source_bfs(sources, avoids=avoids, reverse=reverse)
+
+    def hops(self, sector):
+        if(sector < 0 or sector >= len(self.distance) or self.distance[sector] < 0):
+            return None
+        return self.distance[sector]
+
+    def route(self, sector):
+        if(self.hops(sector) is None):
+            return None
+        path = [sector]
+        while(self.distance[path[-1]] > 0):
+            path.append(self.parent[path[-1]])
+        if(not self.reverse):
+            path.reverse()
+        return path
+
 def connect_database(filename):
     global database
+    global database_name
+    filename = os.path.abspath(filename)
+    if(database is not None and filename == database_name):
+        return
     database = sqlite3.connect(filename)
+    database_name = filename
+    invalidate()
+
+# forget everything loaded from the database
+def invalidate():
+    global graph
+    graph = None
+    cache.clear()
+
+# function decorator that keeps the result of a query until the database changes; callers get their own copy
+def cachedQuery(func):
+    def func_cachedQuery(*args):
+        key = (func.__name__,) + args
+        if(key not in cache):
+            cache[key] = func(*args)
+        return copy.copy(cache[key])
+    return func_cachedQuery
+
+def load_graph():
+    global database
+    global graph
+    if(graph is None):
+        conn = database.cursor()
+        graph = SectorGraph(conn.execute("SELECT source, destination FROM warps ORDER BY rowid"))
+        conn.close()
+    return graph
 
+@cachedQuery
 def fighter_locations():
     global database
     conn = database.cursor()
@@ -19,6 +242,7 @@ def fighter_locations():
     conn.close()
     return retval
 
+@cachedQuery
 def blind_warps():
     global database
     conn = database.cursor()
@@ -33,61 +257,123 @@ def blind_warps():
             )
         '''):
         blind_warps.append(int(sector[0]))
+    conn.close()
     return blind_warps
 
-def port_search(searchStr, avoids=[]):
+@cachedQuery
+def explored_sectors():
     global database
-    searchStr = searchStr.upper().replace("?", "_")
     conn = database.cursor()
-    query = conn.execute("SELECT sector FROM ports WHERE class LIKE ?", (searchStr,))
-    retval = [int(sector[0]) for sector in query]
-    retval = filter(lambda p: p not in avoids, retval)
+    retval = set(int(s[0]) for s in conn.execute('SELECT sector FROM explored'))
     conn.close()
     return retval
 
-def deadend_search(avoids=[]):
+@cachedQuery
+def port_list():
     global database
     conn = database.cursor()
-    query = conn.execute('''
-        SELECT source AS sector
-        FROM warps
-        GROUP BY source
-        HAVING count(*)=1
-        INTERSECT
-        SELECT destination AS sector
-        FROM warps
-        GROUP BY destination
-        HAVING count(*)=1
-        ''')
-    retval = [int(sector[0]) for sector in query]
-    retval = filter(lambda p: p not in avoids, retval)
+    retval = list(conn.execute('SELECT sector, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct, last_seen FROM ports'))
     conn.close()
     return retval
 
-def list_all_sectors():
+# how fast each port's commodities regenerate, in units per day, estimated from the rises between successive reports
+# in port_observations.  trades made between two reports make the estimate low, so a port needs to have been scanned
+# a few times without being traded with for it to mean much.  returns { sector: (ore, org, equ, reports) }, with None
+# for a commodity that hasn't been seen to rise
+def port_regen_rates():
     global database
     conn = database.cursor()
-    query = conn.execute("SELECT DISTINCT source FROM warps")
-    retval = [int(sector[0]) for sector in query]
+    rates = {}
+    try:
+        query = conn.execute('''
+            WITH steps AS (
+                SELECT sector,
+                    ts - lag(ts) OVER w AS dt,
+                    ore_amt - lag(ore_amt) OVER w AS ore,
+                    org_amt - lag(org_amt) OVER w AS org,
+                    equ_amt - lag(equ_amt) OVER w AS equ
+                FROM port_observations
+                WINDOW w AS (PARTITION BY sector ORDER BY ts)
+                )
+            SELECT sector,
+                86400.0 * sum(CASE WHEN ore > 0 THEN ore END) / sum(CASE WHEN ore > 0 THEN dt END),
+                86400.0 * sum(CASE WHEN org > 0 THEN org END) / sum(CASE WHEN org > 0 THEN dt END),
+                86400.0 * sum(CASE WHEN equ > 0 THEN equ END) / sum(CASE WHEN equ > 0 THEN dt END),
+                count(*)
+            FROM steps
+            GROUP BY sector
+            ''')
+        for sector, ore, org, equ, reports in query:
+            rates[sector] = (ore, org, equ, reports)
+    except sqlite3.OperationalError:
+        # a database twparser hasn't migrated yet has no history
+        pass
+    conn.close()
+    return rates
+
+@cachedQuery
+def get_setting(key):
+    global database
+    conn = database.cursor()
+    retval = None
+    try:
+        for value in conn.execute('SELECT value FROM settings WHERE key=?', (key,)):
+            retval = value[0]
+    except sqlite3.Error:
+        pass
     conn.close()
     return retval
 
-def warps_from(sector):
+def port_search(searchStr, avoids=[]):
     global database
+    searchStr = searchStr.upper().replace("?", "_")
     conn = database.cursor()
-    query = conn.execute("SELECT destination FROM warps WHERE source=?", (sector,))
-    retval = [int(warp[0]) for warp in query]
+    query = conn.execute("SELECT sector FROM ports WHERE class LIKE ?", (searchStr,))
+    retval = [int(sector[0]) for sector in query]
+    retval = filter(lambda p: p not in avoids, retval)
     conn.close()
     return retval
 
-def warps_to(sector):
+def deadend_search(avoids=[]):
     global database
     conn = database.cursor()
-    query = conn.execute("SELECT source FROM warps WHERE destination=?", (sector,))
-    retval = [int(warp[0]) for warp in query]
+    try:
+        # sector_degree is kept up to date by twparser's triggers on warps
+        query = conn.execute('SELECT sector FROM sector_degree WHERE warps_out = 1 AND warps_in = 1 ORDER BY sector')
+    except sqlite3.OperationalError:
+        # a database twparser hasn't migrated yet
+        query = conn.execute('''
+            SELECT source AS sector
+            FROM warps
+            GROUP BY source
+            HAVING count(*)=1
+            INTERSECT
+            SELECT destination AS sector
+            FROM warps
+            GROUP BY destination
+            HAVING count(*)=1
+            ''')
+    retval = [int(sector[0]) for sector in query]
+    retval = filter(lambda p: p not in avoids, retval)
     conn.close()
     return retval
 
+# the bubbles twgraph.py finds in the sector map, as (gate, sectors)
+@cachedQuery
+def bubbles():
+    # twgraph works from this module's sector graph, so it's only imported when needed
+    import twgraph
+    return [(bubble['gate'], bubble['sectors']) for bubble in twgraph.load(database_name)['bubbles']]
+
+def list_all_sectors():
+    return load_graph().sectors()
+
+def warps_from(sector):
+    return load_graph().warps_from(sector)
+
+def warps_to(sector):
+    return load_graph().warps_to(sector)
+
 def backtrace(parent, start, end, reverse=False):
     path = [end]
     while(path[-1] != start):
@@ -96,50 +382,17 @@ def backtrace(parent, start, end, reverse=False):
         path.reverse()
     return path
 
-# mainly drawn from http://pythonfiddle.com/dijkstra/
-def dijkstra(start_vertex, end_vertices, avoids=[], reverse=False, return_all=False):
+def nearest_sources(sources, avoids=[], reverse=False):
+    return NearestSources(load_graph(), sources, avoids=avoids, reverse=reverse)
+
+# originally drawn from http://pythonfiddle.com/dijkstra/; every warp costs one hop, so this is a plain BFS over the in-memory graph
+def dijkstra(start_vertex, end_vertices, avoids=[], reverse=False, return_all=False, max_hops=None):
     if(not isinstance(end_vertices, list)):
         end_vertices = [end_vertices]
-    queue = []
-    distance = {}
-    visited = {}
-    parent = {}
-    shortest_distance = {}
-
-    retVal = []
-
-    for node in list_all_sectors():
-        distance[node] = None
-        visited[node] = False
-        parent[node] = None
-        shortest_distance[node] = float('inf')
-
-        if(node in avoids):
-            visited[node] = True
-
-    queue.append(start_vertex)
-    distance[start_vertex] = 0
-    while(len(queue)):
-        current = queue.pop(0)
-        visited[current] = True
-        if(current in end_vertices):
-            retVal.append(backtrace(parent, start_vertex, current, reverse))
-            if(not return_all):
-                return retVal
-        warp_list = warps_from(current)
-        if(reverse):
-            warp_list = warps_to(current)
-        for neighbor in warp_list:
-            if(visited[neighbor] == False):
-                distance[neighbor] = distance[current] + 1
-                if(distance[neighbor] < shortest_distance[neighbor]):
-                    shortest_distance[neighbor] = distance[neighbor]
-                    parent[neighbor] = current
-                    queue.append(neighbor)
-    return retVal
+    return load_graph().bfs(start_vertex, end_vertices, avoids=avoids, reverse=reverse, return_all=return_all, max_hops=max_hops)
 
 
-if(__name__ == '__main__'):
+def run(argv=None):
     parser = argparse.ArgumentParser(description='Calculate the shortest path between sectors or facilities in a TW2002 game.')
     parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database file to use; default "{}"'.format(DEFAULT_DB_NAME))
     parser.add_argument('--all-destinations', '-a', dest='all', action='store_true', default=False, help='Show routes to all destinations, not only the nearest')
@@ -150,12 +403,19 @@ if(__name__ == '__main__'):
     parser.add_argument('--blind-warps', '-b', action='store_true', help='Adds to your destination list all mapped sectors not known to contain a port.  Use caution when blind warping!')
     parser.add_argument('--avoids', '-v', type=int, default=[], nargs='+', help='Sectors to avoid plotting a route through')
     parser.add_argument('--dead-ends', '-e', action='store_true', help='Adds known presumed to be dead end sectors')
+    parser.add_argument('--bubble-gates', '-g', action='store_true', help='Adds the gate sector of every bubble: a pocket of sectors that can only be reached through it (see twgraph.py)')
+    parser.add_argument('--hops-only', '-n', dest='hops_only', action='store_true', help='Only show the hop count to and from each destination, using the hop matrix built by twhops.py when it is up to date')
     parser.add_argument('start',  type=int, help='The starting sector for the route calculation')
     parser.add_argument('destination', type=int, nargs='*', help='The desired destination sector')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     # print(args)
 
+    # twdaemon serves queries from this module, so it's only imported here
+    import twdaemon
+    if(twdaemon.forward(args.db, 'twpath', argv)):
+        return
+
     connect_database(args.db)
 
     if(args.fighters):
@@ -166,16 +426,9 @@ if(__name__ == '__main__'):
 
     if(args.fedspace):
         fedSpace = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
-        starDock = None
-        try:
-            conn = database.cursor()
-            for sd in conn.execute('SELECT value FROM settings WHERE key=?', ('stardock',)):
-                starDock = int(sd[0])
-            conn.close()
-        except:
-            pass
+        starDock = get_setting('stardock')
         if(starDock):
-            fedSpace.append(starDock)
+            fedSpace.append(int(starDock))
         args.destination += fedSpace
 
     if(args.port_type):
@@ -186,6 +439,31 @@ if(__name__ == '__main__'):
     if(args.dead_ends):
         args.destination += deadend_search(args.avoids)
 
+    if(args.bubble_gates):
+        args.destination += [gate for gate, sectors in bubbles() if gate not in args.avoids]
+
+    if(args.hops_only):
+        # twhops builds its matrix from this module's SectorGraph, so it's only imported when needed
+        import twhops
+        hops = None
+        if(len(args.avoids) == 0):
+            hops = twhops.load(args.db)
+        for destination in args.destination:
+            if(hops):
+                there = hops.distance(args.start, destination)
+                back = hops.distance(destination, args.start)
+                there = None if there == twhops.UNREACHABLE else there
+                back = None if back == twhops.UNREACHABLE else back
+            else:
+                there = [len(r)-1 for r in dijkstra(args.start, destination, avoids=args.avoids)]
+                back = [len(r)-1 for r in dijkstra(destination, args.start, avoids=args.avoids)]
+                there = there[0] if len(there) else None
+                back = back[0] if len(back) else None
+            print("{} > {}: {} hops\t{} > {}: {} hops".format(
+                args.start, destination, '-' if there is None else there,
+                destination, args.start, '-' if back is None else back))
+        return
+
     results = dijkstra(args.start, args.destination, reverse=args.reverse, avoids=args.avoids, return_all=args.all)
     for result in results:
         result = [str(s) for s in result]
@@ -193,3 +471,6 @@ if(__name__ == '__main__'):
     if(len(results) == 0):
         print('No route found.')
 
+
+if(__name__ == '__main__'):
+    run()
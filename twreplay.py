@@ -0,0 +1,176 @@
+#!/usr/bin/python3
+
+import argparse
+import threading
+import tempfile
+import queue
+import json
+import time
+import sys
+import os
+import re
+
+import twparser
+import twclient
+import twsession
+
+# the name twparser gives each of its patterns, for the match counts
+def pattern_names():
+    return {id(value): name for name, value in vars(twparser).items() if isinstance(value, re.Pattern)}
+
+# replace the parser's handlers with ones that count their matches as well; returns the counts
+def count_matches():
+    names = pattern_names()
+    matches = {}
+
+    def counting(name, handler):
+        def counted(match):
+            matches[name] += 1
+            return handler(match)
+        return counted
+
+    for table in (twparser.completeLineHandlers, twparser.routeLineHandlers):
+        for key, entries in table.items():
+            table[key] = tuple((regex, counting(names.get(id(regex), regex.pattern), handler), stop) for regex, handler, stop in entries)
+            for regex, handler, stop in entries:
+                matches[names.get(id(regex), regex.pattern)] = 0
+    return matches
+
+# feed a recording through twclient's parser thread and database writer, either at the pace it was recorded (for
+# latency) or as fast as the parser will take it (for throughput).  returns a report
+def replay(filename, dbname, paced=False, speed=1.0, sample_interval=0.1):
+    # find out about a missing or mistaken file before anything is started
+    with twsession.open_session(filename, 'rb') as f:
+        twsession.check_session(f, filename)
+
+    matches = count_matches()
+    lines = 0
+    def count_line(line, partial):
+        nonlocal lines
+        if(not partial):
+            lines += 1
+    twparser.line_listeners = twparser.line_listeners + [count_line]
+    twclient.parse_lag = twclient.LatencyStats('parse lag')
+
+    twparser.database_connect(dbname)
+
+    chunks = queue.Queue(twclient.PARSE_QUEUE_CHUNKS)
+    responses = queue.Queue()
+    wakeup_r, wakeup_w = os.pipe()
+    parser = threading.Thread(target=twclient.parser_worker, args=(chunks, responses, wakeup_w))
+    parser.start()
+
+    # nobody is at the keyboard to send the parser's suggestions, but they still have to be taken off its hands
+    suggestions = 0
+    def drain():
+        nonlocal suggestions
+        while(os.read(wakeup_r, 4096)):
+            while(not responses.empty()):
+                # leaving out the parser's notes of when the port replied to an offer
+                if(responses.get()[0] is not None):
+                    suggestions += 1
+    drainer = threading.Thread(target=drain)
+    drainer.start()
+
+    # how far the parser and the database writer are behind, over the course of the replay
+    depths = []
+    done = threading.Event()
+    def sample():
+        while(not done.wait(sample_interval)):
+            depths.append((round(time.perf_counter() - start, 3), chunks.qsize(), twparser.dbqueue.qsize()))
+    sampler = threading.Thread(target=sample)
+
+    size = 0
+    count = 0
+    start = time.perf_counter()
+    sampler.start()
+    try:
+        for offset, data in twsession.read_session(filename):
+            if(paced):
+                delay = start + offset / speed - time.perf_counter()
+                if(delay > 0):
+                    time.sleep(delay)
+            chunks.put((time.perf_counter(), data))
+            size += len(data)
+            count += 1
+        chunks.put(None)
+        parser.join()
+        parsed = time.perf_counter() - start
+        twparser.flush()
+        written = time.perf_counter() - start
+    finally:
+        if(parser.is_alive()):
+            chunks.put(None)
+            parser.join()
+        done.set()
+        sampler.join()
+        os.close(wakeup_w)
+        drainer.join()
+        os.close(wakeup_r)
+
+    lag = twclient.parse_lag
+    return {
+        'recording': filename,
+        'mode': 'paced' if paced else 'max',
+        'speed': speed if paced else None,
+        'chunks': count,
+        'bytes': size,
+        'lines': lines,
+        'suggestions': suggestions,
+        'parse_seconds': parsed,
+        'total_seconds': written,
+        'lines_per_second': lines / parsed if parsed else 0,
+        'bytes_per_second': size / parsed if parsed else 0,
+        'parse_lag_ms': {
+            'mean': lag.total / lag.count * 1000 if lag.count else None,
+            'median': lag.percentile(0.5) * 1000 if lag.count else None,
+            'p99': lag.percentile(0.99) * 1000 if lag.count else None,
+            'max': lag.worst * 1000,
+            },
+        'queue_depth': {
+            'max_chunks': max((d[1] for d in depths), default=0),
+            'max_writes': max((d[2] for d in depths), default=0),
+            'samples': depths,
+            },
+        'database': dict(twparser.write_stats),
+        'matches': matches,
+        }
+
+def print_report(report):
+    print('{}: {} chunks, {} bytes, {} lines replayed ({} mode)'.format(report['recording'], report['chunks'], report['bytes'], report['lines'], report['mode']))
+    print('Parsed in {:.3f}s: {:.0f} lines/s, {:.1f} MB/s; all written after {:.3f}s'.format(
+        report['parse_seconds'], report['lines_per_second'], report['bytes_per_second'] / 1e6, report['total_seconds']))
+    print(twclient.parse_lag)
+    print('Queue depth: at most {} chunks waiting for the parser, {} writes waiting for the database'.format(
+        report['queue_depth']['max_chunks'], report['queue_depth']['max_writes']))
+    print('Matches:')
+    for name, count in sorted(report['matches'].items(), key=lambda m: -m[1]):
+        print('  {:8}  {}'.format(count, name))
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='Replay a session recorded by "twclient.py --record" through the parser, to measure how fast it keeps up.')
+    parser.add_argument('--database', '-d', dest='db', help='SQLite database file to parse into, e.g. a copy of your own; default a new empty database')
+    parser.add_argument('--paced', '-p', action='store_true', help='Replay at the pace the session was recorded, to measure latency; the default is as fast as possible, to measure throughput')
+    parser.add_argument('--speed', '-s', type=float, default=1.0, help='With --paced, how many times faster than recorded to replay; default 1')
+    parser.add_argument('--json', '-o', dest='output', help='JSON file to save the full report to, including the queue depths over time')
+    parser.add_argument('recording', help='Session recording to replay (.gz and .zst files are decompressed)')
+
+    args = parser.parse_args()
+
+    try:
+        with tempfile.TemporaryDirectory(prefix='twreplay-') as workdir:
+            dbname = args.db
+            if(dbname is None):
+                dbname = os.path.join(workdir, 'replay.db')
+            try:
+                report = replay(args.recording, dbname, paced=args.paced, speed=args.speed)
+            finally:
+                twparser.quit()
+            print_report(report)
+            if(args.output):
+                with open(args.output, 'w') as out:
+                    json.dump(report, out, indent=2)
+    except (OSError, ValueError, RuntimeError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+import re
+import time
+import queue
+
+import twparser
+
+# seconds to wait for the game before giving up on a step
+DEFAULT_TIMEOUT = 30
+
+# the game's prompts, for wait_for_prompt().  anchored at the end, so the game's echo of the key typed at a prompt
+# doesn't count as the next prompt
+PROMPTS = {
+    'Command': re.compile(r'^Command \[TL=[0-9:]+\]:\[[0-9]+\] \(\?=Help\)\? :$'),
+    'Computer': re.compile(r'^Computer command \[TL=[0-9:]+\]:\[[0-9]+\] \(\?=Help\)\?$'),
+    'CIM': re.compile(r'^:$'),
+    'Pause': re.compile(r'^\[Pause\]'),
+}
+
+class ScriptTimeout(Exception):
+    pass
+
+# a macro driving the game: send keystrokes, then wait for the game's reply by watching the lines twparser sees.
+# use it as a context manager, so it only listens while it's running:
+#
+#   with twscript.Script(tn, 'update') as script:
+#       script.send('QQQQQQQQN')
+#       script.wait_for_prompt('Command')
+#
+# each expect() is a step; how long each step took is printed when the script ends
+class Script:
+    def __init__(self, tn, name):
+        self.tn = tn
+        self.name = name
+        self.lines = queue.Queue()
+        self.steps = []
+        self.start = None
+        self.step_start = None
+
+    def __enter__(self):
+        self.start = self.step_start = time.time()
+        # replace the list rather than changing it, as the parser may be walking through it in another thread
+        twparser.line_listeners = twparser.line_listeners + [self.on_line]
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        twparser.line_listeners = [f for f in twparser.line_listeners if f != self.on_line]
+        print("\r\n{}".format(self.report(exc_type)), flush=True)
+
+    def on_line(self, line, partial):
+        self.lines.put((line, partial))
+
+    # send keystrokes.  anything the game sent before this is forgotten, so a following expect() only sees the reply
+    def send(self, data):
+        while(not self.lines.empty()):
+            self.lines.get_nowait()
+        if(isinstance(data, str)):
+            data = data.encode('utf-8')
+        self.tn.write(data)
+
+    # wait for a line (or prompt) matching the pattern, and return the match.  raises ScriptTimeout if it doesn't come
+    def expect(self, pattern, timeout=DEFAULT_TIMEOUT, step=None):
+        if(isinstance(pattern, str)):
+            pattern = re.compile(pattern)
+        deadline = time.time() + timeout
+        while(True):
+            remaining = deadline - time.time()
+            if(remaining <= 0):
+                self.record(step or pattern.pattern, timed_out=True)
+                raise ScriptTimeout('{}: timed out waiting for {}'.format(self.name, step or pattern.pattern))
+            try:
+                line, partial = self.lines.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            match = pattern.search(line)
+            if(match):
+                self.record(step or pattern.pattern)
+                return match
+
+    def wait_for_prompt(self, prompt='Command', timeout=DEFAULT_TIMEOUT, step=None):
+        return self.expect(PROMPTS[prompt], timeout=timeout, step=step or '{} prompt'.format(prompt))
+
+    # note the time taken since the last step, for steps that aren't an expect()
+    def record(self, step, timed_out=False):
+        now = time.time()
+        self.steps.append((step, now - self.step_start, timed_out))
+        self.step_start = now
+
+    def report(self, exc_type=None):
+        lines = ['{} {} in {:.2f}s:'.format(self.name, 'timed out' if exc_type is ScriptTimeout else 'finished', time.time() - self.start)]
+        for step, seconds, timed_out in self.steps:
+            lines.append('  {:8.3f}s  {}{}'.format(seconds, step, ' (timed out)' if timed_out else ''))
+        return '\r\n'.join(lines)
@@ -0,0 +1,519 @@
+#!/usr/bin/python3
+
+import socketserver
+import threading
+import argparse
+import sqlite3
+import random
+import socket
+import queue
+import time
+import sys
+
+import twpath
+
+DEFAULT_DB_NAME = 'tw2002.db'
+DEFAULT_PORT = 2002
+
+# telnet, just enough to announce ourselves the way a game server does and to skip the client's replies
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+OPT_ECHO = 1
+OPT_SGA = 3
+
+COMMODITIES = ('Fuel Ore', 'Organics', 'Equipment')
+# rough credits per unit of each commodity
+BASE_PRICES = (20, 40, 75)
+
+SHIP_HOLDS = 50
+SHIP_CREDITS = 1000000
+
+# the game's prompts, with a little colour so the client has ANSI codes to strip
+COMMAND_PROMPT = '\r\n\x1b[35mCommand [\x1b[1;33mTL\x1b[0;35m=\x1b[1;33m00:00:00\x1b[0;35m]\x1b[1;37m:\x1b[0;35m[\x1b[1;36m{sector}\x1b[0;35m] (\x1b[1;33m?=Help\x1b[0;35m)? : \x1b[0m'
+COMPUTER_PROMPT = '\r\n\x1b[35mComputer command [\x1b[1;33mTL\x1b[0;35m=\x1b[1;33m00:00:00\x1b[0;35m]\x1b[1;37m:\x1b[0;35m[\x1b[1;36m{sector}\x1b[0;35m] (\x1b[1;33m?=Help\x1b[0;35m)? \x1b[0m'
+CIM_PROMPT = '\r\n: '
+
+# the universe the server plays, loaded once from a database such as tw2002-demo.db or one made by twgen.py.  trades
+# change the port amounts in memory only; the database is never written
+class Universe:
+    def __init__(self, dbname):
+        database = sqlite3.connect(dbname)
+        self.graph = twpath.SectorGraph(database.execute('SELECT source, destination FROM warps ORDER BY rowid'))
+        self.explored = set(row[0] for row in database.execute('SELECT sector FROM explored'))
+        self.ports = {}
+        for sector, port_class, *amounts in database.execute('SELECT sector, class, ore_amt, ore_pct, org_amt, org_pct, equ_amt, equ_pct FROM ports'):
+            self.ports[sector] = [port_class] + amounts
+        self.fighters = sorted(row[0] for row in database.execute('SELECT sector FROM fighters'))
+        self.planets = list(database.execute('SELECT sector, id, name, class, citadel FROM planets ORDER BY sector, id'))
+        settings = dict(database.execute('SELECT key, value FROM settings'))
+        database.close()
+        self.max_sector = int(settings.get('max_sector', max(self.graph.sectors(), default=1)))
+        self.stardock = settings.get('stardock')
+        self.lock = threading.Lock()
+
+    # a route as the game prints it, with the sectors nobody has explored in parentheses
+    def route_str(self, route):
+        return ' > '.join(str(s) if s in self.explored else '({})'.format(s) for s in route)
+
+# sends everything the game says after the configured delay, and no faster than the configured bandwidth.  replies
+# are delayed rather than the game made slower, so pipelined commands overlap the way they would over a real link
+class Link:
+    def __init__(self, sock, delay=0.0, bandwidth=None):
+        self.sock = sock
+        self.delay = delay
+        self.bandwidth = bandwidth
+        self.bytes_sent = 0
+        self.outgoing = queue.Queue()
+        self.sender = threading.Thread(target=self.send_loop, daemon=True)
+        self.sender.start()
+
+    def send(self, data):
+        if(isinstance(data, str)):
+            data = data.encode('utf-8')
+        self.outgoing.put((time.perf_counter() + self.delay, data))
+
+    def send_loop(self):
+        busy_until = 0.0
+        while(True):
+            item = self.outgoing.get()
+            if(item is None):
+                break
+            due, data = item
+            wait = due - time.perf_counter()
+            if(wait > 0):
+                time.sleep(wait)
+            step = len(data)
+            if(self.bandwidth):
+                # a twentieth of a second's worth at a time
+                step = max(1, self.bandwidth // 20)
+            for i in range(0, len(data), step):
+                piece = data[i:i + step]
+                try:
+                    self.sock.sendall(piece)
+                except OSError:
+                    return
+                self.bytes_sent += len(piece)
+                if(self.bandwidth):
+                    busy_until = max(busy_until, time.perf_counter()) + len(piece) / self.bandwidth
+                    wait = busy_until - time.perf_counter()
+                    if(wait > 0):
+                        time.sleep(wait)
+
+    def close(self):
+        self.outgoing.put(None)
+        self.sender.join()
+
+class Disconnect(Exception):
+    pass
+
+# one player's connection: Command, Computer and CIM prompts, the info screen, fighter and planet scans, course
+# plots, moving between sectors, and trading at ports
+class GameSession:
+    def __init__(self, universe, sock, link, sector=1, seed=None):
+        self.universe = universe
+        self.sock = sock
+        self.link = link
+        self.sector = sector
+        self.rng = random.Random(seed)
+        self.pending = bytearray()
+        self.holds = SHIP_HOLDS
+        self.cargo = [0, 0, 0]
+        self.credits = SHIP_CREDITS
+        self.stats = {'commands': 0, 'plots': 0, 'trades': 0, 'offers': 0}
+
+    def send(self, text):
+        self.link.send(text)
+
+    # the next byte the player typed, with the telnet negotiation taken out
+    def next_byte(self):
+        while(True):
+            while(len(self.pending) == 0):
+                data = self.sock.recv(4096)
+                if(not data):
+                    raise Disconnect()
+                self.pending += data
+            byte = self.pending[0]
+            if(byte != IAC):
+                del self.pending[0]
+                return byte
+            if(len(self.pending) < 2):
+                self.pending += self.recv_more()
+                continue
+            command = self.pending[1]
+            if(command == IAC):
+                del self.pending[:2]
+                return IAC
+            if(command in (DO, DONT, WILL, WONT)):
+                if(len(self.pending) < 3):
+                    self.pending += self.recv_more()
+                    continue
+                del self.pending[:3]
+            elif(command == SB):
+                end = self.pending.find(bytes((IAC, SE)))
+                if(end < 0):
+                    self.pending += self.recv_more()
+                    continue
+                del self.pending[:end + 2]
+            else:
+                del self.pending[:2]
+
+    def recv_more(self):
+        data = self.sock.recv(4096)
+        if(not data):
+            raise Disconnect()
+        return data
+
+    # a keystroke, ignoring the LF of a CR-LF and any NULs
+    def key(self):
+        while(True):
+            byte = self.next_byte()
+            if(byte not in (0x0a, 0x00)):
+                return chr(byte)
+
+    # a line typed at a prompt, echoed as it's typed
+    def line(self):
+        text = ''
+        while(True):
+            k = self.key()
+            if(k == '\r'):
+                self.send('\r\n')
+                return text
+            if(k in ('\x08', '\x7f')):
+                if(text):
+                    text = text[:-1]
+                    self.send('\x08 \x08')
+            elif(k.isprintable()):
+                text += k
+                self.send(k)
+
+    def number(self, default=None):
+        text = self.line().replace(',', '').strip()
+        if(text.isdigit()):
+            return int(text)
+        return default
+
+    def run(self):
+        self.send(bytes((IAC, WILL, OPT_ECHO, IAC, WILL, OPT_SGA)))
+        self.send('\r\nWelcome to the TW2002 stand-in server.\r\n')
+        self.sector_display()
+        try:
+            self.command_mode()
+        except Disconnect:
+            pass
+
+    def command_mode(self):
+        while(True):
+            self.send(COMMAND_PROMPT.format(sector=self.sector))
+            k = self.key()
+            self.stats['commands'] += 1
+            if(k.isdigit()):
+                # a sector number to move to
+                self.send(k)
+                destination = (k + self.line()).replace(',', '').strip()
+                if(destination.isdigit()):
+                    self.move(int(destination))
+                continue
+            command = k.upper()
+            if(command == '\r'):
+                continue
+            self.send(command + '\r\n')
+            if(command == 'Q'):
+                self.send('\r\nAre you sure you want to quit? (Y/N) ')
+                if(self.key().upper() == 'Y'):
+                    self.send('Y\r\n\r\nSee you next time!\r\n')
+                    return
+            elif(command == 'V'):
+                self.game_info()
+            elif(command == 'D'):
+                self.sector_display()
+            elif(command == 'G'):
+                self.fighter_scan()
+            elif(command == 'C'):
+                self.computer_mode()
+            elif(command == '^'):
+                self.cim_mode()
+            elif(command == 'P'):
+                self.port()
+
+    def move(self, destination):
+        if(destination not in self.universe.graph.warps_from(self.sector)):
+            self.send('\r\nThat sector is not adjacent to this one.\r\n')
+            return
+        self.send('\r\nWarping to Sector {}\r\n'.format(destination))
+        self.sector = destination
+        self.sector_display()
+
+    def sector_display(self):
+        lines = ['', '\x1b[1;32mSector  \x1b[1;33m: \x1b[36m{} \x1b[0;32min \x1b[34muncharted space.\x1b[0m'.format(self.sector)]
+        port = self.universe.ports.get(self.sector)
+        if(port):
+            lines.append('\x1b[0;35mPorts   \x1b[1;33m: \x1b[36mStand-in Station {}\x1b[0;33m, \x1b[1;33mClass \x1b[36m{} \x1b[0;35m({})\x1b[0m'.format(self.sector, port_class_number(port[0]), port[0]))
+        if(self.sector in self.universe.fighters):
+            lines.append('\x1b[0;35mFighters\x1b[1;33m: \x1b[36m1 \x1b[0;35m(yours) [Defensive]\x1b[0m')
+        lines.append('\x1b[1;32mWarps to Sector(s) \x1b[1;33m:  \x1b[36m{}\x1b[0m'.format(' - '.join(str(w) for w in self.universe.graph.warps_from(self.sector))))
+        self.send('\r\n'.join(lines) + '\r\n')
+
+    def game_info(self):
+        u = self.universe
+        lines = [
+            '',
+            'Trade Wars 2002 stand-in',
+            '',
+            '   Maximum players 10, sectors {:,}, ports {:,}, planets {:,}.'.format(u.max_sector, len(u.ports), len(u.planets)),
+            ]
+        if(u.stardock):
+            lines.append('   The StarDock is located in sector {}.'.format(u.stardock))
+        self.send('\r\n'.join(lines) + '\r\n')
+
+    def fighter_scan(self):
+        lines = [
+            '',
+            '                 Deployed  Fighter  Scan',
+            '',
+            ' Sector    Fighters    Personal/Corp    Mode    Toll',
+            ' ===================================================',
+            ]
+        for sector in self.universe.fighters:
+            lines.append(' {:5}         1       Personal      Defensive  N/A'.format(sector))
+        lines.append('')
+        lines.append('                 1 Total                             ' if len(self.universe.fighters) else 'No fighters deployed')
+        self.send('\r\n'.join(lines) + '\r\n')
+
+    def planet_scan(self):
+        if(len(self.universe.planets) == 0):
+            self.send('\r\nNo planets.\r\n')
+            return
+        lines = [
+            '',
+            '                     Personal Planet Scan',
+            '',
+            ' Sector  Planet Name    Ore  Org  Equ   Ore   Org   Equ   Fighters    Citadel',
+            ' Shields Population    -=Productions=-  -=-=-=-=-On Hands-=-=-=-=-   Credits',
+            ' ----------------------------------------------------------------------------',
+            ]
+        for sector, planet_id, name, planet_class, citadel in self.universe.planets:
+            lines.append(' {:5}   #{:<3} {:<20} Class {}, Stand-in Type    {}'.format(sector, planet_id, name, planet_class, 'Level {}'.format(citadel) if citadel else 'No Citadel'))
+        self.send('\r\n'.join(lines) + '\r\n')
+
+    def computer_mode(self):
+        while(True):
+            self.send(COMPUTER_PROMPT.format(sector=self.sector))
+            command = self.key().upper()
+            self.stats['commands'] += 1
+            if(command == '\r'):
+                continue
+            self.send(command + '\r\n')
+            if(command == 'Q'):
+                return
+            elif(command == '^'):
+                self.cim_mode()
+            elif(command == 'Y'):
+                self.planet_scan()
+            elif(command == 'F'):
+                self.send('\r\nWhat is the starting sector ? ')
+                start = self.number(self.sector)
+                self.send('What is the destination sector? ')
+                end = self.number()
+                route = self.plot(start, end)
+                if(route):
+                    self.send('\r\nThe shortest path ({} hops, {} turns) from sector {} to sector {} is: {}\r\n'.format(len(route) - 1, 3 * (len(route) - 1), start, end, self.universe.route_str(route)))
+
+    # Computer Interrogation Mode: terse reports for scripts, and no echo of the commands
+    def cim_mode(self):
+        while(True):
+            self.send(CIM_PROMPT)
+            command = self.key().upper()
+            self.stats['commands'] += 1
+            if(command == 'Q'):
+                return
+            elif(command == 'I'):
+                self.warp_report()
+            elif(command == 'R'):
+                self.port_report()
+            elif(command == 'F'):
+                self.send('\r\nFM > ')
+                start = self.number()
+                self.send('  TO > ')
+                end = self.number()
+                route = self.plot(start, end)
+                if(route):
+                    self.send(self.universe.route_str(route) + '\r\n')
+
+    def warp_report(self):
+        u = self.universe
+        lines = ['']
+        for sector in sorted(u.explored):
+            warps = u.graph.warps_from(sector)
+            if(warps):
+                lines.append('{:4}'.format(sector) + ''.join(' {:4}'.format(w) for w in warps))
+        self.send('\r\n'.join(lines) + '\r\n')
+
+    def port_report(self):
+        u = self.universe
+        lines = ['']
+        with u.lock:
+            for sector in sorted(u.ports):
+                if(sector not in u.explored):
+                    continue
+                port_class, *amounts = u.ports[sector]
+                flags = ['-' if c == 'B' else ' ' for c in port_class]
+                lines.append('{:4} {} {:4} {:3}% {} {:4} {:3}% {} {:4} {:3}%'.format(sector, flags[0], amounts[0], amounts[1], flags[1], amounts[2], amounts[3], flags[2], amounts[4], amounts[5]))
+        self.send('\r\n'.join(lines) + '\r\n')
+
+    def plot(self, start, end):
+        self.stats['plots'] += 1
+        routes = []
+        if(start is not None and end is not None):
+            routes = self.universe.graph.bfs(start, [end])
+        if(len(routes) == 0):
+            self.send('\r\n*** Error - No route within 45 warps from sector {} to sector {}\r\n'.format(start, end))
+            return None
+        return routes[0]
+
+    def port(self):
+        u = self.universe
+        if(self.sector not in u.ports):
+            self.send('\r\nThere is no port in this sector!\r\n')
+            return
+        self.send('\r\n<Port>\r\n\r\nDocking...\r\n\r\nEnter your choice [T] ? ')
+        if(self.key().upper() not in ('T', '\r')):
+            self.send('\r\n')
+            return
+        self.send('T\r\n')
+        port_class = u.ports[self.sector][0]
+        lines = ['', 'Commerce report for Stand-in Station {}:'.format(self.sector), '', ' Items     Status  Trading % of max OnBoard', ' -----     ------  ------- -------- -------']
+        with u.lock:
+            for i, name in enumerate(COMMODITIES):
+                lines.append('{:10} {:7} {:7} {:7}% {:7}'.format(name, 'Buying' if port_class[i] == 'B' else 'Selling', u.ports[self.sector][1 + 2 * i], u.ports[self.sector][2 + 2 * i], self.cargo[i]))
+        self.send('\r\n'.join(lines) + '\r\n')
+
+        # sell to the port first, then buy from it, as the game does
+        for operation, wanted in (('sell', 'B'), ('buy', 'S')):
+            for i, name in enumerate(COMMODITIES):
+                if(port_class[i] != wanted):
+                    continue
+                with u.lock:
+                    available = u.ports[self.sector][1 + 2 * i]
+                if(operation == 'sell'):
+                    most = min(self.cargo[i], available)
+                else:
+                    most = min(self.holds - sum(self.cargo), available)
+                if(most <= 0):
+                    continue
+                self.send('\r\nHow many holds of {} do you want to {} [{:,}]? '.format(name, operation, most))
+                units = self.number(most)
+                if(units is None or units <= 0 or units > most):
+                    continue
+                self.send('Agreed, {} units.\r\n'.format(units))
+                self.haggle(operation, i, units)
+        self.send('\r\nYou have {:,} credits and {} empty cargo holds.\r\n'.format(self.credits, self.holds - sum(self.cargo)))
+
+    # the port starts at its price and gives a little ground on each of three offers; too greedy and it walks away
+    def haggle(self, operation, commodity, units):
+        u = self.universe
+        with u.lock:
+            pct = u.ports[self.sector][2 + 2 * commodity]
+        unit_price = BASE_PRICES[commodity] * (1.0 + (100 - pct) / 200)
+        if(operation == 'sell'):
+            unit_price *= 0.9
+        asking = int(unit_price * units)
+        # the worst deal the port will take
+        if(operation == 'buy'):
+            limit = asking * self.rng.uniform(0.90, 0.95)
+            self.send('We\'ll sell them for {:,} credits.\r\n'.format(asking))
+        else:
+            limit = asking * self.rng.uniform(1.05, 1.10)
+            self.send('We\'ll buy them for {:,} credits.\r\n'.format(asking))
+        self.stats['trades'] += 1
+        for attempt in range(3):
+            self.send('Your offer [{:,}] ? '.format(asking))
+            offer = self.number(asking)
+            self.stats['offers'] += 1
+            if((operation == 'buy' and offer >= limit) or (operation == 'sell' and offer <= limit)):
+                with u.lock:
+                    u.ports[self.sector][1 + 2 * commodity] -= units
+                if(operation == 'buy'):
+                    self.credits -= offer
+                    self.cargo[commodity] += units
+                else:
+                    self.credits += offer
+                    self.cargo[commodity] -= units
+                self.send('\r\nAgreed!\r\n')
+                return True
+            if(attempt == 2):
+                break
+            # meet them part of the way, but never at the same price twice
+            moved = int(abs(asking - offer) * self.rng.uniform(0.2, 0.5)) or 1
+            asking = asking - moved if operation == 'buy' else asking + moved
+            if(attempt == 1):
+                self.send('Our final offer is {:,} credits.\r\n'.format(asking))
+            else:
+                self.send('We\'ll {} them for {:,} credits.\r\n'.format('sell' if operation == 'buy' else 'buy', asking))
+        self.send('\r\nWe\'re not interested.\r\n')
+        return False
+
+def port_class_number(port_class):
+    return {'BBS':1, 'BSB':2, 'SBB':3, 'SSB':4, 'SBS':5, 'BSS':6, 'SSS':7, 'BBB':8}.get(port_class, 0)
+
+class RequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = Link(self.request, delay=server.delay, bandwidth=server.bandwidth)
+        session = GameSession(server.universe, self.request, link, sector=server.start_sector, seed=server.seed)
+        start = time.time()
+        print('twserver: {}:{} connected'.format(*self.client_address), flush=True)
+        try:
+            session.run()
+        finally:
+            link.close()
+        elapsed = time.time() - start
+        stats = session.stats
+        print('twserver: {}:{} disconnected after {:.1f}s: {} commands, {} course plots ({:.1f}/s), {} trades, {} offers, {} bytes sent'.format(
+            self.client_address[0], self.client_address[1], elapsed, stats['commands'], stats['plots'], stats['plots'] / elapsed if elapsed else 0,
+            stats['trades'], stats['offers'], link.bytes_sent), flush=True)
+
+class Server(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    universe = None
+    delay = 0.0
+    bandwidth = None
+    start_sector = 1
+    seed = None
+
+
+if(__name__ == '__main__'):
+    parser = argparse.ArgumentParser(description='A local stand-in for a TW2002 game server, playing a universe from a SQLite database, so twclient.py and its macros can be tried and timed without a real game.')
+    parser.add_argument('--database', '-d', dest='db', default=DEFAULT_DB_NAME, help='SQLite database holding the universe to play, e.g. tw2002-demo.db or one made by twgen.py; default "{}"'.format(DEFAULT_DB_NAME))
+    parser.add_argument('--host', default='127.0.0.1', help='Address to listen on; default 127.0.0.1')
+    parser.add_argument('--port', '-p', type=int, default=DEFAULT_PORT, help='Port to listen on; default {}'.format(DEFAULT_PORT))
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds to delay everything the server sends, like a network round trip; default 0')
+    parser.add_argument('--bandwidth', type=int, help='Most bytes per second to send; default unlimited')
+    parser.add_argument('--sector', '-s', type=int, default=1, help='Sector each player starts in; default 1')
+    parser.add_argument('--seed', type=int, help='Random seed for the ports\' haggling, for repeatable runs')
+
+    args = parser.parse_args()
+
+    start = time.time()
+    universe = Universe(args.db)
+    server = Server((args.host, args.port), RequestHandler)
+    server.universe = universe
+    server.delay = args.delay
+    server.bandwidth = args.bandwidth
+    server.start_sector = args.sector
+    server.seed = args.seed
+    print('twserver: {} sectors, {} ports from {} loaded in {:.2f}s; listening on {}:{}'.format(
+        universe.max_sector, len(universe.ports), args.db, time.time() - start, args.host, server.server_address[1]), flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    sys.exit(0)
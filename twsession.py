@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import threading
+import struct
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# a session recording is this header, then one record per chunk received from the game: the seconds since the first
+# chunk (from the monotonic clock) and the chunk's length, followed by the chunk itself.  files ending in .gz or .zst
+# are compressed
+MAGIC = b'TWSESSION1\n'
+RECORD = struct.Struct('<dI')
+
+# seconds between flushes of a recording, so a client that's killed loses no more than this much of it
+RECORD_FLUSH_INTERVAL = 1.0
+
+def open_session(filename, mode):
+    if(filename.endswith('.gz')):
+        return gzip.open(filename, mode)
+    if(filename.endswith('.zst')):
+        if(zstandard is None):
+            raise RuntimeError('{}: the zstandard module is needed for .zst recordings (pip3 install zstandard)'.format(filename))
+        raw = open(filename, mode)
+        if('w' in mode):
+            return zstandard.ZstdCompressor().stream_writer(raw, closefd=True)
+        return zstandard.ZstdDecompressor().stream_reader(raw, closefd=True)
+    return open(filename, mode)
+
+# records what twclient receives from the game.  timestamps are time.perf_counter() values, as twclient takes them
+class SessionRecorder:
+    def __init__(self, filename):
+        self.file = open_session(filename, 'wb')
+        self.file.write(MAGIC)
+        self.start = None
+        self.flushed = None
+        self.lock = threading.Lock()
+
+    def write(self, timestamp, data):
+        with self.lock:
+            if(self.file is None):
+                return
+            if(self.start is None):
+                self.start = self.flushed = timestamp
+            self.file.write(RECORD.pack(timestamp - self.start, len(data)))
+            self.file.write(data)
+            if(timestamp - self.flushed > RECORD_FLUSH_INTERVAL):
+                self.file.flush()
+                self.flushed = timestamp
+
+    def close(self):
+        with self.lock:
+            if(self.file is not None):
+                self.file.close()
+                self.file = None
+
+def read_exactly(f, size):
+    data = b''
+    while(len(data) < size):
+        try:
+            more = f.read(size - len(data))
+        except EOFError:
+            # the end of a compressed file that was never closed properly
+            break
+        if(not more):
+            break
+        data += more
+    return data
+
+def check_session(f, filename):
+    if(read_exactly(f, len(MAGIC)) != MAGIC):
+        raise ValueError('{}: not a session recording'.format(filename))
+
+# yields (seconds since the first chunk, chunk) for each chunk in a recording
+def read_session(filename):
+    with open_session(filename, 'rb') as f:
+        check_session(f, filename)
+        while(True):
+            header = read_exactly(f, RECORD.size)
+            if(len(header) < RECORD.size):
+                # a recording cut off mid-record (the client was killed) is read up to the last whole chunk
+                return
+            offset, size = RECORD.unpack(header)
+            data = read_exactly(f, size)
+            if(len(data) < size):
+                return
+            yield offset, data